@@ -47,6 +47,20 @@ def create_app(config_class=Config):
     setup_frontend_logs_table()
     from app.models.transportopendata import set_parking_data_table
     set_parking_data_table()
+    from app.models.clashofclans import (setup_coc_tracked_clan_table, setup_coc_player_table,
+                                         setup_coc_player_data_table, setup_coc_upgrade_events_table,
+                                         setup_coc_player_activity_table, setup_coc_war_history_table,
+                                         setup_coc_war_stats_table, setup_coc_capital_raid_season_table,
+                                         setup_coc_view_count_flush_table)
+    setup_coc_tracked_clan_table()
+    setup_coc_player_table()
+    setup_coc_player_data_table()
+    setup_coc_upgrade_events_table()
+    setup_coc_player_activity_table()
+    setup_coc_war_history_table()
+    setup_coc_war_stats_table()
+    setup_coc_capital_raid_season_table()
+    setup_coc_view_count_flush_table()
 
     # Initialise CORS for auth
     cors.init_app(app, resources={
@@ -93,6 +107,15 @@ def create_app(config_class=Config):
     app.register_blueprint(clashofclans_bp,
                            url_prefix='/clashofclans')
 
+    # Register the scheduled jobs, they can also be triggered through their routes
+    from app.clashofclans.jobs import register_jobs as register_clashofclans_jobs
+    register_clashofclans_jobs()
+    from app.transportopendata.jobs import register_jobs as register_transportopendata_jobs
+    register_transportopendata_jobs()
+    if Config.BACKGROUND_JOBS:
+        from app.scheduler import start_scheduler
+        start_scheduler(app)
+
     @app.errorhandler(429)
     def ratelimit_handler(e):
         return jsonify({"error": f"rate limit exceeded {e.description}"}), 429
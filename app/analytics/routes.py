@@ -7,6 +7,7 @@ from app.analytics import bp
 from app.models.request_log import get_api_requests_per_bucket
 from app.models.frontend_log import get_frontend_log_per_bucket, insert_frontend_log
 from app.extensions import limiter
+from app.scheduler import job_metrics
 from zoneinfo import ZoneInfo
 from dateutil import parser
 from urllib.parse import urlparse
@@ -88,6 +89,15 @@ def frontend_visits():
         return jsonify({'success': True}), 201
 
 
+@bp.route('/jobs', methods=['GET'])
+@limiter.limit('20/minute', override_defaults=True)
+def get_jobs():
+    """
+    Schedule and last run metrics of the background jobs
+    """
+    return jsonify(job_metrics()), 200
+
+
 def sanitise_route(route: str) -> str:
     # Parse the URL to get the path
     parsed_url = urlparse(route)
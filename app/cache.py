@@ -0,0 +1,64 @@
+import sys
+import time
+from typing import Callable, Optional, Tuple
+from flask import current_app
+from app.extensions import redis_client, socketio
+
+
+def stale_while_revalidate(key: str, fresh_for: int, stale_for: int, compute: Callable[[], str]) -> Tuple[str, int]:
+    """
+    Returns the cached value of key and its age in seconds.
+
+    :param key: Redis key the value is stored under.
+    :param fresh_for: Seconds the value is served without being refreshed.
+    :param stale_for: Seconds after that the stale value is still served while it is refreshed in the background.
+    :param compute: Builds the (already serialised) value. Exceptions propagate when there is nothing cached.
+    """
+    value, age = read_cached(key)
+    if value is not None:
+        if age >= fresh_for:
+            _refresh_in_background(key, fresh_for, stale_for, compute)
+        return value, age
+
+    value = compute()
+    write_cached(key, value, fresh_for + stale_for)
+    return value, 0
+
+
+def read_cached(key: str) -> Tuple[Optional[str], Optional[int]]:
+    """
+    Returns the value stored under key and its age in seconds, (None, None) if there is none
+    """
+    cached = redis_client.hmget(key, "value", "stored_at")
+    if cached[0] is None:
+        return None, None
+    return cached[0].decode(), int(time.time()) - int(cached[1])
+
+
+def write_cached(key: str, value: str, expire: int):
+    """
+    Stores an (already serialised) value under key, recording when it was stored. It is removed after expire seconds
+    """
+    pipe = redis_client.pipeline()
+    pipe.hset(key, mapping={"value": value, "stored_at": int(time.time())})
+    pipe.expire(key, expire)
+    pipe.execute()
+
+
+def _refresh_in_background(key: str, fresh_for: int, stale_for: int, compute: Callable[[], str]):
+    # Only one refresh per key at a time, across all workers
+    if not redis_client.set(f"{key}:refreshing", 1, nx=True, ex=max(fresh_for, 10)):
+        return
+
+    app = current_app._get_current_object()
+
+    def refresh():
+        with app.app_context():
+            try:
+                write_cached(key, compute(), fresh_for + stale_for)
+            except Exception as e:
+                print(f"Error refreshing {key}: {str(e)}", file=sys.stderr)
+            finally:
+                redis_client.delete(f"{key}:refreshing")
+
+    socketio.start_background_task(refresh)
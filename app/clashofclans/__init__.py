@@ -2,4 +2,4 @@ from flask import Blueprint
 
 bp = Blueprint('clashofclans', __name__)
 
-from app.clashofclans import routes
\ No newline at end of file
+from app.clashofclans import commands, routes
\ No newline at end of file
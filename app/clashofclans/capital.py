@@ -0,0 +1,159 @@
+import base64
+from datetime import datetime
+import json
+import sys
+from typing import List, Optional
+from zoneinfo import ZoneInfo
+from sqlalchemy.dialects.postgresql import insert
+from app.clashofclans.client import CocApiError, coc_client
+from app.clashofclans.quota import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from app.clashofclans.tracking import over_quota, record_requests, tracked_clan_tags
+from app.extensions import db
+from app.models.clashofclans import CocCapitalRaidSeason
+
+# Seasons requested per upstream page while syncing
+SYNC_PAGE_SIZE = 10
+# Bounds a first sync of a clan, the API keeps far fewer seasons than this
+SYNC_MAX_PAGES = 20
+
+
+def _parse_time(value: str) -> datetime:
+    return datetime.strptime(value.replace('Z', ''), "%Y%m%dT%H%M%S.%f").replace(tzinfo=ZoneInfo("UTC"))
+
+
+def encode_cursor(start_time: datetime) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"before": start_time.isoformat()}).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> datetime:
+    """
+    The start time a page continues before. Raises ValueError if the cursor is invalid
+    """
+    try:
+        before = json.loads(base64.urlsafe_b64decode(cursor.encode()))["before"]
+        return datetime.fromisoformat(before)
+    except (TypeError, KeyError, UnicodeDecodeError, json.JSONDecodeError, base64.binascii.Error) as e:
+        raise ValueError(f"Invalid cursor '{cursor}'") from e
+
+
+def store_seasons(clan_tag: str, seasons: List[dict]) -> int:
+    """
+    Stores the ended seasons of a clan that aren't stored yet, returns how many were inserted
+    """
+    rows = [
+        {
+            "clan_tag": clan_tag,
+            "start_time": _parse_time(season["startTime"]),
+            "end_time": _parse_time(season["endTime"]),
+            "state": season["state"],
+            "data": season,
+        }
+        for season in seasons if season.get("state") == "ended"
+    ]
+    if not rows:
+        return 0
+    result = db.session.execute(insert(CocCapitalRaidSeason).values(rows).on_conflict_do_nothing()
+                                .returning(CocCapitalRaidSeason.start_time))
+    inserted = len(result.all())
+    db.session.commit()
+    return inserted
+
+
+def latest_stored_season(clan_tag: str) -> Optional[datetime]:
+    return (db.session.query(db.func.max(CocCapitalRaidSeason.start_time))
+            .filter(CocCapitalRaidSeason.clan_tag == clan_tag)
+            .scalar())
+
+
+def sync_capital_raid_seasons(clan_tag: str, priority: str = PRIORITY_BACKGROUND) -> dict:
+    """
+    Fetches the clan's seasons newest first until reaching the latest stored one and stores the ended ones,
+    so after the first sync a run is usually a single request. Raises CocApiError if a page can't be fetched
+    """
+    latest = latest_stored_season(clan_tag)
+    params = {"limit": SYNC_PAGE_SIZE}
+    requests = 0
+    inserted = 0
+    for _ in range(SYNC_MAX_PAGES):
+        response = coc_client.get(f"/clans/{clan_tag.replace('#', '%23')}/capitalraidseasons", params=params,
+                                  cache=False, priority=priority)
+        requests += 1
+        if not response.ok:
+            raise CocApiError(response.json().get("reason"), response.status_code)
+
+        body = response.json()
+        seasons = body.get("items", [])
+        new = [s for s in seasons if latest is None or _parse_time(s["startTime"]) > latest]
+        inserted += store_seasons(clan_tag, new)
+
+        after = body.get("paging", {}).get("cursors", {}).get("after")
+        if len(new) < len(seasons) or not after:
+            break
+        params["after"] = after
+    return {"requests": requests, "inserted": inserted}
+
+
+def collect_capital_raid_seasons():
+    """
+    Syncs the capital raid seasons of each tracked clan. Scheduled as the coc_capital_raid_seasons job
+    """
+    inserted = 0
+    failures = 0
+    for tag in tracked_clan_tags():
+        if over_quota(tag):
+            continue
+        try:
+            result = sync_capital_raid_seasons(tag)
+            record_requests(tag, result["requests"])
+            inserted += result["inserted"]
+        except CocApiError as e:
+            print(f"Unable to sync capital raid seasons of {tag}: {e.status_code} {e.message}", file=sys.stderr)
+            failures += 1
+    return {"items": inserted, "failures": failures}
+
+
+def capital_raid_seasons_page(clan_tag: str, limit: int, before: Optional[datetime]):
+    """
+    A page of the clan's seasons newest first, in the API's response shape. History is served from the
+    stored seasons, upstream is only requested on the first page for the latest (usually ongoing) season,
+    syncing first if more than the latest season is missing since the last sync.
+    Returns None if nothing is stored for the clan, so the caller can proxy the request instead.
+    Raises CocApiError if the latest season can't be fetched
+    """
+    latest_stored = latest_stored_season(clan_tag)
+    if latest_stored is None:
+        return None
+
+    items = []
+    if before is None:
+        response = coc_client.get(f"/clans/{clan_tag.replace('#', '%23')}/capitalraidseasons",
+                                  params={"limit": 2}, priority=PRIORITY_INTERACTIVE)
+        if not response.ok:
+            raise CocApiError(response.json().get("reason"), response.status_code)
+        latest = response.json().get("items", [])
+        if len(latest) > 1 and _parse_time(latest[1]["startTime"]) > latest_stored:
+            # Seasons were missed since the last sync (e.g. the job wasn't running), fill the hole first
+            sync_capital_raid_seasons(clan_tag, PRIORITY_INTERACTIVE)
+        else:
+            # A season that ended since the last sync
+            store_seasons(clan_tag, latest[:1])
+        if latest and latest[0].get("state") != "ended":
+            items.append(latest[0])
+
+    # One extra row tells whether there is a next page
+    query = (CocCapitalRaidSeason.query
+             .filter(CocCapitalRaidSeason.clan_tag == clan_tag)
+             .order_by(CocCapitalRaidSeason.start_time.desc()))
+    if before is not None:
+        query = query.filter(CocCapitalRaidSeason.start_time < before)
+    stored = query.limit(limit - len(items) + 1).all()
+
+    has_more = len(stored) > limit - len(items)
+    stored = stored[:limit - len(items)]
+    items.extend(season.data for season in stored)
+
+    cursors = {}
+    if has_more:
+        last = stored[-1].start_time if stored else _parse_time(items[-1]["startTime"])
+        cursors["after"] = encode_cursor(last)
+    return {"items": items, "paging": {"cursors": cursors}}
@@ -0,0 +1,184 @@
+from collections import defaultdict
+from concurrent.futures import Future
+import json
+import re
+import threading
+import time
+from urllib.parse import urlencode
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from app.clashofclans.quota import PRIORITY_INTERACTIVE, coc_quota
+from app.extensions import redis_client
+from config import Config
+
+BASE_URL = "https://cocproxy.royaleapi.dev/v1"
+# Large enough for the default ThreadPoolExecutor (min(32, cpus + 4) workers) used to fan out requests
+POOL_SIZE = 32
+# (connect, read) timeouts in seconds
+TIMEOUT = (3.05, 15)
+CACHE_KEY = "coc:cache"
+CACHE_STATS_KEY = "coc:cache:stats"
+
+
+class CocApiError(Exception):
+    """
+    A failed CoC API request, with the API's error message and status code
+    """
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class CachedResponse:
+    """
+    The parts of requests.Response that callers use, for responses served from the cache
+    """
+    status_code = 200
+    ok = True
+
+    def __init__(self, content: bytes):
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode()
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class CocClient:
+    """
+    Clash of Clans API client that keeps connections to the proxy alive across requests,
+    retries rate limited/failed requests with backoff and records latency/error metrics.
+
+    Successful responses are cached in Redis for as long as the API's Cache-Control max-age
+    allows, and concurrent requests for the same URL share a single upstream call
+    """
+
+    def __init__(self, base_url: str, token: str, pool_size: int = POOL_SIZE, timeout=TIMEOUT, retries: int = 3):
+        self.base_url = base_url
+        self.timeout = timeout
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET"]),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {token}"
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._in_flight: dict[str, Future] = {}
+        self._metrics = defaultdict(lambda: {
+            "requests": 0,
+            "errors": 0,
+            "statuses": defaultdict(int),
+            "total_latency_ms": 0.0,
+            "max_latency_ms": 0.0
+        })
+
+    def get(self, path: str, params: dict = None, cache: bool = True,
+            priority: str = PRIORITY_INTERACTIVE) -> requests.Response | CachedResponse:
+        """
+        GET a path relative to the API root, e.g. /clans/%23220QP2GGU.
+        Requests that reach the API wait for the shared upstream quota, background collection should pass
+        PRIORITY_BACKGROUND so it yields to interactive requests
+        """
+        if not cache:
+            return self._fetch(path, params, priority)
+
+        key = f"{CACHE_KEY}:{path}"
+        if params:
+            key += f"?{urlencode(sorted(params.items()), doseq=True)}"
+
+        cached = redis_client.get(key)
+        if cached is not None:
+            redis_client.hincrby(CACHE_STATS_KEY, "hits")
+            return CachedResponse(cached)
+
+        # Single flight, if the same URL is already being fetched wait for that instead
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+
+        if not leader:
+            redis_client.hincrby(CACHE_STATS_KEY, "coalesced")
+            return future.result()
+
+        redis_client.hincrby(CACHE_STATS_KEY, "misses")
+        try:
+            response = self._fetch(path, params, priority)
+            max_age = self._max_age(response)
+            if response.status_code == 200 and max_age:
+                redis_client.set(key, response.content, ex=max_age)
+            future.set_result(response)
+            return response
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def _fetch(self, path: str, params: dict = None, priority: str = PRIORITY_INTERACTIVE) -> requests.Response:
+        coc_quota.acquire(priority)
+        start = time.perf_counter()
+        try:
+            response = self.session.get(f"{self.base_url}{path}", params=params, timeout=self.timeout)
+        except requests.RequestException:
+            self._record(path, start, None)
+            raise
+        self._record(path, start, response.status_code)
+        return response
+
+    @staticmethod
+    def _max_age(response: requests.Response) -> int:
+        match = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+        return int(match.group(1)) if match else 0
+
+    def _record(self, path: str, start: float, status: int | None):
+        latency = (time.perf_counter() - start) * 1000
+        # Group metrics by endpoint rather than by tag
+        endpoint = re.sub(r"(%23|#)[^/?]+", "{tag}", path.split("?")[0])
+        with self._lock:
+            metric = self._metrics[endpoint]
+            metric["requests"] += 1
+            metric["statuses"][status or "failed"] += 1
+            if status is None or status == 429 or status >= 500:
+                metric["errors"] += 1
+            metric["total_latency_ms"] += latency
+            metric["max_latency_ms"] = max(metric["max_latency_ms"], latency)
+
+    def stats(self):
+        with self._lock:
+            upstream = {
+                endpoint: {
+                    "requests": m["requests"],
+                    "errors": m["errors"],
+                    "statuses": {str(k): v for k, v in m["statuses"].items()},
+                    "avg_latency_ms": round(m["total_latency_ms"] / m["requests"], 1),
+                    "max_latency_ms": round(m["max_latency_ms"], 1)
+                }
+                for endpoint, m in self._metrics.items()
+            }
+
+        cache = {k.decode(): int(v) for k, v in redis_client.hgetall(CACHE_STATS_KEY).items()}
+        lookups = sum(cache.get(k, 0) for k in ["hits", "misses", "coalesced"])
+        cache["hit_rate"] = round((cache.get("hits", 0) + cache.get("coalesced", 0)) / lookups, 3) if lookups else None
+
+        return {"upstream": upstream, "cache": cache}
+
+
+coc_client = CocClient(BASE_URL, Config.COC_BEARER_TOKEN)
@@ -0,0 +1,21 @@
+import click
+from app.clashofclans import bp
+from app.models.clashofclans import backfill_upgrade_events, refresh_player_daily
+
+# One off maintenance, e.g. `BACKGROUND_JOBS=false flask clashofclans refresh-player-daily`
+# (without the scheduler, which would otherwise start with the app)
+
+
+@bp.cli.command("refresh-player-daily")
+def refresh_player_daily_command():
+    """Materialise the daily player aggregate over all stored snapshots."""
+    refresh_player_daily()
+    click.echo("coc_player_daily refreshed")
+
+
+@bp.cli.command("backfill-upgrade-events")
+@click.option("--rebuild", is_flag=True, help="Replace the stored events instead of only adding missing ones.")
+def backfill_upgrade_events_command(rebuild):
+    """Derive upgrade events from all stored snapshots."""
+    backfill_upgrade_events(rebuild=rebuild)
+    click.echo("coc_upgrade_events rebuilt" if rebuild else "coc_upgrade_events backfilled")
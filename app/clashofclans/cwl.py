@@ -0,0 +1,62 @@
+import concurrent.futures
+import json
+from typing import List
+from app.clashofclans.client import coc_client
+from app.clashofclans.quota import PRIORITY_INTERACTIVE
+from app.extensions import redis_client
+
+CWL_WAR_KEY = "coc:cwl_war"
+# Ended wars never change, keep them for longer than a CWL season (about a week) is visible in the league group
+CWL_WAR_TTL = 35 * 24 * 3600
+
+
+def league_group_war_tags(leaguegroup_data: dict) -> List[str]:
+    """
+    The war tags of every round of a league group that has been drawn, in round order
+    """
+    return [
+        war_tag
+        for r in leaguegroup_data.get("rounds")
+        for war_tag in r.get("warTags")
+        if war_tag != "#0"
+    ]
+
+
+def fetch_cwl_wars(war_tags: List[str], priority: str = PRIORITY_INTERACTIVE) -> List[dict]:
+    """
+    Fetches the CWL wars of the given war tags, skipping any that can't be fetched.
+    Wars that have ended are immutable, so they are stored in Redis and only wars in
+    preparation or in progress are requested from the API. Each war has its url encoded
+    tag added as "war_tag".
+    """
+    if not war_tags:
+        return []
+
+    cached = redis_client.mget([f"{CWL_WAR_KEY}:{war_tag}" for war_tag in war_tags])
+    wars = {war_tag: json.loads(war) for war_tag, war in zip(war_tags, cached) if war is not None}
+
+    def fetch(war_tag):
+        response = coc_client.get(f"/clanwarleagues/wars/{war_tag.replace('#', '%23')}", priority=priority)
+        return response.json() if response.ok else None
+
+    missing = [war_tag for war_tag in war_tags if war_tag not in wars]
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            fetched = dict(zip(missing, executor.map(fetch, missing)))
+
+        pipe = redis_client.pipeline()
+        for war_tag, war in fetched.items():
+            if war is None:
+                continue
+            wars[war_tag] = war
+            if war.get("state") == "warEnded":
+                pipe.set(f"{CWL_WAR_KEY}:{war_tag}", json.dumps(war), ex=CWL_WAR_TTL)
+        pipe.execute()
+
+    result = []
+    for war_tag in war_tags:
+        war = wars.get(war_tag)
+        if war:
+            war["war_tag"] = war_tag.replace("#", "%23")
+            result.append(war)
+    return result
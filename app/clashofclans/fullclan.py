@@ -0,0 +1,231 @@
+import concurrent.futures
+from datetime import datetime
+import sys
+from typing import List, Optional
+from flask import current_app
+from app.cache import read_cached, write_cached
+from app.clashofclans.client import coc_client
+from app.clashofclans.cwl import fetch_cwl_wars, league_group_war_tags
+from app.clashofclans.quota import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from app.clashofclans.tracking import tracked_clan_tags
+from config import Config
+
+FULLCLAN_SNAPSHOT_KEY = "coc:fullclan"
+
+
+def full_clan_data(tag: str, priority: str = PRIORITY_INTERACTIVE):
+    """
+    Fetches the clan, its capital raid, regular war and CWL wars and combines them with build_full_clan.
+    Return value: clan_data, error_message, status_code
+    """
+    tag = tag.replace("#", "%23")
+    clan_url = f"/clans/{tag}"
+    capital_raid = f"/clans/{tag}/capitalraidseasons?limit=1"
+    war_url = f"/clans/{tag}/currentwar"
+    leaguegroup_url = f"/clans/{tag}/currentwar/leaguegroup"
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        futures = [executor.submit(coc_client.get, url, priority=priority)
+                   for url in [clan_url, capital_raid, war_url, leaguegroup_url]]
+        clan_response, capital_raid_response, war_response, leaguegroup_response = [f.result() for f in futures]
+
+    # League group can be 404 if CWL is not currently active
+    # Current war is 403 if war log is not private
+    if not clan_response.ok:
+        return None, clan_response.json().get("message"), clan_response.status_code
+    if not capital_raid_response.ok:
+        return None, capital_raid_response.json().get("message"), capital_raid_response.status_code
+    if not war_response.ok and war_response.status_code != 403:
+        return None, war_response.json().get("message"), war_response.status_code
+    if not leaguegroup_response.ok and leaguegroup_response.status_code != 404:
+        return None, leaguegroup_response.json().get("message"), leaguegroup_response.status_code
+
+    # If leaguegroup exists then fetch all CWL wars
+    cwl_wars = None
+    if leaguegroup_response.status_code != 404:
+        cwl_wars = fetch_cwl_wars(league_group_war_tags(leaguegroup_response.json()), priority)
+        # Keeping it sorted in order is good
+        cwl_wars.sort(key=lambda x: datetime.strptime(x["startTime"], "%Y%m%dT%H%M%S.%fZ"))
+
+    capital_data = capital_raid_response.json()["items"]
+    capital_data = capital_data[0] if len(capital_data) == 1 else None
+
+    war_data = war_response.json() if war_response.status_code != 403 else None
+
+    return build_full_clan(tag, clan_response.json(), war_data, capital_data, cwl_wars), None, 200
+
+
+def full_clan_snapshot(tag: str):
+    """
+    The serialised full clan data of a tracked clan and its age in seconds, (None, None) if there is no snapshot yet
+    """
+    return read_cached(f"{FULLCLAN_SNAPSHOT_KEY}:{tag}")
+
+
+def refresh_full_clan_snapshot(tag: str) -> bool:
+    """
+    Rebuilds and stores the snapshot of a clan. Returns whether it was refreshed
+    """
+    clan, error, status = full_clan_data(tag, PRIORITY_BACKGROUND)
+    if error:
+        print(f"Unable to refresh full clan data of {tag}: {status} {error}", file=sys.stderr)
+        return False
+    # An old snapshot is worse than assembling on demand, so it expires if refreshing stops
+    write_cached(f"{FULLCLAN_SNAPSHOT_KEY}:{tag}", current_app.json.dumps(clan), Config.COC_FULLCLAN_REFRESH_SECONDS * 5)
+    return True
+
+
+def refresh_full_clan_snapshots():
+    """
+    Refreshes the snapshots of the tracked clans. Scheduled as the coc_fullclan_snapshots job
+    """
+    refreshed = 0
+    tags = tracked_clan_tags()
+    for tag in tags:
+        try:
+            refreshed += refresh_full_clan_snapshot(tag)
+        except Exception as e:
+            print(f"Error refreshing full clan data of {tag}: {str(e)}", file=sys.stderr)
+    return {"items": refreshed, "failures": len(tags) - refreshed}
+
+
+def build_full_clan(tag: str, clan: dict, war_data: Optional[dict], capital_data: Optional[dict],
+                    cwl_wars: Optional[List[dict]]) -> dict:
+    """
+    Combines the clan, its current regular war, current capital raid and CWL wars into the clan,
+    adding each member's capital raid, war and CWL stats and the CWL round summary.
+
+    Each source is indexed by player tag once and the CWL stats are built in a single pass over
+    the wars, so the cost is linear in the size of the input rather than members x wars x roster.
+    The clan dict is modified in place and returned.
+    """
+    tag = tag.replace("%23", "#")
+
+    clan["war"] = war_data
+    clan["cwl_wars"] = cwl_wars
+    clan["capital_raid_data"] = capital_data
+
+    # Raid contributions for the current clan capital raid
+    capital_players = {}
+    if capital_data and capital_data.get("state") == "ongoing":
+        capital_players = {p["tag"]: p for p in capital_data["members"]}
+
+    # Attacks used in the ongoing regular war
+    war_players = {}
+    if war_data and war_data.get("state") == "inWar":
+        war_players = {p["tag"]: p for p in war_data["clan"]["members"]}
+
+    cwl_stats = _cwl_player_stats(tag, cwl_wars) if cwl_wars else None
+
+    for member in clan["memberList"]:
+        capital_player = capital_players.get(member["tag"])
+        # We dont want players who haven't opened it to show up
+        member["clan_capital"] = {
+            "attacks": capital_player.get("attacks", 0),
+            "capitalResourcesLooted": capital_player.get("capitalResourcesLooted", 0)
+        } if capital_player else None
+
+        war_player = war_players.get(member["tag"])
+        member["war"] = {"attacks": len(war_player.get("attacks", []))} if war_player else None
+
+        if cwl_stats is not None:
+            member["cwl_war"] = cwl_stats.get(member["tag"]) or _empty_cwl_stats()
+        else:
+            member["cwl_war"] = None
+
+    clan["cwl_war_rounds"] = _cwl_war_rounds(tag, cwl_wars) if cwl_wars else None
+
+    return clan
+
+
+def _empty_cwl_stats():
+    return {
+        "attacks": 0,
+        "attack_limit": 0,
+        "total_destruction": 0,
+        "total_stars": 0,
+        "total_duration": 0,
+        "attack_todo": False,
+        "defends": 0,
+        "defends_stars": 0,
+        "defends_total_destruction": 0,
+        "defends_total_duration": 0
+    }
+
+
+def _cwl_player_stats(tag: str, cwl_wars: List[dict]) -> dict:
+    """
+    Aggregated CWL attack and defence stats of each player of the clan, keyed by player tag
+    """
+    stats = {}
+    for war in cwl_wars:
+        # If it's preparation then skip
+        state = war.get("state")
+        if state == "preparation":
+            continue
+
+        # Get the members list if the requested clan is in this war
+        if war["clan"].get("tag") == tag:
+            war_members = war["clan"].get("members")
+        elif war["opponent"].get("tag") == tag:
+            war_members = war["opponent"].get("members")
+        else:
+            continue
+
+        # War state can be inWar or warEnded
+        for war_player in war_members:
+            player_stats = stats.get(war_player["tag"])
+            if player_stats is None:
+                player_stats = stats[war_player["tag"]] = _empty_cwl_stats()
+
+            player_stats["attack_limit"] += 1
+            attacks = war_player.get("attacks")
+            if attacks and len(attacks) == 1:
+                attack_info = attacks[0]
+                player_stats["attacks"] += 1
+                player_stats["total_destruction"] += attack_info.get("destructionPercentage")
+                player_stats["total_stars"] += attack_info.get("stars")
+                player_stats["total_duration"] += attack_info.get("duration")
+            elif state == "inWar":
+                player_stats["attack_todo"] = True
+
+            opponent_attacks = war_player.get("opponentAttacks")
+            if opponent_attacks > 0:
+                player_stats["defends"] += opponent_attacks
+                best_attack = war_player.get("bestOpponentAttack")
+                if best_attack:
+                    player_stats["defends_stars"] += best_attack.get("stars")
+                    player_stats["defends_total_destruction"] += best_attack.get("destructionPercentage")
+                    player_stats["defends_total_duration"] += best_attack.get("duration")
+    return stats
+
+
+def _cwl_war_rounds(tag: str, cwl_wars: List[dict]) -> List[dict]:
+    """
+    CWL round info for this clan (clan, opponent, war tag), with our clan as the friendly one
+    """
+    rounds = []
+    for war in cwl_wars:
+        if war["opponent"].get("tag") == tag:
+            clan, opponent = war["opponent"], war["clan"]
+            clan_tag = tag
+        else:
+            clan, opponent = war["clan"], war["opponent"]
+            clan_tag = clan.get("tag")
+
+        rounds.append({
+            "war_tag": war.get("war_tag").replace("%23", "#"),
+            "clan": clan.get("name"),
+            "clan_tag": clan_tag,
+            "clan_attacks": clan.get("attacks"),
+            "clan_stars": clan.get("stars"),
+            "clan_destruction_percentage": clan.get("destructionPercentage"),
+            "opponent": opponent.get("name"),
+            "opponent_tag": opponent.get("tag"),
+            "opponent_attacks": opponent.get("attacks"),
+            "opponent_stars": opponent.get("stars"),
+            "opponent_destruction_percentage": opponent.get("destructionPercentage"),
+            "state": war.get("state"),
+            "team_size": war.get("teamSize"),
+        })
+    return rounds
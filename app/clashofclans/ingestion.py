@@ -0,0 +1,77 @@
+import concurrent.futures
+import sys
+import time
+from typing import Callable, Iterable, List, Tuple
+from app.clashofclans.client import coc_client
+from app.clashofclans.quota import PRIORITY_BACKGROUND
+from app.extensions import db
+
+# Concurrent upstream fetches, the shared upstream quota decides the actual request rate
+INGESTION_WORKERS = 8
+WRITE_BATCH_SIZE = 50
+
+
+class PlayerIngestion:
+    """
+    Fetches players from the CoC API concurrently (as background requests of the upstream quota) and hands the
+    parsed payloads in batches to a single writer running in the calling thread, so the writer can
+    use the request's db session and persist each batch with one commit.
+
+    The writer receives a list of (tag, player json) and returns how many players it persisted.
+    If a writer raises, the session is rolled back and the batch is counted as failed.
+    """
+
+    def __init__(self, name: str, workers: int = INGESTION_WORKERS, batch_size: int = WRITE_BATCH_SIZE):
+        self.name = name
+        self.workers = workers
+        self.batch_size = batch_size
+
+    def _fetch(self, tag: str):
+        response = coc_client.get(f"/players/{tag.replace('#', '%23')}", priority=PRIORITY_BACKGROUND)
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+    def run(self, tags: Iterable[str], write: Callable[[List[Tuple[str, dict]]], int]):
+        start = time.perf_counter()
+        stats = {"job": self.name, "players": 0, "fetched": 0, "fetch_failures": 0, "written": 0, "write_failures": 0}
+        batch = []
+
+        def flush():
+            try:
+                stats["written"] += write(batch)
+            except Exception as e:
+                # End the failed transaction so the following batches can still be written
+                db.session.rollback()
+                print(f"{self.name}: failed to write {len(batch)} players: {str(e)}", file=sys.stderr)
+                stats["write_failures"] += len(batch)
+            batch.clear()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self._fetch, tag): tag for tag in tags}
+            stats["players"] = len(futures)
+
+            for future in concurrent.futures.as_completed(futures):
+                tag = futures[future]
+                try:
+                    data = future.result()
+                except Exception as e:
+                    print(f"{self.name}: error fetching {tag}: {str(e)}", file=sys.stderr)
+                    data = None
+
+                if data is None:
+                    stats["fetch_failures"] += 1
+                    continue
+
+                stats["fetched"] += 1
+                batch.append((tag, data))
+                if len(batch) >= self.batch_size:
+                    flush()
+
+        if batch:
+            flush()
+
+        stats["duration_seconds"] = round(time.perf_counter() - start, 2)
+        stats["players_per_second"] = round(stats["fetched"] / stats["duration_seconds"], 2) if stats["duration_seconds"] else None
+        print(f"{self.name}: {stats}", file=sys.stderr)
+        return stats
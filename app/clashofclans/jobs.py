@@ -0,0 +1,17 @@
+from app.clashofclans.capital import collect_capital_raid_seasons
+from app.clashofclans.fullclan import refresh_full_clan_snapshots
+from app.clashofclans.routes import collect_player_activity, collect_player_snapshots, collect_war_history
+from app.clashofclans.tracking import COLLECTION_TICK_SECONDS
+from app.clashofclans.view_counts import flush_views
+from app.scheduler import register_job
+from config import Config
+
+
+def register_jobs():
+    # Each run collects the share of clans/players that is due, see app.clashofclans.tracking
+    register_job("coc_player_snapshots", collect_player_snapshots, interval=COLLECTION_TICK_SECONDS, timeout=600)
+    register_job("coc_player_activity", collect_player_activity, interval=COLLECTION_TICK_SECONDS, timeout=600)
+    register_job("coc_war_history", collect_war_history, interval=900, jitter=60)
+    register_job("coc_capital_raid_seasons", collect_capital_raid_seasons, interval=3600, jitter=300)
+    register_job("coc_fullclan_snapshots", refresh_full_clan_snapshots, interval=Config.COC_FULLCLAN_REFRESH_SECONDS)
+    register_job("coc_view_counts", lambda: {"items": flush_views()}, interval=Config.COC_VIEW_COUNT_FLUSH_SECONDS)
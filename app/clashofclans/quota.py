@@ -0,0 +1,62 @@
+import time
+from app.extensions import redis_client
+from config import Config
+
+QUOTA_KEY = "quota"
+COC_UPSTREAM = "cocproxy"
+
+# Interactive requests (someone is waiting on the response) can use every token, background collection has to
+# leave a share of the bucket so interactive requests never queue behind it
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BACKGROUND = "background"
+RESERVED_FRACTION = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_BACKGROUND: 0.5}
+
+# Token bucket shared by every process using the upstream, the discord bot runs the same script
+# (discord_bot/upstream_quota.py). Returns "0" when a token was taken, otherwise the seconds to wait
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+
+local wait = 0
+if tokens - 1 >= reserve then
+    tokens = tokens - 1
+else
+    wait = (reserve + 1 - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+token_bucket = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+
+class UpstreamQuota:
+    """
+    Distributed token bucket for an upstream API, acquire() blocks until a request may be made
+    """
+
+    def __init__(self, upstream: str, rate: float, capacity: int):
+        self.key = f"{QUOTA_KEY}:{upstream}"
+        self.rate = rate
+        self.capacity = max(1, capacity)
+
+    def acquire(self, priority: str = PRIORITY_INTERACTIVE):
+        # At least one token has to stay usable, or a bucket of capacity 1 would never serve background requests
+        reserve = min(self.capacity * RESERVED_FRACTION[priority], self.capacity - 1)
+        while True:
+            wait = float(token_bucket(keys=[self.key], args=[self.rate, self.capacity, reserve]))
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+coc_quota = UpstreamQuota(COC_UPSTREAM, Config.COC_API_REQUESTS_PER_SECOND, Config.COC_API_BURST)
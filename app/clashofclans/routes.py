@@ -1,23 +1,56 @@
-from collections import defaultdict
 import concurrent.futures
 from datetime import datetime, timedelta
+import json
+import math
+import re
 import sys
 from zoneinfo import ZoneInfo
 import concurrent
 from flask import jsonify, request, current_app
-import requests
-from sqlalchemy import and_, func, or_
+from sqlalchemy import func, or_, select, text, update
+from sqlalchemy.dialects.postgresql import insert
 from app.clashofclans import bp
-from app.extensions import db, limiter, get_real_ip
+from app.clashofclans.capital import capital_raid_seasons_page, decode_cursor
+from app.clashofclans.client import CocApiError, coc_client
+from app.clashofclans.cwl import fetch_cwl_wars, league_group_war_tags
+from app.clashofclans.fullclan import full_clan_data, full_clan_snapshot
+from app.clashofclans.ingestion import PlayerIngestion
+from app.clashofclans.quota import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from app.clashofclans.tracking import (due_activity_players, due_clans, over_quota, record_player_requests,
+                                       record_requests, requests_today, tracked_clan_tags)
+from app.clashofclans.view_counts import add_view, pending_views
+from app.extensions import db, limiter, get_real_ip, redis_client
+from app.scheduler import JobAlreadyRunning, run_job
 from config import Config
-from app.models.clashofclans import CocPlayerDataSchema, CocPlayerData, CocPlayer, CocPlayerSchema, CocPlayerWarHistory, CocPlayerWarHistorySchema
+from app.models.clashofclans import (CocPlayerDataSchema, CocPlayerData, CocPlayer, CocPlayerSchema,
+                                     CocUpgradeEvent, CocPlayerActivity, CocTrackedClan, SNAPSHOT_KEYFRAME_INTERVAL,
+                                     latest_player_snapshots, snapshot_values, find_upgrade_events, activity_heatmap,
+                                     clan_trends, war_stats_upsert)
 from dateutil import parser
 
-BASE_URL = "https://cocproxy.royaleapi.dev/v1"
-headers = {
-    "Authorization": f"Bearer {Config.COC_BEARER_TOKEN}",
+EXTRA_PLAYERS_COLLECTED_KEY = "coc:extra_players_collected"
+# Achievements whose values change when a player does something in game
+ACTIVITY_ACHIEVEMENTS = ["Nice and Tidy", "Gold Grab", "Elixir Escapade",
+                         "Heroic Heist", "Conqueror", "Friend in Need",
+                         "War Hero", "Clan War Wealth", "Games Champion",
+                         "War League Legend", "Well Seasoned"]
+# Player history fields that can be requested, by their camelCase response key
+HISTORY_COLUMNS = {
+    re.sub(r'_([a-z])', lambda x: x.group(1).upper(), c.name): c
+    for c in CocPlayerData.__table__.columns if c.name not in ("id", "timestamp")
 }
 
+def parse_date_range(default_start: timedelta, default_end: timedelta = timedelta(0)):
+    """
+    Parses the optional 'start' and 'end' ISO 8601 query parameters into UTC datetimes,
+    defaulting to now - default_start and now + default_end. Raises ValueError if either is invalid
+    """
+    now = datetime.now(ZoneInfo("UTC"))
+    start_date = request.args.get('start')
+    end_date = request.args.get('end')
+    start_date = parser.parse(start_date).astimezone(ZoneInfo("UTC")) if start_date else now - default_start
+    end_date = parser.parse(end_date).astimezone(ZoneInfo("UTC")) if end_date else now + default_end
+    return start_date, end_date
 
 @bp.route('set_player_data', methods=['POST'])
 @limiter.limit('4/minute', override_defaults=True)
@@ -32,175 +65,272 @@ def set_player_data():
     if post_body['password'] != Config.PARKING_POST_PASSWORD:
             return jsonify({"success": False, 'error': 'incorrect password'}), 400
 
+    try:
+        stats = run_job("coc_player_snapshots")
+    except JobAlreadyRunning:
+        return jsonify({"success": False, "error": "Player data is already being collected"}), 409
+    except CocApiError as e:
+        return jsonify({"success": False, "error": e.message}), e.status_code
+
+    return jsonify({"success": True, **stats}), 201
 
+def collect_player_snapshots():
+    '''
+    Collects the member snapshots of the tracked clans that are due in this tick. Scheduled as the coc_player_snapshots job
+    '''
+    totals = {"clans": 0, "players": 0, "fetched": 0, "fetch_failures": 0, "written": 0, "write_failures": 0}
+    clan_failures = 0
+
+    for clan in due_clans():
+        if over_quota(clan.tag):
+            continue
+        try:
+            stats = collect_clan_snapshots(clan.tag)
+        except CocApiError as e:
+            print(f"Unable to collect snapshots of {clan.tag}: {e.status_code} {e.message}", file=sys.stderr)
+            clan_failures += 1
+            continue
+        totals["clans"] += 1
+        for key in totals:
+            totals[key] += stats.get(key, 0)
+
+    # Players tracked outside of the tracked clans are collected on the same schedule
+    if Config.COC_EXTRA_TRACKED_PLAYERS and redis_client.set(EXTRA_PLAYERS_COLLECTED_KEY, 1, nx=True,
+                                                              ex=Config.COC_SNAPSHOT_INTERVAL_SECONDS):
+        extra_tags = [tag for (tag,) in db.session.query(CocPlayer.tag).filter(CocPlayer.tag.in_(Config.COC_EXTRA_TRACKED_PLAYERS))]
+        stats = PlayerIngestion("player_snapshots").run(extra_tags, store_player_snapshots)
+        for key in totals:
+            totals[key] += stats.get(key, 0)
+
+    return {**totals, "items": totals["written"], "failures": clan_failures + totals["fetch_failures"] + totals["write_failures"]}
+
+def collect_clan_snapshots(clan_tag):
+    '''
+    Syncs a clan's roster (clearing the clan of players that left) and stores a snapshot of each member
+    '''
     # Fetch clan data
-    clan_response = requests.get(f"{BASE_URL}/clans/%23220QP2GGU", headers=headers)
+    clan_response = coc_client.get(f"/clans/{clan_tag.replace('#', '%23')}", priority=PRIORITY_BACKGROUND)
+    record_requests(clan_tag, 1)
 
     if clan_response.status_code != 200:
-        return jsonify({"success": False, "error": clan_response.json().get("message")}), clan_response.status_code
+        raise CocApiError(clan_response.json().get("message"), clan_response.status_code)
 
     clan_data = clan_response.json()
 
-    for player in clan_data["memberList"]:
-        tag = player["tag"]
-        name = player["name"]
+    # Sync the roster in a single upsert
+    roster = [{
+        "tag": player["tag"],
+        "name": player["name"],
+        "clan_tag": clan_data["tag"],
+        "clan_name": clan_data["name"],
+        "view_count": 0,
+        "regular_wars": 0,
+        "cwl_wars": 0
+    } for player in clan_data["memberList"]]
+
+    if roster:
+        upsert = insert(CocPlayer).values(roster)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[CocPlayer.tag],
+            set_={
+                "name": upsert.excluded.name,
+                "clan_tag": upsert.excluded.clan_tag,
+                "clan_name": upsert.excluded.clan_name
+            }
+        )
+        db.session.execute(upsert)
+    # Players that left are no longer counted as the clan's members, their new clan is set when they are next fetched
+    db.session.execute(
+        update(CocPlayer)
+        .where(CocPlayer.clan_tag == clan_data["tag"], CocPlayer.tag.not_in([player["tag"] for player in roster]))
+        .values(clan_tag=None, clan_name=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.execute(
+        update(CocTrackedClan)
+        .where(CocTrackedClan.tag == clan_tag)
+        .values(name=clan_data["name"], last_collected_at=func.now())
+    )
+    db.session.commit()
 
-        existing_player = CocPlayer.query.get(tag)
+    # Only collect snapshots of current members, not every player ever seen
+    stats = PlayerIngestion(f"player_snapshots {clan_tag}").run([player["tag"] for player in roster], store_player_snapshots)
+    record_requests(clan_tag, stats["players"])
+    return stats
 
-        if existing_player:
-            if existing_player.name != name:
-                existing_player.name = name
+def store_player_snapshots(batch):
+    """
+    Persists a historical snapshot for each (tag, player json) and updates the player's clan.
+    Snapshots identical to the player's latest one are skipped unless it's older than the keyframe interval
+    """
+    schema = CocPlayerDataSchema()
+    timestamp = datetime.now(tz=ZoneInfo("UTC"))
+    latest = latest_player_snapshots([tag for tag, _ in batch])
+    snapshots = []
+    player_updates = []
+    upgrade_events = []
+
+    for tag, data in batch:
+        try:
+            player_data = schema.load(data)
+        except Exception as e:
+            print(f"Error processing {tag}: {str(e)}", file=sys.stderr)
+            continue
+        player_data.timestamp = timestamp
+
+        clan = data.get("clan") or {}
+        player_updates.append({"tag": tag, "clan_tag": clan.get("tag"), "clan_name": clan.get("name")})
+
+        previous = latest.get(tag)
+        if (previous is None
+                or timestamp - previous.timestamp >= SNAPSHOT_KEYFRAME_INTERVAL
+                or snapshot_values(previous) != snapshot_values(player_data)):
+            snapshots.append(player_data)
+            if previous is not None:
+                upgrade_events.extend(find_upgrade_events(previous, player_data, timestamp))
+
+    db.session.add_all(snapshots)
+    if player_updates:
+        db.session.execute(update(CocPlayer), player_updates)
+    if upgrade_events:
+        db.session.execute(insert(CocUpgradeEvent).values(upgrade_events).on_conflict_do_nothing())
+    db.session.commit()
+    return len(player_updates)
+
+@bp.route('update_player_activity', methods=['POST'])
+@limiter.limit('1/15seconds;4/minute', override_defaults=True)
+def update_player_activity():
+    try:
+        stats = run_job("coc_player_activity")
+    except JobAlreadyRunning:
+        return jsonify({"success": False, "error": "Player activity is already being updated"}), 409
+
+    return jsonify({"success": True, **stats}), 201
+
+def collect_player_activity():
+    '''
+    Updates the activity state of the players due in this tick. Scheduled as the coc_player_activity job
+    '''
+    players = due_activity_players()
+    stats = PlayerIngestion("player_activity").run(list(players), store_player_activity)
+    record_player_requests(players)
+    return {**stats, "items": stats["written"], "failures": stats["fetch_failures"] + stats["write_failures"]}
+
+def store_player_activity(batch):
+    """
+    Updates each player's clan and name from (tag, player json), and records when their activity state changed.
+    Every change is also logged to coc_player_activity for the activity heatmaps
+    """
+    players = {p.tag: p for p in CocPlayer.query.filter(CocPlayer.tag.in_([tag for tag, _ in batch])).all()}
+    now = datetime.now(ZoneInfo("UTC"))
+    updated = 0
+    activity = []
+
+    for tag, data in batch:
+        player = players.get(tag)
+        if not player:
+            continue
+
+        if data.get("clan"):
+            player.clan_tag = data["clan"]["tag"]
+            player.clan_name = data["clan"]["name"]
         else:
-            new_player = CocPlayer(tag=tag, name=name, clan_tag=clan_data["tag"], view_count=0)
-            db.session.add(new_player)
+            player.clan_tag = None
+            player.clan_name = None
+        player.name = data["name"]
+
+        # Build the new activity state
+        new_activity_state = {
+            "name": data.get("name"),
+            "builderBaseTrophies": data.get("builderBaseTrophies"),
+            "warPreference": data.get("warPreference"),
+            "clanCapitalContributions": data.get("clanCapitalContributions")
+        }
+
+        # Also do specific achievement changes that can indicate activity
+        achievement_values = {x["name"]: x.get("value") for x in data.get("achievements")}
+        for a in ACTIVITY_ACHIEVEMENTS:
+            new_activity_state[a] = achievement_values.get(a)
+        
+        # War preference will be null if player was kicked from the clan, which will be a false positive change from 'in' or 'out'
+        # Therefore if war preference is null, copy it from the previous value
+        if player.last_activity_state and not new_activity_state["warPreference"]:
+            new_activity_state["warPreference"] = player.last_activity_state["warPreference"]
+        
+        if new_activity_state != player.last_activity_state:
+            # Player made an action between the 2 states
+            if player.last_activity_state:
+                activity.append({"tag": tag, "timestamp": now})
+            player.activity_change_date = player.last_state_date
+            player.last_activity_state = new_activity_state
+        
+        player.last_state_date = now
+        updated += 1
 
-    # Commit after processing all players
+    if activity:
+        db.session.execute(insert(CocPlayerActivity).values(activity).on_conflict_do_nothing())
     db.session.commit()
+    return updated
 
-    all_players = CocPlayer.query.all()
 
+@bp.route('/tracked_clans', methods=['GET', 'POST'])
+@limiter.limit('20/minute', override_defaults=True)
+def tracked_clans():
+    '''
+    GET: the tracked clans with when they were last collected and their upstream requests today.
+    POST: starts tracking a clan (password, tag), its members are collected in one of the next collection ticks
+    '''
+    if request.method == 'GET':
+        clans = CocTrackedClan.query.order_by(CocTrackedClan.tag).all()
+        usage = requests_today([clan.tag for clan in clans])
+        return jsonify([{
+            "tag": clan.tag,
+            "name": clan.name,
+            "active": clan.active,
+            "added_at": clan.added_at.isoformat(),
+            "last_collected_at": clan.last_collected_at.isoformat() if clan.last_collected_at else None,
+            "requests_today": usage[clan.tag],
+            "daily_request_quota": Config.COC_CLAN_DAILY_REQUEST_QUOTA
+        } for clan in clans]), 200
 
-    # Get the current Flask app context
-    app = current_app._get_current_object()  # Extract actual app instance
+    post_body = request.json
+    if 'password' not in post_body:
+            return jsonify({"success": False, 'error': 'password not provided'}), 400
+    if post_body['password'] != Config.PARKING_POST_PASSWORD:
+            return jsonify({"success": False, 'error': 'incorrect password'}), 400
+    if not post_body.get('tag'):
+        return jsonify({"success": False, 'error': 'tag not provided'}), 400
 
-    def process_player(tag, app):
-        with app.app_context():  # Ensure Flask context is available
-            
-            # Create a new database session for this thread
-            session = db.sessionmaker(bind=db.engine)()
-
-            try:
-
-                url = f"{BASE_URL}/players/{tag.replace('#', '%23')}"
-                player_response = requests.get(url, headers=headers)
-
-                if player_response.status_code != 200:
-                    return None
-                
-                player = session.query(CocPlayer).get(tag)
-                if player_response.json().get("clan"):
-                    player.clan_tag = player_response.json()["clan"]["tag"]
-                    player.clan_name = player_response.json()["clan"]["name"]
-                else:
-                    player.clan_tag = None
-                    player.clan_name = None
-                    
-
-                data = player_response.json()
-                schema = CocPlayerDataSchema()
-                player_data = schema.load(data)
-                player_data.timestamp = datetime.now(tz=ZoneInfo("UTC"))
-
-                session.add(player_data)
-                session.commit()
-                return tag  # Return tag after processing
-            except Exception as e:
-                session.rollback()
-                print(f"Error processing {tag}: {str(e)}", file=sys.stderr)
-                return None
-            finally:
-                session.close()  # Ensure the session is closed properly
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
-        # Submit tasks for each player in parallel, passing the app instance
-        futures = [executor.submit(process_player, p.tag, app) for p in all_players]
-
-        # Wait for all futures to complete and handle the results
-        for future in concurrent.futures.as_completed(futures):
-            result = future.result()
-            if result is None:
-                print(f"Failed to commit data for a player.", file=sys.stderr)
-            else:
-                print(f"Successfully committed data for {result}", file=sys.stderr)
-
-    return jsonify({"success": True}), 201
+    clan_response = coc_client.get(f"/clans/{post_body['tag'].replace('#', '%23')}")
+    if clan_response.status_code != 200:
+        return jsonify({"success": False, "error": clan_response.json().get("message")}), clan_response.status_code
+    clan = clan_response.json()
 
-@bp.route('update_player_activity', methods=['POST'])
-@limiter.limit('1/15seconds;4/minute', override_defaults=True)
-def update_player_activity():
-    all_players = CocPlayer.query.all()
-    # Get the current Flask app context
-    app = current_app._get_current_object()  # Extract actual app instance
+    upsert = insert(CocTrackedClan).values(tag=clan["tag"], name=clan["name"], active=True)
+    upsert = upsert.on_conflict_do_update(index_elements=[CocTrackedClan.tag], set_={"name": upsert.excluded.name, "active": True})
+    db.session.execute(upsert)
+    db.session.commit()
 
-    def process_player(tag, app):
-        with app.app_context():  # Ensure Flask context is available
-            
-            # Create a new database session for this thread
-            session = db.sessionmaker(bind=db.engine)()
-
-            try:
-
-                url = f"{BASE_URL}/players/{tag.replace('#', '%23')}"
-                player_response = requests.get(url, headers=headers)
-
-                if player_response.status_code != 200:
-                    return None
-                
-                player = session.query(CocPlayer).get(tag)
-                if player_response.json().get("clan"):
-                    player.clan_tag = player_response.json()["clan"]["tag"]
-                    player.clan_name = player_response.json()["clan"]["name"]
-                else:
-                    player.clan_tag = None
-                    player.clan_name = None
-                player.name = player_response.json()["name"]
-
-                data = player_response.json()
-                
-                # Build the new activity state
-                new_activity_state = {
-                    "name": data.get("name"),
-                    "builderBaseTrophies": data.get("builderBaseTrophies"),
-                    "warPreference": data.get("warPreference"),
-                    "clanCapitalContributions": data.get("clanCapitalContributions")
-                }
-
-                # Also do specific achievement changes that can indicate activity
-                achievements = ["Nice and Tidy", "Gold Grab", "Elixir Escapade", 
-                                "Heroic Heist", "Conqueror", "Friend in Need", 
-                                "War Hero", "Clan War Wealth", "Games Champion",
-                                "War League Legend", "Well Seasoned" ]
-                
-                for a in achievements:
-                    value = next((x.get("value") for x in data.get("achievements") if x["name"] == a), None)
-                    new_activity_state[a] = value
-                
-                # War preference will be null if player was kicked from the clan, which will be a false positive change from 'in' or 'out'
-                # Therefore if war preference is null, copy it from the previous value
-                if player.last_activity_state and not new_activity_state["warPreference"]:
-                    new_activity_state["warPreference"] = player.last_activity_state["warPreference"]
-                
-                if new_activity_state != player.last_activity_state:
-                    # Player made an action between the 2 states
-                    player.activity_change_date = player.last_state_date
-                    player.last_activity_state = new_activity_state
-                
-                player.last_state_date = datetime.now(ZoneInfo("UTC"))
-                
-                session.commit()
-                return tag  # Return tag after processing
-            except Exception as e:
-                session.rollback()
-                print(f"Error processing {tag}: {str(e)}", file=sys.stderr)
-                return None
-            finally:
-                session.close()  # Ensure the session is closed properly
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=6) as executor:
-        # Submit tasks for each player in parallel, passing the app instance
-        futures = [executor.submit(process_player, p.tag, app) for p in all_players]
-
-        # Wait for all futures to complete and handle the results
-        for future in concurrent.futures.as_completed(futures):
-            result = future.result()
-            if result is None:
-                print(f"Failed to commit data for a player.", file=sys.stderr)
-            else:
-                pass
-                # print(f"Successfully committed data for {result}", file=sys.stderr)
-
-    return jsonify({"success": True}), 201
+    return jsonify({"success": True, "tag": clan["tag"], "name": clan["name"]}), 201
+
+@bp.route('/tracked_clans/<string:tag>', methods=['DELETE'])
+@limiter.limit('20/minute', override_defaults=True)
+def untrack_clan(tag):
+    '''
+    Stops collecting a clan, its stored data is kept
+    '''
+    post_body = request.json
+    if 'password' not in post_body:
+            return jsonify({"success": False, 'error': 'password not provided'}), 400
+    if post_body['password'] != Config.PARKING_POST_PASSWORD:
+            return jsonify({"success": False, 'error': 'incorrect password'}), 400
 
+    clan = db.session.get(CocTrackedClan, tag)
+    if clan is None:
+        return jsonify({"success": False, "error": "Clan is not tracked"}), 404
+    clan.active = False
+    db.session.commit()
+    return jsonify({"success": True}), 200
 
 @bp.route('/player_data/<string:tag>', methods=['GET'])
 @limiter.limit('30/minute', override_defaults=True)
@@ -209,65 +339,308 @@ def get_player_data(tag):
     Retrieve player data by tag.
     Optionally filter by start and end with timezone support.
     If no dates are provided, fetch records from one year ago until now.
+
+    Optional parameters to keep responses small:
+    - fields: comma separated history fields to return, e.g. fields=trophies,warStars (timestamp is always included)
+    - bucket (e.g. '6 hours', '1 day', '1 week') or max_points: downsample to the last snapshot in each time bucket
+    - limit and after: page through the history, pass the returned next_cursor as after to get the next page
     '''
     
     try:
-        start_date = request.args.get('start')
-        end_date = request.args.get('end')
-
-        if start_date:
-            start_date = parser.parse(start_date)
-        else:
-            start_date = datetime.now(ZoneInfo("UTC")) - timedelta(days=365)  # Default: 1 year ago (UTC)
-
-        if end_date:
-            end_date = parser.parse(end_date)  # Parses timezone if provided
-        else:
-            end_date = datetime.now(ZoneInfo("UTC"))  # Default: now (UTC)
-
+        start_date, end_date = parse_date_range(timedelta(days=365)) # Default: 1 year ago (UTC)
     except ValueError:
         return jsonify({"error": "Invalid datetime format. Use ISO 8601 (YYYY-MM-DDTHH:MM:SS±HH:MM)"}), 400
-    
+
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()] or list(HISTORY_COLUMNS)
+    unknown_fields = [f for f in fields if f not in HISTORY_COLUMNS]
+    if unknown_fields:
+        return jsonify({"error": f"Unknown fields: {', '.join(unknown_fields)}"}), 400
+    columns = [HISTORY_COLUMNS[f].label(f) for f in fields]
+
+    bucket = None
+    if request.args.get('bucket'):
+        match = re.fullmatch(r"(\d+)\s*(minute|hour|day|week)s?", request.args.get('bucket').strip())
+        if not match or int(match.group(1)) < 1:
+            return jsonify({"error": "bucket must look like '30 minutes', '6 hours', '1 day' or '1 week'"}), 400
+        bucket = timedelta(**{f"{match.group(2)}s": int(match.group(1))})
+    elif request.args.get('max_points'):
+        max_points = request.args.get('max_points', type=int)
+        if not max_points or max_points < 1:
+            return jsonify({"error": "max_points must be a positive integer"}), 400
+        bucket = max(timedelta(seconds=math.ceil((end_date - start_date).total_seconds() / max_points)), timedelta(minutes=1))
+
+    limit = request.args.get('limit', type=int)
+    if 'limit' in request.args and (limit is None or limit < 1):
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    try:
+        after = parser.parse(request.args.get('after')).astimezone(ZoneInfo("UTC")) if request.args.get('after') else None
+    except ValueError:
+        return jsonify({"error": "Invalid after cursor"}), 400
+
     player = CocPlayer.query.get(tag)
 
     # Check if player exists in the DB
     if not player:
         return jsonify({"error": f"No data exists for player {tag}"}), 404
 
-    # Query the database
-    player_data = CocPlayerData.query.filter(
-        and_(
+    timestamp = CocPlayerData.timestamp
+    query = select().where(
+        CocPlayerData.tag == tag,
+        timestamp >= start_date,
+        timestamp <= end_date
+    )
+    if bucket:
+        # Downsample in SQL, keeping the last value of each field in every bucket
+        time_col = func.time_bucket(bucket, timestamp)
+        query = query.add_columns(time_col.label("timestamp"),
+                                  *[func.last(HISTORY_COLUMNS[f], timestamp).label(f) for f in fields])
+        query = query.group_by(time_col).order_by(time_col.asc())
+        if after:
+            query = query.where(timestamp >= after + bucket)
+    else:
+        query = query.add_columns(timestamp.label("timestamp"), *columns).order_by(timestamp.asc())
+        if after:
+            query = query.where(timestamp > after)
+    if limit:
+        query = query.limit(limit + 1)
+
+    rows = db.session.execute(query).mappings().all()
+
+    next_cursor = None
+    if limit and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]["timestamp"].isoformat()
+
+    history = [{**row, "timestamp": row["timestamp"].isoformat()} for row in rows]
+
+    # Snapshots are only stored on change, so the state at the start of the range is the latest snapshot before it
+    if not after:
+        anchor = db.session.execute(select(*columns).where(
             CocPlayerData.tag == tag,
-            CocPlayerData.timestamp >= start_date.astimezone(ZoneInfo("UTC")),
-            CocPlayerData.timestamp <= end_date.astimezone(ZoneInfo("UTC"))
-        )
-    ).order_by(CocPlayerData.timestamp.asc()).all()
-    print(player.activity_change_date, file=sys.stderr)
-    # Serialize results
-    data_schema = CocPlayerDataSchema(many=True)
+            timestamp < start_date
+        ).order_by(timestamp.desc()).limit(1)).mappings().first()
+        if anchor:
+            history.insert(0, {**anchor, "timestamp": start_date.isoformat()})
+
     player_schema = CocPlayerSchema()
 
-    return jsonify({**player_schema.dump(player), "history": data_schema.dump(player_data)}), 200
+    return jsonify({**player_schema.dump(player), "history": history, "next_cursor": next_cursor}), 200
+
+@bp.route('/players/<string:tag>/upgrades', methods=['GET'])
+@limiter.limit('30/minute', override_defaults=True)
+def get_player_upgrades(tag):
+    """
+    Progression timeline of a player, e.g. when each Archer Queen level was reached.
+    Optionally filter by category (troop, hero, spell, hero_equipment, town_hall, town_hall_weapon, builder_hall),
+    item name, village (home, builderBase) and start/end (default all time)
+    """
+    try:
+        start_date, end_date = parse_date_range(timedelta(days=365 * 20))
+    except ValueError:
+        return jsonify({"error": "Invalid datetime format. Use ISO 8601 (YYYY-MM-DDTHH:MM:SS±HH:MM)"}), 400
+
+    query = CocUpgradeEvent.query.filter(
+        CocUpgradeEvent.tag == tag,
+        CocUpgradeEvent.timestamp >= start_date,
+        CocUpgradeEvent.timestamp <= end_date
+    )
+    if request.args.get('category'):
+        query = query.filter(CocUpgradeEvent.category == request.args.get('category'))
+    if request.args.get('name'):
+        query = query.filter(CocUpgradeEvent.name == request.args.get('name'))
+    if request.args.get('village'):
+        query = query.filter(CocUpgradeEvent.village == request.args.get('village'))
+
+    events = query.order_by(CocUpgradeEvent.timestamp.asc()).all()
+
+    return jsonify([{
+        "timestamp": e.timestamp.isoformat(),
+        "category": e.category,
+        "name": e.name,
+        "village": e.village,
+        "old_level": e.old_level,
+        "new_level": e.new_level
+    } for e in events]), 200
+
+@bp.route('/clan/<string:clan_tag>/upgrades', methods=['GET'])
+@limiter.limit('30/minute', override_defaults=True)
+def get_clan_upgrades(clan_tag):
+    """
+    Feed of upgrades made by current members of a clan, newest first.
+    Optionally filter by category, item name, village, start/end (default past 30 days) and limit (default 100, max 500)
+    """
+    try:
+        start_date, end_date = parse_date_range(timedelta(days=30))
+    except ValueError:
+        return jsonify({"error": "Invalid datetime format. Use ISO 8601 (YYYY-MM-DDTHH:MM:SS±HH:MM)"}), 400
+
+    limit = request.args.get('limit', default=100, type=int)
+    if limit is None or limit < 1 or limit > 500:
+        return jsonify({"success": False, "error": "limit must be an integer between 1-500"}), 400
+
+    query = db.session.query(CocUpgradeEvent, CocPlayer.name).join(CocPlayer).filter(
+        CocPlayer.clan_tag == clan_tag,
+        CocUpgradeEvent.timestamp >= start_date,
+        CocUpgradeEvent.timestamp <= end_date
+    )
+    if request.args.get('category'):
+        query = query.filter(CocUpgradeEvent.category == request.args.get('category'))
+    if request.args.get('name'):
+        query = query.filter(CocUpgradeEvent.name == request.args.get('name'))
+    if request.args.get('village'):
+        query = query.filter(CocUpgradeEvent.village == request.args.get('village'))
+
+    events = query.order_by(CocUpgradeEvent.timestamp.desc()).limit(limit).all()
+
+    return jsonify([{
+        "tag": e.tag,
+        "player_name": player_name,
+        "timestamp": e.timestamp.isoformat(),
+        "category": e.category,
+        "name": e.name,
+        "village": e.village,
+        "old_level": e.old_level,
+        "new_level": e.new_level
+    } for e, player_name in events]), 200
+
+def heatmap_params():
+    """
+    Parses the optional 'tz' (IANA timezone, default UTC) and 'weeks' (1-52, default 12) heatmap parameters.
+    Raises ValueError if either is invalid
+    """
+    timezone = request.args.get('tz', 'UTC')
+    try:
+        ZoneInfo(timezone)
+    except Exception:
+        raise ValueError(f"Unknown timezone '{timezone}'")
+
+    weeks = request.args.get('weeks', default=12, type=int)
+    if weeks is None or weeks < 1 or weeks > 52:
+        raise ValueError("weeks must be an integer between 1-52")
+
+    return timezone, weeks
+
+@bp.route('/players/<string:tag>/activity_heatmap', methods=['GET'])
+@limiter.limit('20/minute', override_defaults=True)
+def get_player_activity_heatmap(tag):
+    """
+    When a player is active, as the number of activity changes by day of week (Monday first) and hour over the last 'weeks'
+    """
+    try:
+        timezone, weeks = heatmap_params()
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    since = datetime.now(ZoneInfo("UTC")) - timedelta(weeks=weeks)
+    heatmap = activity_heatmap(timezone, since, tag=tag)
+    return jsonify({"tag": tag, "timezone": timezone, "weeks": weeks, "heatmap": heatmap}), 200
+
+@bp.route('/clan/<string:clan_tag>/activity_heatmap', methods=['GET'])
+@limiter.limit('20/minute', override_defaults=True)
+def get_clan_activity_heatmap(clan_tag):
+    """
+    When a clan's current members are active, as the number of activity changes by day of week (Monday first)
+    and hour over the last 'weeks'
+    """
+    try:
+        timezone, weeks = heatmap_params()
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    since = datetime.now(ZoneInfo("UTC")) - timedelta(weeks=weeks)
+    heatmap = activity_heatmap(timezone, since, clan_tag=clan_tag)
+    return jsonify({"clan_tag": clan_tag, "timezone": timezone, "weeks": weeks, "heatmap": heatmap}), 200
+
+# Trend bucket sizes that can be requested
+TREND_INTERVALS = {"day": "1 day", "week": "1 week"}
+
+@bp.route('/clan/<string:clan_tag>/trends', methods=['GET'])
+@limiter.limit('20/minute', override_defaults=True)
+def get_clan_trends(clan_tag):
+    """
+    Trophies, war stars gained, donations and capital contributions of a clan's current members,
+    per 'interval' (day or week, default day) between start/end (default past 90 days).
+    Each member's own series is included with members=true
+    """
+    clan_tag = clan_tag.replace("%23", "#")
+    try:
+        start_date, end_date = parse_date_range(timedelta(days=90))
+    except ValueError:
+        return jsonify({"error": "Invalid datetime format. Use ISO 8601 (YYYY-MM-DDTHH:MM:SS±HH:MM)"}), 400
+
+    interval = request.args.get('interval', 'day')
+    if interval not in TREND_INTERVALS:
+        return jsonify({"success": False, "error": f"interval must be one of {', '.join(TREND_INTERVALS)}"}), 400
+    members = request.args.get('members', 'false').lower() == 'true'
+
+    series, member_series = clan_trends(clan_tag, start_date, end_date, TREND_INTERVALS[interval], members)
+    response = {"clan_tag": clan_tag, "interval": interval, "start": start_date.isoformat(),
+                "end": end_date.isoformat(), "series": series}
+    if members:
+        response["members"] = member_series
+    return jsonify(response), 200
 
 @bp.route('/player_data/increment_view_count/<string:tag>', methods=['PATCH'])
 @limiter.limit('1/5minute;20/day', key_func=lambda: f"{get_real_ip()}:{request.view_args.get('tag', 'UNKNOWN')}", override_defaults=True)
 def increment_view_count(tag):
-    player = CocPlayer.query.get(tag)
-    
-    if player:
-        player.view_count += 1
-        db.session.commit()
-        
-        return jsonify({"success": True}), 200
-    else:
+    """
+    Counts a profile view. Views are buffered in Redis and periodically added to the player's view_count
+    """
+    if db.session.query(CocPlayer.tag).filter_by(tag=tag).first() is None:
         return jsonify({"success": False, "error": "Player not found"}), 404
 
+    add_view(tag)
+    return jsonify({"success": True}), 200
+
 @bp.route('/players', methods=['GET'])
 @limiter.limit('40/minute', override_defaults=True)
 def get_players():
-    players = CocPlayer.query.all()
-    schema = CocPlayerSchema(many=True)
-    return jsonify(schema.dump(players)), 200
+    players = CocPlayerSchema(many=True).dump(CocPlayer.query.all())
+
+    # Include views that haven't been flushed yet
+    views = pending_views()
+    for player in players:
+        player["view_count"] += views.get(player["tag"], 0)
+
+    return jsonify(players), 200
+
+@bp.route('/players/search', methods=['GET'])
+@limiter.limit('60/minute', override_defaults=True)
+def search_players():
+    """
+    Fuzzy, accent insensitive player name search for autocomplete.
+    Returns the top 'limit' (default 10, max 50) matches for 'q', names starting with q first then by similarity.
+    Optionally restrict to a clan with 'clan_tag'
+    """
+    search = request.args.get('q', '').strip()
+    if not search:
+        return jsonify({"success": False, "error": "'q' must be provided"}), 400
+
+    limit = request.args.get('limit', default=10, type=int)
+    if limit is None or limit < 1 or limit > 50:
+        return jsonify({"success": False, "error": "limit must be an integer between 1-50"}), 400
+
+    clan_tag = request.args.get('clan_tag')
+    # Escape LIKE wildcards in the search term
+    pattern = re.sub(r"([%_\\])", r"\\\1", search)
+
+    query = text(f"""
+        SELECT tag, name, clan_tag, clan_name,
+            similarity(immutable_unaccent(lower(name)), immutable_unaccent(lower(:search))) AS similarity
+        FROM coc_player
+        WHERE (immutable_unaccent(lower(name)) % immutable_unaccent(lower(:search))
+            OR immutable_unaccent(lower(name)) LIKE '%' || immutable_unaccent(lower(:pattern)) || '%')
+            {"AND clan_tag = :clan_tag" if clan_tag else ""}
+        ORDER BY
+            immutable_unaccent(lower(name)) LIKE immutable_unaccent(lower(:pattern)) || '%' DESC,
+            similarity DESC,
+            name
+        LIMIT :limit
+    """)
+
+    rows = db.session.execute(query, {"search": search, "pattern": pattern, "clan_tag": clan_tag, "limit": limit}).mappings()
+
+    return jsonify([{**row, "similarity": round(row["similarity"], 3)} for row in rows]), 200
 
 @bp.route('/players/<string:tag>', methods=['GET'])
 @limiter.limit('40/minute', override_defaults=True)
@@ -277,8 +650,9 @@ def get_player_by_tag(tag):
     if player is None:
         return jsonify({"error": "Player not found"}), 404
 
-    schema = CocPlayerSchema()
-    return jsonify(schema.dump(player)), 200
+    player = CocPlayerSchema().dump(player)
+    player["view_count"] += pending_views([tag]).get(tag, 0)
+    return jsonify(player), 200
 
 @bp.route('/players/<string:tag>/profile', methods=['GET'])
 @limiter.limit('15/minute', override_defaults=True)
@@ -287,7 +661,7 @@ def get_player_profile(tag):
     Retrieves a player's ingame data
     """
     tag = tag.replace("#", "%23")
-    player_response = requests.get(f"{BASE_URL}/players/{tag}", headers=headers)
+    player_response = coc_client.get(f"/players/{tag}")
 
     if player_response.status_code != 200:
         return jsonify({"success": False, "error": player_response.json().get("message")}), player_response.status_code
@@ -298,7 +672,7 @@ def get_player_profile(tag):
 @bp.route('/goldpass', methods=['GET'])
 @limiter.limit('40/minute', override_defaults=True)
 def gold_pass():
-    gold_response = requests.get(f"{BASE_URL}/goldpass/seasons/current", headers=headers)
+    gold_response = coc_client.get("/goldpass/seasons/current")
 
     if gold_response.status_code != 200:
         return jsonify({"success": False, "error": gold_response.json().get("message")}), gold_response.status_code
@@ -312,7 +686,7 @@ def get_current_regular_war(tag):
     Retrieves information about a clan's current war
     """
     tag = tag.replace("#", "%23")
-    war_response = requests.get(f"{BASE_URL}/clans/{tag}/currentwar", headers=headers)
+    war_response = coc_client.get(f"/clans/{tag}/currentwar")
 
     if war_response.status_code != 200:
         return jsonify({"success": False, "error": war_response.json().get("message")}), war_response.status_code
@@ -326,74 +700,54 @@ def get_current_CWL_war(war_tag):
     Retrieves information about a CWL war
     """
     war_tag = war_tag.replace("#", "%23")
-    war_response = requests.get(f"{BASE_URL}/clanwarleagues/wars/{war_tag}", headers=headers)
+    war_response = coc_client.get(f"/clanwarleagues/wars/{war_tag}")
 
     if war_response.status_code != 200:
         return jsonify({"success": False, "error": war_response.json().get("message")}), war_response.status_code
 
     return jsonify(war_response.json()), 200
 
-def current_active_war(tag):
+def current_active_war(tag, priority=PRIORITY_INTERACTIVE):
     """
     Retrieves the current active war of the clan, whether it is a regular or CWL war.
     This will take longer to run because it goes through all CWL wars if they exist
     Return value: war_data, error_message, status_code
     """
     tag = tag.replace("#", "%23")
-    war_url = f"{BASE_URL}/clans/{tag}/currentwar"
-    leaguegroup_url = f"{BASE_URL}/clans/{tag}/currentwar/leaguegroup"
+    war_url = f"/clans/{tag}/currentwar"
+    leaguegroup_url = f"/clans/{tag}/currentwar/leaguegroup"
 
     def fetch(url):
-        return requests.get(url, headers=headers)
+        return coc_client.get(url, priority=priority)
 
     with concurrent.futures.ThreadPoolExecutor() as executor:
         futures = [executor.submit(fetch, url) for url in [war_url, leaguegroup_url]]
         war_response, leaguegroup_response = [f.result() for f in futures]
 
-    leaguegroup_response = requests.get(leaguegroup_url, headers=headers)
     if not leaguegroup_response.ok and leaguegroup_response.status_code != 404:
         return None, leaguegroup_response.json().get("message"), leaguegroup_response.status_code
     if not war_response.ok and war_response.status_code != 403:
         return None, war_response.json().get("message"), war_response.status_code
     
-    def fetchCWLWar(url, war_tag):
-        response = requests.get(url, headers=headers)
-        if response.ok:
-            data = response.json()
-            data["war_tag"] = war_tag
-            return data
-        else:
-            return None
-    
     if leaguegroup_response.ok:
         leaguegroup_data = leaguegroup_response.json()
-        cwl_war_tags = []
-        for r in leaguegroup_data.get("rounds"):
-            for war_tag in r.get("warTags"):
-                if war_tag != "#0":
-                    cwl_war_tags.append(war_tag.replace("#", "%23"))
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(fetchCWLWar, f"{BASE_URL}/clanwarleagues/wars/{war_tag}", war_tag) for war_tag in cwl_war_tags]
-            cwl_wars = [f.result() for f in futures 
-                                 if f.result()]
-            tag = tag.replace("%23", "#")
+        cwl_wars = fetch_cwl_wars(league_group_war_tags(leaguegroup_data), priority)
+        tag = tag.replace("%23", "#")
+        
+        # Loop through and find the current active war (if no active then get preparation or ended war)
+        active_war = None
+        for war in cwl_wars:
+            # If we are the opponent, swap oponent and clan
+            if war.get("opponent").get("tag") == tag:
+                war["clan"], war["opponent"] = war["opponent"], war["clan"]
             
-            # Loop through and find the current active war (if no active then get preparation or ended war)
-            active_war = None
-            for war in cwl_wars:
-                war_tag = war.get("war_tag").replace("%23","#")
-
-                # If we are the opponent, swap oponent and clan
-                if war.get("opponent").get("tag") == tag:
-                    war["clan"], war["opponent"] = war["opponent"], war["clan"]
-                
-                if war["clan"].get("tag") == tag and war.get("state") == "inWar":
-                    active_war = war
-                # Preparation war is last priority if there's no ongoing wars (1st CWL war hasn't started yet)
-                if war["clan"].get("tag") == tag and war.get("state") in ["preparation", "warEnded"] and not active_war:
-                    active_war = war
-            active_war["isCwl"] = True
-            return active_war, None, 200
+            if war["clan"].get("tag") == tag and war.get("state") == "inWar":
+                active_war = war
+            # Preparation war is last priority if there's no ongoing wars (1st CWL war hasn't started yet)
+            if war["clan"].get("tag") == tag and war.get("state") in ["preparation", "warEnded"] and not active_war:
+                active_war = war
+        active_war["isCwl"] = True
+        return active_war, None, 200
     
     # Return the regular war
     if war_response.ok:
@@ -450,53 +804,173 @@ def get_war_attack_history(clan_tag):
     except ValueError:
         return jsonify({"error": "Invalid datetime format. Use ISO 8601 (YYYY-MM-DDTHH:MM:SS±HH:MM)"}), 400
     
-    query = CocPlayerWarHistory.query.join(CocPlayer).filter(
-        CocPlayer.clan_tag == clan_tag,
-        CocPlayerWarHistory.preparation_start_timestamp >= start_date,
-        CocPlayerWarHistory.preparation_start_timestamp <= end_date
-    )
+    params = {"clan_tag": clan_tag, "start_date": start_date, "end_date": end_date}
 
     # Filter by player tags or names
-    if player_tags or player_names:
-        player_filters = []
-        if player_tags:
-            player_filters.append(CocPlayer.tag.in_(player_tags))
-        for name in player_names:
-            search_term_processed = name # Only lowercase the search term
-            player_name_processed = func.unaccent(func.lower(CocPlayer.name)) # Only lowercase the database column
-            player_filters.append(player_name_processed.ilike(f"%{search_term_processed}%"))
-        query = query.filter(or_(*player_filters))
-
-    # Order by latest date (war_end_timestamp) and then attack_order
-    query = query.order_by(
-        CocPlayerWarHistory.war_end_timestamp.desc(),
-        CocPlayerWarHistory.attack_order.desc()
-    )
-
-    war_history_records = query.all()
-    schema = CocPlayerWarHistorySchema()
-
-    # Group by each player
-    player_war_history = defaultdict(list)
-
-    for attack in war_history_records:
-        player_tag = attack.tag
-        player_name = attack.player.name
-        regular_war_count = attack.player.regular_wars
-        cwl_war_count = attack.player.cwl_wars
-
-        player_war_history[(player_tag, player_name, regular_war_count, cwl_war_count)].append(schema.dump(attack))
-    
-    final_response = [{
-        "tag": tag,
-        "name": name,
-        "all_time_regular_wars": regular_wars,
-        "all_time_cwl_wars": cwl_wars,
-        "attacks": attacks
-    } for (tag, name, regular_wars, cwl_wars), attacks in player_war_history.items()]
+    player_filters = []
+    if player_tags:
+        player_filters.append("p.tag = ANY(:player_tags)")
+        params["player_tags"] = player_tags
+    for i, name in enumerate(player_names):
+        # Only lowercase the database column, ILIKE handles the search term's case.
+        # Matches the expression of the trigram index on coc_player.name
+        player_filters.append(f"immutable_unaccent(lower(p.name)) ILIKE :player_name_{i}")
+        params[f"player_name_{i}"] = f"%{name}%"
+    player_filter = f"AND ({' OR '.join(player_filters)})" if player_filters else ""
+
+    # Group and serialise in Postgres, players ordered by their latest attack (war_end_timestamp then attack_order)
+    query = text(f"""
+        SELECT COALESCE(json_agg(json_build_object(
+            'tag', tag,
+            'name', name,
+            'all_time_regular_wars', regular_wars,
+            'all_time_cwl_wars', cwl_wars,
+            'attacks', attacks
+        ) ORDER BY latest_war_end DESC, latest_attack_order DESC), '[]')::text
+        FROM (
+            SELECT
+                p.tag, p.name, p.regular_wars, p.cwl_wars,
+                json_agg(json_build_object(
+                    'id', w.id,
+                    'war_end_timestamp', w.war_end_timestamp,
+                    'preparation_start_timestamp', w.preparation_start_timestamp,
+                    'start_timestamp', w.start_timestamp,
+                    'attack_order', w.attack_order,
+                    'tag', w.tag,
+                    'attacker_townhall', w.attacker_townhall,
+                    'map_position', w.map_position,
+                    'defender_townhall', w.defender_townhall,
+                    'defender_tag', w.defender_tag,
+                    'defender_map_position', w.defender_map_position,
+                    'destruction_percentage', w.destruction_percentage,
+                    'duration', w.duration,
+                    'stars', w.stars,
+                    'is_cwl', w.is_cwl
+                ) ORDER BY w.war_end_timestamp DESC, w.attack_order DESC) AS attacks,
+                MAX(w.war_end_timestamp) AS latest_war_end,
+                (array_agg(w.attack_order ORDER BY w.war_end_timestamp DESC, w.attack_order DESC))[1] AS latest_attack_order
+            FROM coc_player_war_history w
+            JOIN coc_player p ON p.tag = w.tag
+            WHERE p.clan_tag = :clan_tag
+                AND w.preparation_start_timestamp >= :start_date
+                AND w.preparation_start_timestamp <= :end_date
+                {player_filter}
+            GROUP BY p.tag
+        ) players
+    """)
+
+    body = db.session.execute(query, params).scalar()
+
+    return current_app.response_class(body, mimetype="application/json")
+
+
+def _war_type_stats(prefix: str, condition: str = "TRUE") -> str:
+    """
+    Attacks, average stars and triple rate of the coc_player_war_stats rows matching condition, as a JSON object
+    """
+    attacks = f"SUM(s.{prefix}attacks) FILTER (WHERE {condition})"
+    return f"""json_build_object(
+        'attacks', COALESCE({attacks}, 0),
+        'average_stars', ROUND(SUM(s.{prefix}stars) FILTER (WHERE {condition}) / NULLIF({attacks}, 0)::NUMERIC, 2),
+        'triple_rate', ROUND(SUM(s.{prefix}triples) FILTER (WHERE {condition}) / NULLIF({attacks}, 0)::NUMERIC, 3)
+    )"""
+
+# Leaderboard orderings by name, over the per player sums of coc_player_war_stats
+WAR_LEADERBOARD_SORTS = {
+    "attacks": "SUM(s.attacks)",
+    "average_stars": "SUM(s.stars)::NUMERIC / SUM(s.attacks)",
+    "average_destruction": "SUM(s.destruction)::NUMERIC / SUM(s.attacks)",
+    "average_duration": "SUM(s.duration)::NUMERIC / SUM(s.attacks)",
+    "triple_rate": "SUM(s.triples)::NUMERIC / SUM(s.attacks)",
+    "same_townhall_triple_rate": "SUM(s.same_townhall_triples)::NUMERIC / NULLIF(SUM(s.same_townhall_attacks), 0)",
+    "higher_townhall_triple_rate": "SUM(s.higher_townhall_triples)::NUMERIC / NULLIF(SUM(s.higher_townhall_attacks), 0)",
+}
+WAR_TYPES = {"all": "TRUE", "regular": "NOT s.is_cwl", "cwl": "s.is_cwl"}
 
-    return jsonify(final_response), 200
+@bp.route('/clan/<string:clan_tag>/war_leaderboard', methods=['GET'])
+@limiter.limit('20/minute', override_defaults=True)
+def get_war_leaderboard(clan_tag):
+    """
+    War performance of a clan's current members between start/end (default past 90 days), by the day of each war's
+    preparation start. Filter by war_type (all, regular or cwl), comma separated player_tags or player_names and
+    min_attacks (default 1, 0 also lists members without attacks, with null averages).
+    Ordered by sort (default average_stars) and order (asc or desc, default desc), limit 1-100
+    """
+    clan_tag = clan_tag.replace("%23", "#")
+    try:
+        start_date, end_date = parse_date_range(timedelta(days=90), timedelta(days=2))
+    except ValueError:
+        return jsonify({"error": "Invalid datetime format. Use ISO 8601 (YYYY-MM-DDTHH:MM:SS±HH:MM)"}), 400
 
+    sort = request.args.get("sort", "average_stars")
+    if sort not in WAR_LEADERBOARD_SORTS:
+        return jsonify({"success": False, "error": f"sort must be one of {', '.join(WAR_LEADERBOARD_SORTS)}"}), 400
+    order = request.args.get("order", "desc").lower()
+    if order not in ("asc", "desc"):
+        return jsonify({"success": False, "error": "order must be asc or desc"}), 400
+    war_type = request.args.get("war_type", "all")
+    if war_type not in WAR_TYPES:
+        return jsonify({"success": False, "error": f"war_type must be one of {', '.join(WAR_TYPES)}"}), 400
+    limit = request.args.get("limit", default=50, type=int)
+    if limit is None or limit < 1 or limit > 100:
+        return jsonify({"success": False, "error": "limit must be an integer between 1-100"}), 400
+    min_attacks = request.args.get("min_attacks", default=1, type=int)
+    if min_attacks is None or min_attacks < 0:
+        return jsonify({"success": False, "error": "min_attacks must be a non-negative integer"}), 400
+
+    params = {"clan_tag": clan_tag, "start_date": start_date.date(), "end_date": end_date.date(),
+              "min_attacks": min_attacks, "limit": limit}
+
+    player_tags = [tag.strip() for tag in request.args.get("player_tags", "").split(",") if tag.strip()]
+    player_names = [name.strip() for name in request.args.get("player_names", "").split(",") if name.strip()]
+    player_filters = []
+    if player_tags:
+        player_filters.append("p.tag = ANY(:player_tags)")
+        params["player_tags"] = player_tags
+    for i, name in enumerate(player_names):
+        # Accent insensitive like the player search, matching the expression of the trigram index on coc_player.name
+        player_filters.append(
+            f"immutable_unaccent(lower(p.name)) LIKE '%' || immutable_unaccent(lower(:player_name_{i})) || '%'")
+        params[f"player_name_{i}"] = re.sub(r"([%_\\])", r"\\\1", name)
+    player_filter = f"AND ({' OR '.join(player_filters)})" if player_filters else ""
+
+    ordering = f"{WAR_LEADERBOARD_SORTS[sort]} {order} NULLS LAST, COALESCE(SUM(s.attacks), 0) DESC, p.name"
+    query = text(f"""
+        SELECT COALESCE(json_agg(players ORDER BY players.rank), '[]')::text
+        FROM (
+            SELECT
+                ROW_NUMBER() OVER (ORDER BY {ordering}) AS rank,
+                p.tag,
+                p.name,
+                COALESCE(SUM(s.attacks), 0) AS attacks,
+                ROUND(SUM(s.stars)::NUMERIC / SUM(s.attacks), 2) AS average_stars,
+                ROUND(SUM(s.destruction)::NUMERIC / SUM(s.attacks), 2) AS average_destruction,
+                ROUND(SUM(s.duration)::NUMERIC / SUM(s.attacks), 1) AS average_duration,
+                ROUND(SUM(s.triples)::NUMERIC / SUM(s.attacks), 3) AS triple_rate,
+                ROUND(SUM(s.map_position_offset)::NUMERIC / SUM(s.attacks), 2) AS average_opponent_offset,
+                ROUND(SUM(s.townhall_offset)::NUMERIC / SUM(s.attacks), 2) AS average_townhall_offset,
+                {_war_type_stats("same_townhall_")} AS same_townhall,
+                {_war_type_stats("higher_townhall_")} AS higher_townhall,
+                {_war_type_stats("", "NOT s.is_cwl")} AS regular,
+                {_war_type_stats("", "s.is_cwl")} AS cwl
+            FROM coc_player p
+            -- Left joined so min_attacks=0 also lists members without attacks
+            LEFT JOIN coc_player_war_stats s ON s.tag = p.tag
+                AND s.day >= :start_date
+                AND s.day <= :end_date
+                AND {WAR_TYPES[war_type]}
+            WHERE p.clan_tag = :clan_tag
+                {player_filter}
+            GROUP BY p.tag
+            HAVING COALESCE(SUM(s.attacks), 0) >= :min_attacks
+            ORDER BY rank
+            LIMIT :limit
+        ) players
+    """)
+
+    body = db.session.execute(query, params).scalar()
+
+    return current_app.response_class(body, mimetype="application/json")
 
 @bp.route('/clan/<string:tag>/update_war_history', methods=['POST'])
 @limiter.limit('5/minute', override_defaults=True)
@@ -506,86 +980,131 @@ def update_war_history(tag):
             return jsonify({"success": False, 'error': 'password not provided'}), 400
     if post_body['password'] != Config.PARKING_POST_PASSWORD:
             return jsonify({"success": False, 'error': 'incorrect password'}), 400
-    
-    data, error, status = current_active_war(tag)
+
+    try:
+        result = store_war_history(tag)
+    except CocApiError as e:
+        return jsonify({"success": False, "error": e.message}), e.status_code
+    except Exception as e:
+        print(f"Error updating war history of {tag}: {str(e)}", file=sys.stderr)
+        return jsonify({"success": False, "error": "Failed to update war history"}), 500
+
+    return jsonify({"success": True, **result})
+
+def collect_war_history():
+    '''
+    Stores the attacks of the current war of each tracked clan. Scheduled as the coc_war_history job
+    '''
+    inserted = 0
+    failures = 0
+    for tag in tracked_clan_tags():
+        if over_quota(tag):
+            continue
+        try:
+            # The current war and league group, ended CWL wars are cached
+            record_requests(tag, 2)
+            inserted += store_war_history(tag)["attacks_inserted"]
+        except CocApiError as e:
+            # 404 when the clan isn't in a war
+            if e.status_code != 404:
+                print(f"Unable to update war history of {tag}: {e.status_code} {e.message}", file=sys.stderr)
+                failures += 1
+    return {"items": inserted, "failures": failures}
+
+def store_war_history(tag):
+    '''
+    Stores the attacks of the clan's current (regular or CWL) war and counts the war for its members.
+    Raises CocApiError if the war can't be fetched
+    '''
+    data, error, status = current_active_war(tag, PRIORITY_BACKGROUND)
 
     if error or not data:
-        return jsonify({"success": False, "error": error}), status
-    
+        raise CocApiError(error, status)
+
     if data["state"] not in ["inWar", "warEnded"]:
         # No attacks to process
-        return jsonify({"success": True})
+        return {"wars_counted": 0, "attacks_inserted": 0}
     
     war_preparation_start = datetime.strptime(data["preparationStartTime"].replace('Z', ''), "%Y%m%dT%H%M%S.%f").replace(tzinfo=ZoneInfo("UTC"))
     war_start = datetime.strptime(data["startTime"].replace('Z', ''), "%Y%m%dT%H%M%S.%f").replace(tzinfo=ZoneInfo("UTC"))
     war_end = datetime.strptime(data["endTime"].replace('Z', ''), "%Y%m%dT%H%M%S.%f").replace(tzinfo=ZoneInfo("UTC"))
 
-    for member in data["clan"]["members"]:
-        player_tag = member["tag"]
-        town_hall = member["townhallLevel"]
-        map_position = member["mapPosition"]
-        is_cwl=data["isCwl"]
-
-        # increment the war count of this player if not already done
-        player = db.session.query(CocPlayer).filter_by(tag=player_tag).first()
-        if player:
-            if is_cwl:
-                if not player.last_cwl_war_date or player.last_cwl_war_date < war_preparation_start:
-                    player.last_cwl_war_date = war_preparation_start
-                    player.cwl_wars = (player.cwl_wars or 0) + 1
-                    db.session.commit()
-            else:
-                if not player.last_regular_war_date or player.last_regular_war_date < war_preparation_start:
-                    player.last_regular_war_date = war_preparation_start
-                    player.regular_wars = (player.regular_wars or 0) + 1
-                    db.session.commit()
-
-        for attack in member.get("attacks", []):
-            attack_order = attack["order"]
-            defender_tag = attack["defenderTag"]
-
-            existing_entry = db.session.query(CocPlayerWarHistory).filter_by(
-                preparation_start_timestamp=war_preparation_start,
-                attack_order=attack_order
-            ).first()
-
-            if existing_entry:
-                continue
-            
-            stars = attack["stars"]
-            destruction_percentage = attack["destructionPercentage"]
-            duration = attack["duration"]
-
-            # Need to find additional defender information
-            defender = next((p for p in data["opponent"]["members"] if p["tag"] == defender_tag), None)
-            defender_townhall = defender["townhallLevel"]
-            defender_map_position = defender["mapPosition"]
-
-            new_entry = CocPlayerWarHistory(
-                war_end_timestamp=war_end,
-                tag=player_tag,
-                attacker_townhall=town_hall,
-                map_position=map_position,
-                defender_townhall=defender_townhall,
-                defender_tag=defender_tag,
-                defender_map_position=defender_map_position,
-                destruction_percentage=destruction_percentage,
-                duration=duration,
-                stars=stars,
-                attack_order=attack_order,
-                is_cwl=is_cwl,
-                preparation_start_timestamp=war_preparation_start,
-                start_timestamp=war_start
+    is_cwl = data["isCwl"]
+    members = data["clan"]["members"]
+    defenders = {defender["tag"]: defender for defender in data["opponent"]["members"]}
+
+    attacks = [
+        {
+            "attack_order": attack["order"],
+            "tag": member["tag"],
+            "attacker_townhall": member["townhallLevel"],
+            "map_position": member["mapPosition"],
+            "defender_tag": attack["defenderTag"],
+            "defender_townhall": defenders[attack["defenderTag"]]["townhallLevel"],
+            "defender_map_position": defenders[attack["defenderTag"]]["mapPosition"],
+            "destruction_percentage": attack["destructionPercentage"],
+            "duration": attack["duration"],
+            "stars": attack["stars"]
+        }
+        for member in members
+        for attack in member.get("attacks", [])
+    ]
+
+    # Increment the war count of every member not already counted for this war
+    last_war_date = CocPlayer.last_cwl_war_date if is_cwl else CocPlayer.last_regular_war_date
+    war_count = CocPlayer.cwl_wars if is_cwl else CocPlayer.regular_wars
+    count_wars = (
+        update(CocPlayer)
+        .where(
+            CocPlayer.tag.in_([member["tag"] for member in members]),
+            or_(last_war_date.is_(None), last_war_date < war_preparation_start)
+        )
+        .values({last_war_date: war_preparation_start, war_count: func.coalesce(war_count, 0) + 1})
+        .execution_options(synchronize_session=False)
+    )
+
+    # Attacks already stored (same war and attack order) are skipped, attackers we don't track are dropped.
+    # The attacks that were inserted are added to the players' war stats in the same statement
+    insert_attacks = text(f"""
+        WITH inserted AS (
+            INSERT INTO coc_player_war_history (
+                war_end_timestamp, preparation_start_timestamp, start_timestamp, attack_order, tag, attacker_townhall,
+                map_position, defender_townhall, defender_tag, defender_map_position, destruction_percentage, duration,
+                stars, is_cwl
             )
+            SELECT :war_end, :war_preparation_start, :war_start, a.attack_order, a.tag, a.attacker_townhall,
+                a.map_position, a.defender_townhall, a.defender_tag, a.defender_map_position, a.destruction_percentage,
+                a.duration, a.stars, :is_cwl
+            FROM jsonb_to_recordset(CAST(:attacks AS jsonb)) AS a(
+                attack_order INTEGER, tag VARCHAR(15), attacker_townhall INTEGER, map_position INTEGER,
+                defender_townhall INTEGER, defender_tag VARCHAR(15), defender_map_position INTEGER,
+                destruction_percentage INTEGER, duration INTEGER, stars INTEGER
+            )
+            JOIN coc_player p ON p.tag = a.tag
+            ON CONFLICT (tag, preparation_start_timestamp, attack_order) DO NOTHING
+            RETURNING *
+        ),
+        stats AS ({war_stats_upsert("inserted")})
+        SELECT COUNT(*) FROM inserted;
+    """)
 
-            try:
-                db.session.add(new_entry)
-                db.session.commit()
-            except Exception as e:
-                db.session.rollback()
-            
-    
-    return jsonify({"success": True})
+    try:
+        counted = db.session.execute(count_wars).rowcount
+        inserted = 0
+        if attacks:
+            inserted = db.session.execute(insert_attacks, {
+                "war_end": war_end,
+                "war_preparation_start": war_preparation_start,
+                "war_start": war_start,
+                "is_cwl": is_cwl,
+                "attacks": json.dumps(attacks)
+            }).scalar()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return {"wars_counted": counted, "attacks_inserted": inserted}
 
 @bp.route('/clan/<string:tag>/warlog', methods=['GET'])
 @limiter.limit('15/minute', override_defaults=True)
@@ -594,7 +1113,7 @@ def get_war_log(tag):
     Retrieves a clan's war log
     """
     tag = tag.replace("#", "%23")
-    war_log_response = requests.get(f"{BASE_URL}/clans/{tag}/warlog", headers=headers)
+    war_log_response = coc_client.get(f"/clans/{tag}/warlog")
 
     if war_log_response.status_code == 403:
         return jsonify({"success": False, "error": "Private war log"}), war_log_response.status_code
@@ -608,220 +1127,17 @@ def get_war_log(tag):
 def get_full_clan_data(tag):
     """
     Gets all relevant clan data and combines it together in the members
-    Clan data, regular war, cwl war, capital raid
+    Clan data, regular war, cwl war, capital raid.
+    Tracked clans are served from the background refreshed snapshot, with its age in the Age header
     """
-    tag = tag.replace("#", "%23")
-    clan_url = f"{BASE_URL}/clans/{tag}"
-    capital_raid = f"{BASE_URL}/clans/{tag}/capitalraidseasons?limit=1"
-    war_url = f"{BASE_URL}/clans/{tag}/currentwar"
-    leaguegroup_url = f"{BASE_URL}/clans/{tag}/currentwar/leaguegroup"
+    tag = tag.replace("%23", "#")
+    value, age = full_clan_snapshot(tag)
+    if value is not None:
+        return current_app.response_class(value, mimetype="application/json", headers={"Age": str(age)}), 200
 
-    def fetch(url):
-        return requests.get(url, headers=headers)
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(fetch, url) for url in [clan_url, capital_raid, war_url, leaguegroup_url]]
-        clan_response, capital_raid_response, war_response, leaguegroup_response = [f.result() for f in futures]
-    
-
-    if not clan_response.ok:
-        return jsonify({"success": False, "error": clan_response.json().get("message")}), clan_response.status_code
-    if not capital_raid_response.ok:
-        return jsonify({"success": False, "error": capital_raid_response.json().get("message")}), capital_raid_response.status_code
-    if not war_response.ok and war_response.status_code != 403:
-        return jsonify({"success": False, "error": war_response.json().get("message")}), capital_raid_response.status_code
-    if not leaguegroup_response.ok and leaguegroup_response.status_code != 404:
-        return jsonify({"success": False, "error": leaguegroup_response.json().get("message")}), leaguegroup_response.status_code
-    # League group can be 404 if CWL is not currently active
-    # Current war is 403 if war log is not private
-
-    if leaguegroup_response.status_code == 404:
-        leaguegroup_data = None
-    else:
-        leaguegroup_data = leaguegroup_response.json()
-    
-    # If leaguegroup exists then fetch all CWL wars
-    def fetchCWLWar(url, war_tag):
-        response = requests.get(url, headers=headers)
-        if response.ok:
-            data = response.json()
-            data["war_tag"] = war_tag
-            return data
-        else:
-            return None
-    cwl_wars = None
-    if leaguegroup_data:
-        cwl_war_tags = []
-        for r in leaguegroup_data.get("rounds"):
-            for war_tag in r.get("warTags"):
-                if war_tag != "#0":
-                    cwl_war_tags.append(war_tag.replace("#", "%23"))
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [executor.submit(fetchCWLWar, f"{BASE_URL}/clanwarleagues/wars/{war_tag}", war_tag) for war_tag in cwl_war_tags]
-            cwl_wars = [f.result() for f in futures 
-                                 if f.result()]
-            # Keeping it sorted in order is good
-            cwl_wars.sort(key=lambda x: datetime.strptime(x["startTime"], "%Y%m%dT%H%M%S.%fZ"))
-        
-
-
-    clan = clan_response.json()
-
-    capital_data = capital_raid_response.json()["items"]
-    if len(capital_data) == 1:
-        capital_data = capital_data[0]
-    else:
-        capital_data = None
-
-    war_data = war_response.json() if war_response.status_code != 403 else None
-
-    clan["war"] = war_data
-    clan["cwl_wars"] = cwl_wars
-    clan["capital_raid_data"] = capital_data
-    
-
-    for member in clan["memberList"]:
-        # Getting raid contributions for current clan capital raid
-        if capital_data and capital_data.get("state") == "ongoing":
-            capital_player = next((p for p in capital_data["members"] if p["tag"] == member["tag"]), None)
-            if capital_player:
-                member["clan_capital"] = {
-                    "attacks": capital_player.get("attacks", 0),
-                    "capitalResourcesLooted": capital_player.get("capitalResourcesLooted", 0)
-                }
-            else:
-                member["clan_capital"] = None # We dont want players who haven't opened it to show up
-        else:
-            member["clan_capital"] = None
-        
-        # Getting current normal war attacks for ongoing war
-        if war_data and war_data.get("state") == "inWar":
-            war_player = next((p for p in war_data["clan"]["members"] if p["tag"] == member["tag"]), None)
-
-            if war_player:
-                member["war"] = {
-                    "attacks": len(war_player.get("attacks", []))
-                }
-            else:
-                member["war"] = None
-        else:
-            member["war"] = None
-
-        
-        # Go through each cwl to aggregate each player's stats in this clan
-        tag = tag.replace("%23", "#")
-        if cwl_wars:
-            attacks = 0
-            attack_limit = 0
-            total_destruction = 0
-            total_stars = 0
-            total_duration = 0
-            attack_todo = False
-            defends = 0
-            defends_stars = 0
-            defends_total_destruction = 0
-            defends_total_duration = 0
-            for war in cwl_wars:
-                # If it's preparation then skip
-                if war.get("state") == "preparation":
-                    continue
-                # Get the members list if the requested clan is in this war
-                warMembers = None
-                if war.get("clan").get("tag") == tag:
-                    warMembers = war.get("clan").get("members")
-                elif war.get("opponent").get("tag") == tag:
-                    warMembers = war.get("opponent").get("members")
-                else:
-                    continue
-
-                war_player = next((p for p in warMembers if p["tag"] == member["tag"]), None)
-
-                # War state can be inWar or warEnded
-                if war_player:
-                    attack_limit += 1
-                    if war_player.get("attacks") and len(war_player.get("attacks")) == 1:
-                        attack_info = war_player.get("attacks")[0]
-                        attacks += 1
-                        total_destruction += attack_info.get("destructionPercentage")
-                        total_stars += attack_info.get("stars")
-                        total_duration += attack_info.get("duration")
-                    elif war.get("state") == "inWar":
-                        attack_todo = True
-                    
-                    if war_player.get("opponentAttacks") > 0:
-                        defends += war_player.get("opponentAttacks")
-                        if war_player.get("bestOpponentAttack"):
-                            best_attack = war_player.get("bestOpponentAttack")
-                            defends_stars += best_attack.get("stars")
-                            defends_total_destruction += best_attack.get("destructionPercentage")
-                            defends_total_duration += best_attack.get("duration")
-
-
-                    
-                    # can also do defend data
-            member["cwl_war"] = {
-                "attacks": attacks,
-                "attack_limit": attack_limit,
-                "total_destruction": total_destruction,
-                "total_stars": total_stars,
-                "total_duration": total_duration,
-                "attack_todo": attack_todo,
-                "defends": defends,
-                "defends_stars": defends_stars,
-                "defends_total_destruction": defends_total_destruction,
-                "defends_total_duration": defends_total_duration
-            }
-        else:
-            member["cwl_war"] = None
-
-
-        # Put CWL round info for this clan (clan, opponent, war tag)
-        if cwl_wars:
-            cwl_war_rounds = []
-            for war in cwl_wars:
-                war_tag = war.get("war_tag").replace("%23","#")
-                if war.get("opponent").get("tag") == tag:
-                    # Make our clan the friendly one
-                    opponent = war.get("clan").get("name")
-                    opponent_tag = war.get("clan").get("tag")
-                    opponent_attacks = war.get("clan").get("attacks")
-                    opponent_stars = war.get("clan").get("stars")
-                    opponent_destruction_percentage = war.get("clan").get("destructionPercentage")
-                    clan_name = war.get("opponent").get("name")
-                    clan_tag = tag
-                    clan_attacks = war.get("opponent").get("attacks")
-                    clan_stars = war.get("opponent").get("stars")
-                    clan_destruction_percentage = war.get("opponent").get("destructionPercentage")
-                else:
-                    opponent = war.get("opponent").get("name")
-                    opponent_tag = war.get("opponent").get("tag")
-                    opponent_attacks = war.get("opponent").get("attacks")
-                    opponent_stars = war.get("opponent").get("stars")
-                    opponent_destruction_percentage = war.get("opponent").get("destructionPercentage")
-                    clan_name = war.get("clan").get("name")
-                    clan_tag = war.get("clan").get("tag")  
-                    clan_attacks = war.get("clan").get("attacks")
-                    clan_stars = war.get("clan").get("stars")
-                    clan_destruction_percentage = war.get("clan").get("destructionPercentage")                                      
-
-                cwl_war_rounds.append({
-                    "war_tag": war_tag,
-                    "clan": clan_name,
-                    "clan_tag": clan_tag,
-                    "clan_attacks": clan_attacks,
-                    "clan_stars": clan_stars,
-                    "clan_destruction_percentage": clan_destruction_percentage,
-                    "opponent": opponent,
-                    "opponent_tag": opponent_tag,
-                    "opponent_attacks": opponent_attacks,
-                    "opponent_stars": opponent_stars,
-                    "opponent_destruction_percentage": opponent_destruction_percentage,
-                    "state": war.get("state"),
-                    "team_size": war.get("teamSize"),
-                })
-            clan["cwl_war_rounds"] = cwl_war_rounds
-        else:
-            clan["cwl_war_rounds"] = None
+    clan, error, status = full_clan_data(tag)
+    if error:
+        return jsonify({"success": False, "error": error}), status
 
     return jsonify(clan), 200
 
@@ -829,7 +1145,11 @@ def get_full_clan_data(tag):
 @bp.route('/clan/<string:tag>/capitalraidseasons', methods=['GET'])
 @limiter.limit('4/second', override_defaults=True)
 def get_capital_raid_seasons(tag):
-    tag = tag.replace("#", "%23")
+    """
+    Capital raid seasons newest first, paged with limit and the after cursor of the previous page.
+    Finished seasons of tracked clans are served from the database, other clans are proxied
+    """
+    tag = tag.replace("%23", "#")
     try:
         limit = int(request.args.get('limit', default=10))
         if limit < 1 or limit > 20:
@@ -838,16 +1158,34 @@ def get_capital_raid_seasons(tag):
         return jsonify({"success": False, "error": f"limit must be an integer between 1-20, but received '{limit}'"}), 400
     after = request.args.get('after')
 
+    try:
+        before = decode_cursor(after) if after else None
+        page = capital_raid_seasons_page(tag, limit, before)
+    except CocApiError as e:
+        return jsonify({"success": False, "error": e.message}), e.status_code
+    except ValueError:
+        # Not one of our cursors, it may be an upstream cursor of a clan that isn't stored
+        page = None
+    if page is not None:
+        return jsonify(page), 200
+
     params = {
         "limit": limit
     }
     if after:
         params["after"] = after
 
-    capital_raid_response = requests.get(f"{BASE_URL}/clans/{tag}/capitalraidseasons", params=params, headers=headers)
+    capital_raid_response = coc_client.get(f"/clans/{tag.replace('#', '%23')}/capitalraidseasons", params=params)
 
     if capital_raid_response.status_code != 200:
         return jsonify({"success": False, "error": capital_raid_response.json().get("reason")}), capital_raid_response.status_code
 
     return jsonify(capital_raid_response.json()), 200
 
+@bp.route('/upstream_stats', methods=['GET'])
+@limiter.limit('20/minute', override_defaults=True)
+def get_upstream_stats():
+    """
+    Latency and error metrics of Clash of Clans API calls made by this worker, and the response cache hit rate
+    """
+    return jsonify(coc_client.stats()), 200
@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+import math
+import sys
+from typing import List
+from zoneinfo import ZoneInfo
+from sqlalchemy import nulls_first
+from app.extensions import db, redis_client
+from app.models.clashofclans import CocPlayer, CocTrackedClan
+from config import Config
+
+# How often the collection jobs run, each run takes the next share of the work
+COLLECTION_TICK_SECONDS = 60
+# Upstream requests made for each tracked clan, a hash of clan tag -> requests per UTC day
+CLAN_REQUESTS_KEY = "coc:clan_requests"
+CLAN_REQUESTS_RETENTION_SECONDS = 8 * 24 * 3600
+
+
+def tracked_clan_tags() -> List[str]:
+    return [tag for (tag,) in db.session.query(CocTrackedClan.tag).filter_by(active=True).order_by(CocTrackedClan.tag)]
+
+
+def shard_size(total: int, interval: int) -> int:
+    """
+    How many of total items to process per collection tick so each is processed once per interval
+    """
+    ticks = max(1, interval // COLLECTION_TICK_SECONDS)
+    return math.ceil(total / ticks)
+
+
+def due_clans() -> List[CocTrackedClan]:
+    """
+    The tracked clans whose snapshots should be collected in this tick, the most overdue first.
+    At most a tick's share of the clans, so collection is spread over COC_SNAPSHOT_INTERVAL_SECONDS
+    """
+    interval = Config.COC_SNAPSHOT_INTERVAL_SECONDS
+    active = CocTrackedClan.query.filter_by(active=True)
+    limit = shard_size(active.count(), interval)
+    if not limit:
+        return []
+
+    # Slightly early so a clan collected in the previous round's tick isn't pushed back a whole tick
+    due_before = datetime.now(ZoneInfo("UTC")) - timedelta(seconds=interval - COLLECTION_TICK_SECONDS / 2)
+    return (active
+            .filter((CocTrackedClan.last_collected_at.is_(None)) | (CocTrackedClan.last_collected_at <= due_before))
+            .order_by(nulls_first(CocTrackedClan.last_collected_at))
+            .limit(limit)
+            .all())
+
+
+def due_activity_players() -> dict:
+    """
+    The members of tracked clans whose activity should be polled in this tick, the most overdue first, as
+    tag -> clan tag. At most a tick's share of the members, so polling is spread over COC_ACTIVITY_INTERVAL_SECONDS,
+    and never more than COC_ACTIVITY_MAX_PLAYERS_PER_TICK. Members of clans that used their daily quota are skipped
+    """
+    usage = requests_today()
+    clan_tags = [tag for tag in tracked_clan_tags() if usage.get(tag, 0) < Config.COC_CLAN_DAILY_REQUEST_QUOTA]
+    if not clan_tags:
+        return {}
+
+    interval = Config.COC_ACTIVITY_INTERVAL_SECONDS
+    members = CocPlayer.query.filter(CocPlayer.clan_tag.in_(clan_tags))
+    limit = min(shard_size(members.count(), interval), Config.COC_ACTIVITY_MAX_PLAYERS_PER_TICK)
+    if not limit:
+        return {}
+
+    due_before = datetime.now(ZoneInfo("UTC")) - timedelta(seconds=interval - COLLECTION_TICK_SECONDS / 2)
+    query = (db.session.query(CocPlayer.tag, CocPlayer.clan_tag)
+             .filter(CocPlayer.clan_tag.in_(clan_tags))
+             .filter((CocPlayer.last_state_date.is_(None)) | (CocPlayer.last_state_date <= due_before))
+             .order_by(nulls_first(CocPlayer.last_state_date))
+             .limit(limit))
+    return {tag: clan_tag for tag, clan_tag in query}
+
+
+def _requests_key(day: datetime = None) -> str:
+    day = day or datetime.now(ZoneInfo("UTC"))
+    return f"{CLAN_REQUESTS_KEY}:{day.strftime('%Y-%m-%d')}"
+
+
+def record_requests(clan_tag: str, requests: int):
+    """
+    Adds upstream requests made on behalf of a clan to its usage for the day
+    """
+    if not requests:
+        return
+    key = _requests_key()
+    pipe = redis_client.pipeline()
+    pipe.hincrby(key, clan_tag, requests)
+    pipe.expire(key, CLAN_REQUESTS_RETENTION_SECONDS)
+    pipe.execute()
+
+
+def record_player_requests(player_clans: dict):
+    """
+    Attributes one request per player (tag -> clan tag) to the player's clan
+    """
+    per_clan = {}
+    for clan_tag in player_clans.values():
+        if clan_tag:
+            per_clan[clan_tag] = per_clan.get(clan_tag, 0) + 1
+    for clan_tag, requests in per_clan.items():
+        record_requests(clan_tag, requests)
+
+
+def requests_today(clan_tags: List[str] = None) -> dict:
+    usage = {k.decode(): int(v) for k, v in redis_client.hgetall(_requests_key()).items()}
+    if clan_tags is None:
+        return usage
+    return {tag: usage.get(tag, 0) for tag in clan_tags}
+
+
+def over_quota(clan_tag: str) -> bool:
+    used = redis_client.hget(_requests_key(), clan_tag)
+    if used is not None and int(used) >= Config.COC_CLAN_DAILY_REQUEST_QUOTA:
+        print(f"Clan {clan_tag} used its daily request quota, skipping collection", file=sys.stderr)
+        return True
+    return False
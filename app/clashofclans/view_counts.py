@@ -0,0 +1,82 @@
+import json
+import uuid
+from typing import Iterable
+from redis.exceptions import ResponseError
+from sqlalchemy import text
+from app.extensions import db, redis_client
+
+# Profile views not yet added to coc_player.view_count, a hash of tag -> views
+PENDING_VIEWS_KEY = "coc:view_counts:pending"
+# Views being written to Postgres by the current (or a failed) flush
+FLUSHING_VIEWS_KEY = "coc:view_counts:flushing"
+# Identifies the views being flushed, recorded in coc_view_count_flush when they are applied
+FLUSH_ID_KEY = "coc:view_counts:flush_id"
+
+
+def add_view(tag: str):
+    redis_client.hincrby(PENDING_VIEWS_KEY, tag, 1)
+
+
+def pending_views(tags: Iterable[str] = None) -> dict:
+    """
+    Views of each tag that haven't been flushed yet, for all tags if none are given
+    """
+    tags = list(tags) if tags is not None else None
+    if tags == []:
+        return {}
+
+    pipe = redis_client.pipeline()
+    for key in [PENDING_VIEWS_KEY, FLUSHING_VIEWS_KEY]:
+        if tags is None:
+            pipe.hgetall(key)
+        else:
+            pipe.hmget(key, tags)
+
+    views = {}
+    for result in pipe.execute():
+        counts = result.items() if tags is None else zip(tags, result)
+        for tag, count in counts:
+            if count is not None:
+                tag = tag.decode() if isinstance(tag, bytes) else tag
+                views[tag] = views.get(tag, 0) + int(count)
+    return views
+
+
+def flush_views() -> int:
+    """
+    Adds the pending views to coc_player.view_count in a single UPDATE. Returns the number of players updated.
+    The pending hash is renamed first so views counted during the flush go to a new hash.
+    The flush id is recorded in the same transaction as the UPDATE, so if the flushing hash outlives a
+    committed flush (the process died or Redis failed before deleting it) the views aren't added twice
+    """
+    if not redis_client.exists(FLUSHING_VIEWS_KEY):
+        try:
+            redis_client.rename(PENDING_VIEWS_KEY, FLUSHING_VIEWS_KEY)
+        except ResponseError:
+            # No views since the last flush
+            return 0
+    # Kept if a previous attempt at this flush already set it
+    redis_client.set(FLUSH_ID_KEY, uuid.uuid4().hex, nx=True)
+    flush_id = redis_client.get(FLUSH_ID_KEY).decode()
+
+    views = [{"tag": tag.decode(), "views": int(count)} for tag, count in redis_client.hgetall(FLUSHING_VIEWS_KEY).items()]
+    updated = 0
+    if views:
+        first_attempt = db.session.execute(text("""
+            INSERT INTO coc_view_count_flush (flush_id) VALUES (:flush_id)
+            ON CONFLICT (flush_id) DO NOTHING
+            RETURNING flush_id;
+        """), {"flush_id": flush_id}).first() is not None
+        if first_attempt:
+            updated = db.session.execute(text("""
+                UPDATE coc_player p
+                SET view_count = p.view_count + v.views
+                FROM jsonb_to_recordset(CAST(:views AS jsonb)) AS v(tag VARCHAR(15), views INTEGER)
+                WHERE p.tag = v.tag;
+            """), {"views": json.dumps(views)}).rowcount
+            # Only a flush that was interrupted moments ago can be retried
+            db.session.execute(text("DELETE FROM coc_view_count_flush WHERE applied_at < now() - INTERVAL '7 days';"))
+        db.session.commit()
+
+    redis_client.delete(FLUSHING_VIEWS_KEY, FLUSH_ID_KEY)
+    return updated
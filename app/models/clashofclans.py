@@ -1,17 +1,23 @@
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timedelta
 from marshmallow import Schema, fields, EXCLUDE,post_load, pre_load
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
+from sqlalchemy import text
 from sqlalchemy.dialects.postgresql import JSONB
 from app.extensions import db, psycop_conn
+from config import Config
 from zoneinfo import ZoneInfo
 import re
 
+# A snapshot is only stored when a value changed, but at least this often so history stays anchored
+SNAPSHOT_KEYFRAME_INTERVAL = timedelta(days=1)
 
 class CocPlayerData(db.Model):
     __tablename__ = 'coc_player_historical_data'
 
-    id = db.Column(db.Integer, primary_key=True)
-    timestamp = db.Column(db.DateTime(timezone=True), nullable=False, default=datetime.now(tz=ZoneInfo("UTC")))
+    # Hypertable partitioned on timestamp, so it has to be part of the primary key
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    timestamp = db.Column(db.DateTime(timezone=True), primary_key=True, nullable=False, default=datetime.now(tz=ZoneInfo("UTC")))
     tag = db.Column(db.String(15), db.ForeignKey('coc_player.tag', ondelete="CASCADE"), nullable=False)
     town_hall_level = db.Column(db.Integer, nullable=False)
     town_hall_weapon_level = db.Column(db.Integer, nullable=True)
@@ -44,10 +50,666 @@ class CocPlayerData(db.Model):
     # Relationship to CocPlayer
     player = db.relationship('CocPlayer', back_populates='historical_data')
 
+class CocUpgradeEvent(db.Model):
+    """
+    A single level increase of a player's troop, hero, spell, equipment or building,
+    detected by diffing consecutive snapshots during ingestion
+    """
+    __tablename__ = 'coc_upgrade_events'
+
+    tag = db.Column(db.String(15), db.ForeignKey('coc_player.tag', ondelete="CASCADE"), primary_key=True)
+    timestamp = db.Column(db.DateTime(timezone=True), primary_key=True)
+    category = db.Column(db.String(20), primary_key=True)
+    name = db.Column(db.String(50), primary_key=True)
+    # "home" or "builderBase", builder base items share names with home village ones (e.g. Baby Dragon)
+    village = db.Column(db.String(20), primary_key=True)
+    # Null when the item was unlocked
+    old_level = db.Column(db.Integer, nullable=True)
+    new_level = db.Column(db.Integer, nullable=False)
+
+class CocTrackedClan(db.Model):
+    """
+    A clan whose members' snapshots, activity and wars are collected
+    """
+    __tablename__ = 'coc_tracked_clan'
+
+    tag = db.Column(db.String(15), primary_key=True)
+    name = db.Column(db.String(20), nullable=True)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    added_at = db.Column(db.DateTime(timezone=True), nullable=False, server_default=db.func.now())
+    # When the members' snapshots were last collected, collection picks the clans that are most overdue
+    last_collected_at = db.Column(db.DateTime(timezone=True), nullable=True)
+
+class CocPlayerActivity(db.Model):
+    """
+    A detected change in a player's activity state, logged when activity is polled
+    """
+    __tablename__ = 'coc_player_activity'
+
+    tag = db.Column(db.String(15), db.ForeignKey('coc_player.tag', ondelete="CASCADE"), primary_key=True)
+    timestamp = db.Column(db.DateTime(timezone=True), primary_key=True)
+
+class CocCapitalRaidSeason(db.Model):
+    """
+    A finished capital raid season of a clan, as returned by the API. Ongoing seasons are not stored
+    """
+    __tablename__ = 'coc_capital_raid_season'
+
+    clan_tag = db.Column(db.String(15), primary_key=True)
+    start_time = db.Column(db.DateTime(timezone=True), primary_key=True)
+    end_time = db.Column(db.DateTime(timezone=True), nullable=False)
+    state = db.Column(db.String(20), nullable=False)
+    data = db.Column(JSONB, nullable=False)
+
+# Snapshot columns holding [{"name", "level"}] lists, and single level columns, by event category
+UPGRADE_LIST_CATEGORIES = {"troop": "troops", "hero": "heroes", "spell": "spells", "hero_equipment": "hero_equipment"}
+UPGRADE_LEVEL_CATEGORIES = {"town_hall": "town_hall_level", "town_hall_weapon": "town_hall_weapon_level", "builder_hall": "builder_hall_level"}
+UPGRADE_LEVEL_VILLAGES = {"town_hall": "home", "town_hall_weapon": "home", "builder_hall": "builderBase"}
+
+def _villages_by_occurrence(items):
+    villages = defaultdict(list)
+    for item in items or []:
+        villages[item["name"]].append(item.get("village"))
+    return villages
+
+def _item_levels(items, reference=None):
+    """
+    Levels keyed by (name, village). Snapshots stored before the village was kept take it from the item
+    at the same position among those of the same name in reference (a newer snapshot), as the API lists
+    items in a stable order, falling back to the home village being listed first
+    """
+    reference_villages = _villages_by_occurrence(reference)
+    levels = {}
+    occurrences = defaultdict(int)
+    for item in items or []:
+        name = item["name"]
+        occurrence = occurrences[name]
+        occurrences[name] += 1
+        village = item.get("village")
+        if village is None:
+            known = reference_villages.get(name, [])
+            village = known[occurrence] if occurrence < len(known) and known[occurrence] else None
+        if village is None:
+            village = "home" if occurrence == 0 else "builderBase"
+        levels[(name, village)] = item["level"]
+    return levels
+
+def find_upgrade_events(previous: CocPlayerData, current: CocPlayerData, timestamp: datetime):
+    """
+    Upgrade events between two snapshots of the same player, as dicts of CocUpgradeEvent columns
+    """
+    events = []
+
+    def add(category, name, village, old_level, new_level):
+        if new_level is not None and (old_level is None or new_level > old_level):
+            events.append({"tag": current.tag, "timestamp": timestamp, "category": category, "name": name,
+                           "village": village, "old_level": old_level, "new_level": new_level})
+
+    for category, column in UPGRADE_LIST_CATEGORIES.items():
+        current_items = getattr(current, column)
+        old_levels = _item_levels(getattr(previous, column), reference=current_items)
+        for (name, village), level in _item_levels(current_items, reference=current_items).items():
+            add(category, name, village, old_levels.get((name, village)), level)
+
+    for category, column in UPGRADE_LEVEL_CATEGORIES.items():
+        add(category, category, UPGRADE_LEVEL_VILLAGES[category], getattr(previous, column), getattr(current, column))
+
+    return events
+
+def setup_coc_upgrade_events_table():
+    conn = psycop_conn()
+    cur = conn.cursor()
+
+    # Convert the table to a hypertable if it is not already one
+    cur.execute("SELECT create_hypertable('coc_upgrade_events', 'timestamp', if_not_exists => TRUE);")
+
+    # Add the village to the key of events stored before it was kept. Only builder_hall is known to be
+    # builder base, the rest are taken as home village until rebuilt with
+    # backfill_upgrade_events(rebuild=True) (flask clashofclans backfill-upgrade-events --rebuild)
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'coc_upgrade_events' AND column_name = 'village';
+    """)
+    if cur.fetchone() is None:
+        cur.execute("ALTER TABLE coc_upgrade_events ADD COLUMN village VARCHAR(20) NOT NULL DEFAULT 'home';")
+        cur.execute("ALTER TABLE coc_upgrade_events ALTER COLUMN village DROP DEFAULT;")
+        cur.execute("UPDATE coc_upgrade_events SET village = 'builderBase' WHERE category = 'builder_hall';")
+        cur.execute("ALTER TABLE coc_upgrade_events DROP CONSTRAINT IF EXISTS coc_upgrade_events_pkey;")
+        cur.execute("ALTER TABLE coc_upgrade_events ADD PRIMARY KEY (tag, timestamp, category, name, village);")
+
+    # Per item queries, per player ones are served by the primary key
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_coc_upgrade_events_item
+        ON coc_upgrade_events (category, name, timestamp DESC);
+    """)
+
+    # Commit the changes and close the connection
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def setup_coc_tracked_clan_table():
+    conn = psycop_conn()
+    cur = conn.cursor()
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS coc_tracked_clan (
+            tag VARCHAR(15) PRIMARY KEY,
+            name VARCHAR(20),
+            active BOOLEAN NOT NULL DEFAULT TRUE,
+            added_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_collected_at TIMESTAMPTZ
+        );
+    """)
+
+    # Seed the registry with the configured clans, clans removed later stay removed
+    for tag in Config.COC_TRACKED_CLANS:
+        cur.execute("INSERT INTO coc_tracked_clan (tag) VALUES (%s) ON CONFLICT (tag) DO NOTHING;", (tag,))
+
+    # Commit the changes and close the connection
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def setup_coc_capital_raid_season_table():
+    conn = psycop_conn()
+    cur = conn.cursor()
+
+    # Primary key (clan_tag, start_time) also serves the newest first pagination of a clan's seasons
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS coc_capital_raid_season (
+            clan_tag VARCHAR(15) NOT NULL,
+            start_time TIMESTAMPTZ NOT NULL,
+            end_time TIMESTAMPTZ NOT NULL,
+            state VARCHAR(20) NOT NULL,
+            data JSONB NOT NULL,
+            PRIMARY KEY (clan_tag, start_time)
+        );
+    """)
+
+    # Commit the changes and close the connection
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def setup_coc_view_count_flush_table():
+    conn = psycop_conn()
+    cur = conn.cursor()
+
+    # View count flushes that were applied, so a flush retried after it committed is skipped
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS coc_view_count_flush (
+            flush_id VARCHAR(32) PRIMARY KEY,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+
+    # Commit the changes and close the connection
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def setup_coc_player_activity_table():
+    conn = psycop_conn()
+    cur = conn.cursor()
+
+    cur.execute("SELECT create_hypertable('coc_player_activity', 'timestamp', chunk_time_interval => INTERVAL '30 days', if_not_exists => TRUE);")
+
+    # Activity per player per hour, the heatmaps are built from this instead of the raw log
+    cur.execute("""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS coc_player_activity_hourly
+        WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+        SELECT
+            tag,
+            time_bucket('1 hour', timestamp) AS bucket,
+            COUNT(*) AS changes
+        FROM coc_player_activity
+        GROUP BY tag, bucket
+        WITH NO DATA;
+    """)
+    # Include the hours the policy hasn't materialised yet, also for views created before this was set
+    cur.execute("ALTER MATERIALIZED VIEW coc_player_activity_hourly SET (timescaledb.materialized_only = false);")
+    cur.execute("""
+        SELECT add_continuous_aggregate_policy('coc_player_activity_hourly',
+            start_offset => INTERVAL '1 week',
+            end_offset => INTERVAL '1 hour',
+            schedule_interval => INTERVAL '1 hour',
+            if_not_exists => TRUE);
+    """)
+
+    # Commit the changes and close the connection
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def activity_heatmap(timezone: str, since: datetime, tag: str = None, clan_tag: str = None):
+    """
+    Activity changes by day of week (0 = Monday) and hour in the given timezone, as a 7 x 24 grid.
+    For a single player, or for the current members of a clan
+    """
+    if tag:
+        player_filter = "a.tag = :tag"
+    else:
+        player_filter = "a.tag IN (SELECT p.tag FROM coc_player p WHERE p.clan_tag = :clan_tag)"
+
+    query = text(f"""
+        SELECT
+            EXTRACT(ISODOW FROM a.bucket AT TIME ZONE :timezone)::INTEGER AS day,
+            EXTRACT(HOUR FROM a.bucket AT TIME ZONE :timezone)::INTEGER AS hour,
+            SUM(a.changes)::INTEGER AS changes
+        FROM coc_player_activity_hourly a
+        WHERE {player_filter} AND a.bucket >= :since
+        GROUP BY day, hour;
+    """)
+    rows = db.session.execute(query, {"timezone": timezone, "since": since, "tag": tag, "clan_tag": clan_tag})
+
+    heatmap = [[0] * 24 for _ in range(7)]
+    for day, hour, changes in rows:
+        heatmap[day - 1][hour] = changes
+    return heatmap
+
+def clan_trends(clan_tag: str, start: datetime, end: datetime, interval: str, members: bool = False):
+    """
+    Trophies, war stars gained, donations and capital contributions of a clan's current members per
+    day or week ('1 day' / '1 week'), from the coc_player_daily aggregate. War stars and capital
+    contributions are cumulative and donations reset each season, so they are summed as daily gains.
+    Snapshots are only stored when something changed (or about daily), so a member without a snapshot
+    on a day is counted with their latest earlier values.
+    Return value: clan series, {tag: {"name", "series"}} if members else None
+    """
+    if members:
+        member_columns = "GROUPING(g.tag) = 0 AS is_member, g.tag, MAX(p.name) AS name"
+        grouping = "GROUPING SETS ((period), (g.tag, period))"
+    else:
+        member_columns = "FALSE AS is_member, NULL AS tag, NULL AS name"
+        grouping = "period"
+    query = text(f"""
+        WITH members AS (
+            SELECT p.tag FROM coc_player p WHERE p.clan_tag = :clan_tag
+        ),
+        -- Every day of the range and the day before it, which gives the first day's gains
+        days AS (
+            SELECT generate_series(time_bucket('1 day', CAST(:start AS TIMESTAMPTZ)) - INTERVAL '1 day',
+                                   CAST(:end AS TIMESTAMPTZ), INTERVAL '1 day') AS day
+        ),
+        known AS (
+            SELECT d.tag, d.bucket, d.trophies, d.war_stars, d.donations, d.clan_capital_contributions
+            FROM coc_player_daily d
+            WHERE d.tag IN (SELECT tag FROM members)
+                AND d.bucket > (SELECT MIN(day) FROM days) AND d.bucket < :end
+            UNION ALL
+            -- Each member's latest values at the first day, however far back they were stored
+            SELECT m.tag, (SELECT MIN(day) FROM days), l.trophies, l.war_stars, l.donations, l.clan_capital_contributions
+            FROM members m
+            CROSS JOIN LATERAL (
+                SELECT d.trophies, d.war_stars, d.donations, d.clan_capital_contributions
+                FROM coc_player_daily d
+                WHERE d.tag = m.tag AND d.bucket <= (SELECT MIN(day) FROM days)
+                ORDER BY d.bucket DESC
+                LIMIT 1
+            ) l
+        ),
+        -- A member with no snapshot on a day keeps their values of the latest day they had one.
+        -- The row count only increases on days with values, so each group starts with the values to carry
+        grid AS (
+            SELECT m.tag, days.day, k.trophies, k.war_stars, k.donations, k.clan_capital_contributions,
+                COUNT(k.bucket) OVER (PARTITION BY m.tag ORDER BY days.day) AS filled_group
+            FROM members m
+            CROSS JOIN days
+            LEFT JOIN known k ON k.tag = m.tag AND k.bucket = days.day
+        ),
+        filled AS (
+            SELECT
+                tag,
+                day AS bucket,
+                first_value(trophies) OVER f AS trophies,
+                first_value(war_stars) OVER f AS war_stars,
+                first_value(donations) OVER f AS donations,
+                first_value(clan_capital_contributions) OVER f AS clan_capital_contributions
+            FROM grid
+            WINDOW f AS (PARTITION BY tag, filled_group ORDER BY day)
+        ),
+        daily AS (
+            SELECT
+                d.tag,
+                d.bucket,
+                d.trophies,
+                d.war_stars - LAG(d.war_stars) OVER w AS war_stars_gained,
+                CASE WHEN d.donations >= LAG(d.donations) OVER w THEN d.donations - LAG(d.donations) OVER w
+                     -- The season reset since the previous day
+                     WHEN LAG(d.donations) OVER w IS NOT NULL THEN d.donations END AS donations,
+                d.clan_capital_contributions - LAG(d.clan_capital_contributions) OVER w AS capital_contributions
+            FROM filled d
+            -- Days before a member's first snapshot
+            WHERE d.trophies IS NOT NULL
+            WINDOW w AS (PARTITION BY d.tag ORDER BY d.bucket)
+        ),
+        gains AS (
+            SELECT
+                tag,
+                time_bucket(CAST(:interval AS INTERVAL), bucket) AS period,
+                last(trophies, bucket) AS trophies,
+                SUM(GREATEST(war_stars_gained, 0)) AS war_stars_gained,
+                SUM(donations) AS donations,
+                SUM(GREATEST(capital_contributions, 0)) AS capital_contributions
+            FROM daily
+            WHERE bucket >= time_bucket('1 day', CAST(:start AS TIMESTAMPTZ)) AND bucket < :end
+            GROUP BY tag, period
+        )
+        SELECT
+            {member_columns},
+            period,
+            COUNT(*) AS member_count,
+            SUM(g.trophies)::INTEGER AS trophies,
+            ROUND(AVG(g.trophies))::INTEGER AS average_trophies,
+            COALESCE(SUM(g.war_stars_gained), 0)::INTEGER AS war_stars_gained,
+            COALESCE(SUM(g.donations), 0)::INTEGER AS donations,
+            COALESCE(SUM(g.capital_contributions), 0)::INTEGER AS capital_contributions
+        FROM gains g
+        JOIN coc_player p ON p.tag = g.tag
+        GROUP BY {grouping}
+        ORDER BY period;
+    """)
+    rows = db.session.execute(query, {"clan_tag": clan_tag, "start": start, "end": end, "interval": interval})
+
+    series = []
+    member_series = {} if members else None
+    for row in rows:
+        if row.is_member:
+            member = member_series.setdefault(row.tag, {"name": row.name, "series": []})
+            member["series"].append({
+                "timestamp": row.period.isoformat(),
+                "trophies": row.trophies,
+                "war_stars_gained": row.war_stars_gained,
+                "donations": row.donations,
+                "capital_contributions": row.capital_contributions,
+            })
+        else:
+            series.append({
+                "timestamp": row.period.isoformat(),
+                "members": row.member_count,
+                "total_trophies": row.trophies,
+                "average_trophies": row.average_trophies,
+                "war_stars_gained": row.war_stars_gained,
+                "donations": row.donations,
+                "capital_contributions": row.capital_contributions,
+            })
+    return series, member_series
+
+def backfill_upgrade_events(rebuild: bool = False):
+    """
+    One off: derives upgrade events from all stored snapshots. Safe to rerun.
+    With rebuild the stored events are replaced in the same transaction, e.g. those stored before the village was kept
+    """
+    list_items = " UNION ALL ".join(f"""
+        SELECT d.tag, d.timestamp, '{category}' AS category, e.item->>'name' AS name, e.item->>'village' AS village,
+            (e.item->>'level')::INTEGER AS level,
+            row_number() OVER (PARTITION BY d.id, d.timestamp, e.item->>'name' ORDER BY e.ord) AS occurrence
+        FROM coc_player_historical_data d
+        CROSS JOIN LATERAL jsonb_array_elements(d.{column}) WITH ORDINALITY AS e(item, ord)
+    """ for category, column in UPGRADE_LIST_CATEGORIES.items())
+    level_items = " UNION ALL ".join(f"""
+        SELECT tag, timestamp, '{category}', '{category}', '{UPGRADE_LEVEL_VILLAGES[category]}', {column}, 1
+        FROM coc_player_historical_data
+        WHERE {column} IS NOT NULL
+    """ for category, column in UPGRADE_LEVEL_CATEGORIES.items())
+
+    # Items of snapshots stored before the village was kept take it from the same item (by position among those
+    # of the same name) in the player's other snapshots, as in _item_levels
+    query = f"""
+        INSERT INTO coc_upgrade_events (tag, timestamp, category, name, village, old_level, new_level)
+        SELECT tag, timestamp, category, name,
+            COALESCE(village, known_village, CASE WHEN occurrence = 1 THEN 'home' ELSE 'builderBase' END),
+            old_level, level
+        FROM (
+            SELECT *,
+                lag(level) OVER (PARTITION BY tag, category, name, occurrence ORDER BY timestamp) AS old_level,
+                first_value(village) OVER (
+                    PARTITION BY tag, category, name, occurrence ORDER BY village IS NULL, timestamp DESC
+                ) AS known_village,
+                min(timestamp) OVER (PARTITION BY tag) AS first_snapshot
+            FROM ({list_items} UNION ALL {level_items}) items
+        ) changes
+        WHERE level > old_level OR (old_level IS NULL AND timestamp > first_snapshot)
+        ON CONFLICT DO NOTHING;
+    """
+
+    conn = psycop_conn()
+    with conn:
+        with conn.cursor() as cur:
+            if rebuild:
+                cur.execute("DELETE FROM coc_upgrade_events;")
+            cur.execute(query)
+    conn.close()
+
+def setup_coc_player_data_table():
+    conn = psycop_conn()
+    cur = conn.cursor()
+
+    cur.execute("""
+        SELECT compression_enabled FROM timescaledb_information.hypertables
+        WHERE hypertable_name = 'coc_player_historical_data';
+    """)
+    hypertable = cur.fetchone()
+
+    # Convert the table to a hypertable if it is not already one. Its unique indexes must
+    # include the partition column, so the primary key becomes (id, timestamp) first
+    if hypertable is None:
+        cur.execute("ALTER TABLE coc_player_historical_data DROP CONSTRAINT IF EXISTS coc_player_historical_data_pkey;")
+        cur.execute("ALTER TABLE coc_player_historical_data ADD PRIMARY KEY (id, timestamp);")
+        cur.execute("""
+            SELECT create_hypertable('coc_player_historical_data', 'timestamp',
+                chunk_time_interval => INTERVAL '30 days', migrate_data => TRUE);
+        """)
+
+    # Per player history is always fetched by tag over a time range
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_coc_player_historical_data_tag_timestamp
+        ON coc_player_historical_data (tag, timestamp DESC);
+    """)
+
+    # Compress older chunks, segmented by player so a player's history decompresses on its own
+    if hypertable is None or not hypertable[0]:
+        cur.execute("""
+            ALTER TABLE coc_player_historical_data SET (
+                timescaledb.compress,
+                timescaledb.compress_segmentby = 'tag',
+                timescaledb.compress_orderby = 'timestamp DESC'
+            );
+        """)
+    cur.execute("SELECT add_compression_policy('coc_player_historical_data', INTERVAL '60 days', if_not_exists => TRUE);")
+
+    # Each player's last values per day, clan trends are built from this. A player only has a row on days
+    # a snapshot was stored, clan_trends carries values forward over the days in between
+    # The policy only refreshes recent days, history stored before the aggregate existed is materialised
+    # once with refresh_player_daily (flask clashofclans refresh-player-daily)
+    cur.execute("""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS coc_player_daily
+        WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+        SELECT
+            tag,
+            time_bucket('1 day', timestamp) AS bucket,
+            last(trophies, timestamp) AS trophies,
+            last(war_stars, timestamp) AS war_stars,
+            last(donations, timestamp) AS donations,
+            last(clan_capital_contributions, timestamp) AS clan_capital_contributions
+        FROM coc_player_historical_data
+        GROUP BY tag, bucket
+        WITH NO DATA;
+    """)
+    cur.execute("""
+        SELECT add_continuous_aggregate_policy('coc_player_daily',
+            start_offset => INTERVAL '3 days',
+            end_offset => INTERVAL '1 hour',
+            schedule_interval => INTERVAL '1 hour',
+            if_not_exists => TRUE);
+    """)
+
+    # Commit the changes and close the connection
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def refresh_player_daily():
+    """
+    One off: materialises coc_player_daily over all stored snapshots. Safe to rerun
+    """
+    conn = psycop_conn()
+    # Refreshing can't run inside a transaction
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("CALL refresh_continuous_aggregate('coc_player_daily', NULL, now() - INTERVAL '1 hour');")
+    conn.close()
+
+def setup_coc_player_table():
+    conn = psycop_conn()
+    cur = conn.cursor()
+
+    cur.execute("CREATE EXTENSION IF NOT EXISTS unaccent;")
+    cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+
+    # unaccent() is only STABLE (its dictionary could change) so it can't be used in an index,
+    # this wrapper pins the dictionary and is declared IMMUTABLE
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION immutable_unaccent(text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+        AS $$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$;
+    """)
+
+    # Trigram index for unaccented, case insensitive name search (ILIKE '%term%' and similarity)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_coc_player_name_trgm
+        ON coc_player USING gin (immutable_unaccent(lower(name)) gin_trgm_ops);
+    """)
+
+    # Commit the changes and close the connection
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def setup_coc_war_history_table():
+    conn = psycop_conn()
+    cur = conn.cursor()
+
+    # Attack history is fetched per player over a range of wars
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_coc_player_war_history_tag_preparation_start
+        ON coc_player_war_history (tag, preparation_start_timestamp);
+    """)
+
+    # An attack is identified by its attacker, war and order, ingestion relies on this to skip attacks already stored.
+    # The attacker is part of it because the wars of a CWL round (and regular wars of different clans) can share
+    # a preparation start time. Replaces the earlier (preparation_start_timestamp, attack_order) constraint and
+    # removes any duplicates from before a constraint existed, keeping the first stored row
+    cur.execute("SELECT to_regclass('uq_coc_player_war_history_attack');")
+    if cur.fetchone()[0] is None:
+        cur.execute("ALTER TABLE coc_player_war_history DROP CONSTRAINT IF EXISTS uq_coc_player_war_history_war_attack;")
+        cur.execute("""
+            DELETE FROM coc_player_war_history a
+            USING coc_player_war_history b
+            WHERE a.tag = b.tag
+                AND a.preparation_start_timestamp = b.preparation_start_timestamp
+                AND a.attack_order = b.attack_order
+                AND a.id > b.id;
+        """)
+        cur.execute("""
+            ALTER TABLE coc_player_war_history
+            ADD CONSTRAINT uq_coc_player_war_history_attack UNIQUE (tag, preparation_start_timestamp, attack_order);
+        """)
+
+    # Commit the changes and close the connection
+    conn.commit()
+    cur.close()
+    conn.close()
+
+# Columns of coc_player_war_stats that are sums of attacks
+WAR_STATS_SUMS = ["attacks", "stars", "triples", "destruction", "duration", "map_position_offset", "townhall_offset",
+                  "same_townhall_attacks", "same_townhall_stars", "same_townhall_triples",
+                  "higher_townhall_attacks", "higher_townhall_stars", "higher_townhall_triples"]
+
+def war_stats_upsert(source: str) -> str:
+    """
+    SQL adding the attacks of source (coc_player_war_history or a relation with its columns) to coc_player_war_stats
+    """
+    return f"""
+        INSERT INTO coc_player_war_stats (tag, day, is_cwl, {', '.join(WAR_STATS_SUMS)})
+        SELECT
+            tag,
+            (preparation_start_timestamp AT TIME ZONE 'UTC')::DATE AS day,
+            is_cwl,
+            COUNT(*),
+            SUM(stars),
+            COUNT(*) FILTER (WHERE stars = 3),
+            SUM(destruction_percentage),
+            SUM(duration),
+            SUM(map_position - defender_map_position),
+            SUM(defender_townhall - attacker_townhall),
+            COUNT(*) FILTER (WHERE defender_townhall = attacker_townhall),
+            COALESCE(SUM(stars) FILTER (WHERE defender_townhall = attacker_townhall), 0),
+            COUNT(*) FILTER (WHERE defender_townhall = attacker_townhall AND stars = 3),
+            COUNT(*) FILTER (WHERE defender_townhall > attacker_townhall),
+            COALESCE(SUM(stars) FILTER (WHERE defender_townhall > attacker_townhall), 0),
+            COUNT(*) FILTER (WHERE defender_townhall > attacker_townhall AND stars = 3)
+        FROM {source}
+        GROUP BY tag, day, is_cwl
+        ON CONFLICT (tag, day, is_cwl) DO UPDATE SET
+            {', '.join(f"{c} = coc_player_war_stats.{c} + EXCLUDED.{c}" for c in WAR_STATS_SUMS)}
+    """
+
+def setup_coc_war_stats_table():
+    conn = psycop_conn()
+    cur = conn.cursor()
+
+    cur.execute("SELECT to_regclass('coc_player_war_stats');")
+    new_table = cur.fetchone()[0] is None
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS coc_player_war_stats (
+            tag VARCHAR(15) NOT NULL REFERENCES coc_player (tag) ON DELETE CASCADE,
+            day DATE NOT NULL,
+            is_cwl BOOLEAN NOT NULL,
+            {', '.join(f"{c} INTEGER NOT NULL" for c in WAR_STATS_SUMS)},
+            PRIMARY KEY (tag, day, is_cwl)
+        );
+    """)
+
+    # Stats are maintained as attacks are stored, a new table starts from the attacks stored so far
+    if new_table:
+        cur.execute(war_stats_upsert("coc_player_war_history"))
+
+    # Commit the changes and close the connection
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def snapshot_values(player_data: CocPlayerData):
+    """
+    The tracked values of a snapshot, two snapshots with equal values are the same player state
+    """
+    return {c.key: getattr(player_data, c.key) for c in CocPlayerData.__mapper__.column_attrs if c.key not in ("id", "timestamp")}
+
+def latest_player_snapshots(tags):
+    """
+    Latest stored snapshot of each tag, keyed by tag. One index lookup per tag
+    """
+    query = text("""
+        SELECT d.*
+        FROM unnest(:tags) AS t(tag)
+        CROSS JOIN LATERAL (
+            SELECT * FROM coc_player_historical_data
+            WHERE tag = t.tag
+            ORDER BY timestamp DESC
+            LIMIT 1
+        ) d
+    """)
+    rows = db.session.execute(db.select(CocPlayerData).from_statement(query), {"tags": list(tags)}).scalars()
+    return {row.tag: row for row in rows}
+
 class CocPlayerWarHistory(db.Model):
     __tablename__ = 'coc_player_war_history'
+    __table_args__ = (
+        db.UniqueConstraint('tag', 'preparation_start_timestamp', 'attack_order', name='uq_coc_player_war_history_attack'),
+    )
 
-    # war_end_timestamp + attack_order will be unique
     id = db.Column(db.Integer, primary_key=True)
     war_end_timestamp = db.Column(db.DateTime(timezone=True), nullable=False)
     preparation_start_timestamp = db.Column(db.DateTime(timezone=True), nullable=False)
@@ -67,6 +729,32 @@ class CocPlayerWarHistory(db.Model):
     # Relationship to CocPlayer
     player = db.relationship('CocPlayer', back_populates='war_history')
 
+class CocPlayerWarStats(db.Model):
+    """
+    A player's attack totals per war type and day (of the war's preparation start, UTC), maintained as attacks
+    are stored so leaderboards are summed from a few rows per player instead of every attack.
+    Same/higher townhall compare the defender's townhall to the attacker's
+    """
+    __tablename__ = 'coc_player_war_stats'
+
+    tag = db.Column(db.String(15), db.ForeignKey('coc_player.tag', ondelete="CASCADE"), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    is_cwl = db.Column(db.Boolean, primary_key=True)
+    attacks = db.Column(db.Integer, nullable=False)
+    stars = db.Column(db.Integer, nullable=False)
+    triples = db.Column(db.Integer, nullable=False)
+    destruction = db.Column(db.Integer, nullable=False)
+    duration = db.Column(db.Integer, nullable=False)
+    # Sums of map_position - defender_map_position and defender_townhall - attacker_townhall
+    map_position_offset = db.Column(db.Integer, nullable=False)
+    townhall_offset = db.Column(db.Integer, nullable=False)
+    same_townhall_attacks = db.Column(db.Integer, nullable=False)
+    same_townhall_stars = db.Column(db.Integer, nullable=False)
+    same_townhall_triples = db.Column(db.Integer, nullable=False)
+    higher_townhall_attacks = db.Column(db.Integer, nullable=False)
+    higher_townhall_stars = db.Column(db.Integer, nullable=False)
+    higher_townhall_triples = db.Column(db.Integer, nullable=False)
+
 class CocPlayer(db.Model):
     __tablename__ = 'coc_player'
 
@@ -101,11 +789,12 @@ class CocPlayer(db.Model):
 class PlayerDataItemLevelSchema(Schema):
     name = fields.String(required=True)
     level = fields.Integer(required=True)
+    village = fields.String()
 
     @pre_load
     def filter_fields(self, data, **kwargs):
-        # Only keep 'name' and 'level'
-        return {key: data[key] for key in ["name", "level"] if key in data}
+        # Only keep 'name', 'level' and 'village'
+        return {key: data[key] for key in ["name", "level", "village"] if key in data}
 
 class PlayerDataAchievementsSchema(Schema):
     name = fields.String(required=True)
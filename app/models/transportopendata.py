@@ -1,10 +1,20 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import sys
 from marshmallow import Schema, fields, EXCLUDE
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
 from app.extensions import db, psycop_conn
+from config import Config
 from zoneinfo import ZoneInfo
 
+# Occupancy profiles are bucketed in local time so "Tuesday 8am" means Tuesday 8am in Sydney
+PROFILE_TIMEZONE = "Australia/Sydney"
+PROFILE_SLOT_MINUTES = 15
+PROFILE_WEEKS = 12
+
+# parking_data may only hold a row when occupancy changed (see PARKING_CHANGE_ONLY),
+# so readings are rebuilt on this grid by carrying the last observation forward
+PARKING_SAMPLE_INTERVAL = '5 minutes'
+
 
 class ParkingLot(db.Model):
     __tablename__ = 'parking_lots'
@@ -39,6 +49,22 @@ class ParkingData(db.Model):
     def __repr__(self):
         return f'<ParkingData {self.facility_id} - {self.spots} spots>'
 
+class ParkingOccupancyProfile(db.Model):
+    '''
+    Typical occupancy of a facility for each day of week (ISO, 1 = Monday) and time of day slot.
+    Maintained by the refresh_parking_occupancy_profile timescale job, never written by the app.
+    '''
+    __tablename__ = 'parking_occupancy_profile'
+
+    facility_id = db.Column(db.Integer, db.ForeignKey('parking_lots.facility_id', ondelete="CASCADE"), primary_key=True)
+    day_of_week = db.Column(db.SmallInteger, primary_key=True)
+    slot = db.Column(db.SmallInteger, primary_key=True)
+    mean_occupancy = db.Column(db.Integer, nullable=False)
+    p10_occupancy = db.Column(db.Integer, nullable=False)
+    p90_occupancy = db.Column(db.Integer, nullable=False)
+    samples = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
 def set_parking_data_table():
     conn = psycop_conn()
     cur = conn.cursor()
@@ -56,6 +82,82 @@ def set_parking_data_table():
     """
     cur.execute(index_creation_query)   
 
+    # 15 minute continuous aggregate, timescale keeps this up to date incrementally
+    continuous_aggregate_query = """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS parking_data_15m
+        WITH (timescaledb.continuous) AS
+        SELECT
+            facility_id,
+            time_bucket('15 minutes', timestamp) AS bucket,
+            AVG(occupancy) AS avg_occupancy,
+            last(occupancy, timestamp) AS closing_occupancy
+        FROM parking_data
+        GROUP BY facility_id, bucket
+        WITH NO DATA;
+    """
+    cur.execute(continuous_aggregate_query)
+
+    # Only the profile window needs to be materialised
+    cur.execute(f"""
+        SELECT add_continuous_aggregate_policy('parking_data_15m',
+            start_offset => INTERVAL '{PROFILE_WEEKS} weeks',
+            end_offset => INTERVAL '15 minutes',
+            schedule_interval => INTERVAL '15 minutes',
+            if_not_exists => TRUE);
+    """)
+
+    # Rebuild the day of week x time of day profile from the aggregate (not the raw rows)
+    profile_procedure_query = f"""
+        CREATE OR REPLACE PROCEDURE refresh_parking_occupancy_profile(job_id INT DEFAULT NULL, config JSONB DEFAULT NULL)
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO parking_occupancy_profile
+                (facility_id, day_of_week, slot, mean_occupancy, p10_occupancy, p90_occupancy, samples, updated_at)
+            SELECT
+                facility_id,
+                EXTRACT(ISODOW FROM local_bucket)::SMALLINT AS day_of_week,
+                ((EXTRACT(HOUR FROM local_bucket) * 60 + EXTRACT(MINUTE FROM local_bucket)) / {PROFILE_SLOT_MINUTES})::SMALLINT AS slot,
+                ROUND(AVG(occupancy))::INTEGER,
+                ROUND(percentile_cont(0.1) WITHIN GROUP (ORDER BY occupancy))::INTEGER,
+                ROUND(percentile_cont(0.9) WITHIN GROUP (ORDER BY occupancy))::INTEGER,
+                COUNT(*),
+                NOW()
+            FROM (
+                -- Buckets without a stored reading had the previous bucket's closing occupancy
+                SELECT facility_id, bucket AT TIME ZONE '{PROFILE_TIMEZONE}' AS local_bucket,
+                    COALESCE(avg_occupancy, carried_occupancy) AS occupancy
+                FROM (
+                    SELECT
+                        facility_id,
+                        time_bucket_gapfill('15 minutes', bucket, NOW() - INTERVAL '{PROFILE_WEEKS} weeks', NOW()) AS bucket,
+                        AVG(avg_occupancy) AS avg_occupancy,
+                        locf(last(closing_occupancy, bucket)) AS carried_occupancy
+                    FROM parking_data_15m
+                    WHERE bucket >= NOW() - INTERVAL '{PROFILE_WEEKS} weeks' AND bucket < NOW()
+                    GROUP BY facility_id, time_bucket_gapfill('15 minutes', bucket, NOW() - INTERVAL '{PROFILE_WEEKS} weeks', NOW())
+                ) filled
+            ) recent
+            WHERE occupancy IS NOT NULL
+            GROUP BY facility_id, day_of_week, slot
+            ON CONFLICT (facility_id, day_of_week, slot) DO UPDATE SET
+                mean_occupancy = EXCLUDED.mean_occupancy,
+                p10_occupancy = EXCLUDED.p10_occupancy,
+                p90_occupancy = EXCLUDED.p90_occupancy,
+                samples = EXCLUDED.samples,
+                updated_at = EXCLUDED.updated_at;
+        END
+        $$;
+    """
+    cur.execute(profile_procedure_query)
+
+    # Schedule the profile refresh as a timescale job if it isn't already
+    cur.execute("""
+        SELECT add_job('refresh_parking_occupancy_profile', INTERVAL '1 hour')
+        WHERE NOT EXISTS (
+            SELECT 1 FROM timescaledb_information.jobs WHERE proc_name = 'refresh_parking_occupancy_profile'
+        );
+    """)
+
     # Commit the changes and close the connection
     conn.commit()
     cur.close()
@@ -82,24 +184,65 @@ def query_parking_data(facility_id: int, start_time: datetime, end_time: datetim
         time_bucket = bucket_size
 
 
+    # Rebuild the reading at every sample tick (last observation carried forward) and average those,
+    # which matches averaging a row per tick. Ticks more than a keyframe past the last reading are
+    # dropped so ingestion outages stay as gaps rather than being filled with a stale value
     query = """
+    WITH ticks AS (
+        SELECT
+            time_bucket_gapfill(%(sample_interval)s, timestamp, %(start_time)s, %(end_time)s) AS tick,
+            locf(
+                last(occupancy, timestamp),
+                (SELECT occupancy FROM parking_data
+                 WHERE facility_id = %(facility_id)s
+                    AND timestamp < %(start_time)s AND timestamp >= %(lookback_time)s
+                 ORDER BY timestamp DESC LIMIT 1)
+            ) AS occupancy,
+            locf(
+                last(timestamp, timestamp),
+                (SELECT timestamp FROM parking_data
+                 WHERE facility_id = %(facility_id)s
+                    AND timestamp < %(start_time)s AND timestamp >= %(lookback_time)s
+                 ORDER BY timestamp DESC LIMIT 1)
+            ) AS observed_at
+        FROM
+            parking_data
+        WHERE
+            facility_id = %(facility_id)s
+            AND timestamp >= %(start_time)s AND timestamp <= %(end_time)s
+        GROUP BY
+            tick
+    )
     SELECT
-        time_bucket(%s, timestamp) AS bucket,
+        time_bucket(%(time_bucket)s, tick) AS bucket,
         ROUND(AVG(occupancy))::INTEGER AS occupancy
     FROM
-        parking_data
+        ticks
     WHERE
-        facility_id = %s
-        AND timestamp >= %s AND timestamp <= %s
+        occupancy IS NOT NULL
+        AND tick - observed_at <= %(keyframe_interval)s + %(sample_interval)s::INTERVAL
     GROUP BY
         bucket
     ORDER BY
         bucket;
     """
 
+    keyframe_interval = timedelta(minutes=Config.PARKING_KEYFRAME_MINUTES)
+    # Don't carry the latest reading into the future
+    end_time = min(end_time, datetime.now(tz=ZoneInfo("UTC")))
+    params = {
+        "sample_interval": PARKING_SAMPLE_INTERVAL,
+        "time_bucket": time_bucket,
+        "facility_id": facility_id,
+        "start_time": start_time,
+        "end_time": end_time,
+        "lookback_time": start_time - keyframe_interval,
+        "keyframe_interval": keyframe_interval
+    }
+
     conn = psycop_conn()
     cur = conn.cursor()
-    cur.execute(query, (time_bucket, facility_id, start_time, end_time))
+    cur.execute(query, params)
     results = cur.fetchall()
     cur.close()
     conn.close()
@@ -116,28 +259,102 @@ def query_parking_data(facility_id: int, start_time: datetime, end_time: datetim
     return formatted_results
 
 def query_min_and_max_parking(facility_id: int, start_time: datetime, end_time: datetime):
-    # Query for global min and max occupancy over the entire time range
+    # Query for global min and max occupancy over the entire time range, including the
+    # reading carried into the range from before it started
     query = """
     SELECT
         MIN(occupancy) AS min_occupancy,
         MAX(occupancy) AS max_occupancy
-    FROM
-        parking_data
-    WHERE
-        facility_id = %s
-        AND timestamp >= %s AND timestamp <= %s;
+    FROM (
+        SELECT occupancy
+        FROM parking_data
+        WHERE facility_id = %(facility_id)s
+            AND timestamp >= %(start_time)s AND timestamp <= %(end_time)s
+        UNION ALL
+        (SELECT occupancy
+         FROM parking_data
+         WHERE facility_id = %(facility_id)s
+            AND timestamp < %(start_time)s AND timestamp >= %(lookback_time)s
+         ORDER BY timestamp DESC
+         LIMIT 1)
+    ) readings;
     """
 
+    params = {
+        "facility_id": facility_id,
+        "start_time": start_time,
+        "end_time": end_time,
+        "lookback_time": start_time - timedelta(minutes=Config.PARKING_KEYFRAME_MINUTES)
+    }
+
     # Run the global min/max query
     conn = psycop_conn()
     cur = conn.cursor()
-    cur.execute(query, (facility_id, start_time, end_time))
+    cur.execute(query, params)
     min_max_result = cur.fetchone()
     min_occupancy = min_max_result[0] or 0
     max_occupancy = min_max_result[1] or 0
 
     return (min_occupancy, max_occupancy)
 
+def query_parking_profile(facility_id: int, day_of_week: int|None = None):
+    '''
+    Returns the precomputed occupancy profile of a facility, optionally for a single ISO day of week
+    '''
+    query = """
+    SELECT day_of_week, slot, mean_occupancy, p10_occupancy, p90_occupancy, samples
+    FROM parking_occupancy_profile
+    WHERE facility_id = %s
+        AND (%s IS NULL OR day_of_week = %s)
+    ORDER BY day_of_week, slot;
+    """
+
+    conn = psycop_conn()
+    cur = conn.cursor()
+    cur.execute(query, (facility_id, day_of_week, day_of_week))
+    results = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    return [
+        {
+            "day_of_week": day,
+            "time": f"{slot * PROFILE_SLOT_MINUTES // 60:02d}:{slot * PROFILE_SLOT_MINUTES % 60:02d}",
+            "mean": mean,
+            "p10": p10,
+            "p90": p90,
+            "samples": samples
+        }
+        for day, slot, mean, p10, p90, samples in results
+    ]
+
+def profile_slot(timestamp: datetime):
+    '''
+    Converts a timestamp into its (day_of_week, slot) profile key
+    '''
+    local = timestamp.astimezone(ZoneInfo(PROFILE_TIMEZONE))
+    return local.isoweekday(), (local.hour * 60 + local.minute) // PROFILE_SLOT_MINUTES
+
+def query_profile_slots(facility_id: int, keys: list):
+    '''
+    Fetches the given (day_of_week, slot) profile rows of a facility, keyed by (day_of_week, slot)
+    '''
+    query = """
+    SELECT day_of_week, slot, mean_occupancy, p10_occupancy, p90_occupancy
+    FROM parking_occupancy_profile
+    WHERE facility_id = %s
+        AND (day_of_week, slot) IN %s;
+    """
+
+    conn = psycop_conn()
+    cur = conn.cursor()
+    cur.execute(query, (facility_id, tuple(keys)))
+    results = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    return {(day, slot): {"mean": mean, "p10": p10, "p90": p90} for day, slot, mean, p10, p90 in results}
+
 
 
 class ParkingLotSchema(SQLAlchemyAutoSchema):
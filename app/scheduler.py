@@ -0,0 +1,161 @@
+import os
+import random
+import sys
+import time
+import traceback
+from typing import Callable, Dict, Optional
+from app.extensions import db, redis_client, socketio
+
+LOCK_KEY = "scheduler:lock"
+LAST_RUN_KEY = "scheduler:last_run"
+METRICS_KEY = "scheduler:metrics"
+# How often the scheduler checks for due jobs
+TICK_SECONDS = 5
+
+# Releases a lock only if it is still held by the run that took it
+RELEASE_LOCK_SCRIPT = redis_client.register_script("""
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+""")
+
+
+class JobAlreadyRunning(Exception):
+    pass
+
+
+class Job:
+    """
+    A function run every interval seconds (plus up to jitter seconds, so jobs started together drift apart).
+    The interval can be overridden with the JOB_<NAME>_INTERVAL environment variable, and a job disabled by
+    listing its name in DISABLED_JOBS.
+
+    The function runs in an app context and may return a dict of stats, "items" and "failures" are recorded
+    in the job's metrics when present
+    """
+
+    def __init__(self, name: str, func: Callable[[], Optional[dict]], interval: int, jitter: int = 0, timeout: int = None):
+        self.name = name
+        self.func = func
+        self.interval = int(os.environ.get(f"JOB_{name.upper()}_INTERVAL", interval))
+        self.jitter = jitter
+        # A run holding the lock for longer than this is assumed dead
+        self.timeout = timeout or max(self.interval, 60)
+        self.enabled = name not in os.environ.get("DISABLED_JOBS", "").split(",")
+        self.next_check = 0
+
+    def due(self, now: float) -> bool:
+        if not self.enabled or now < self.next_check:
+            return False
+        # The last run is shared so that several processes keep to one schedule
+        last_run = redis_client.hget(LAST_RUN_KEY, self.name)
+        if last_run is not None and now - float(last_run) < self.interval:
+            self.next_check = float(last_run) + self.interval + random.uniform(0, self.jitter)
+            return False
+        return True
+
+
+jobs: Dict[str, Job] = {}
+
+
+def register_job(name: str, func: Callable[[], Optional[dict]], interval: int, jitter: int = 0, timeout: int = None):
+    jobs[name] = Job(name, func, interval, jitter, timeout)
+
+
+def run_job(name: str) -> dict:
+    """
+    Runs a registered job now, in the current app context. Raises JobAlreadyRunning if a run of the job
+    is in progress anywhere. Exceptions of the job are recorded and re-raised
+    """
+    job = jobs[name]
+    token = f"{os.getpid()}:{random.random()}"
+    lock = f"{LOCK_KEY}:{name}"
+    if not redis_client.set(lock, token, nx=True, ex=job.timeout):
+        raise JobAlreadyRunning(name)
+
+    start = time.time()
+    redis_client.hset(LAST_RUN_KEY, name, start)
+    metrics_key = f"{METRICS_KEY}:{name}"
+    try:
+        result = job.func() or {}
+    except Exception as e:
+        db.session.rollback()
+        _record(metrics_key, start, failed=True, error=str(e))
+        raise
+    else:
+        _record(metrics_key, start, items=result.get("items"), failures=result.get("failures"))
+        return result
+    finally:
+        RELEASE_LOCK_SCRIPT(keys=[lock], args=[token])
+
+
+def _record(metrics_key: str, start: float, failed: bool = False, error: str = None, items: int = None, failures: int = None):
+    duration = round(time.time() - start, 2)
+    pipe = redis_client.pipeline()
+    pipe.hincrby(metrics_key, "runs", 1)
+    pipe.hset(metrics_key, mapping={
+        "last_start": int(start),
+        "last_duration_seconds": duration,
+        "last_status": "failed" if failed else "ok",
+        "last_items": items if items is not None else "",
+        "last_failures": failures if failures is not None else "",
+    })
+    if failed:
+        pipe.hincrby(metrics_key, "failed_runs", 1)
+        pipe.hset(metrics_key, "last_error", error[:500])
+    pipe.execute()
+
+
+def job_metrics() -> dict:
+    metrics = {}
+    for name, job in jobs.items():
+        raw = {k.decode(): v.decode() for k, v in redis_client.hgetall(f"{METRICS_KEY}:{name}").items()}
+        metrics[name] = {
+            "enabled": job.enabled,
+            "interval_seconds": job.interval,
+            "running": bool(redis_client.exists(f"{LOCK_KEY}:{name}")),
+            "runs": int(raw.get("runs", 0)),
+            "failed_runs": int(raw.get("failed_runs", 0)),
+            "last_start": int(raw["last_start"]) if raw.get("last_start") else None,
+            "last_duration_seconds": float(raw["last_duration_seconds"]) if raw.get("last_duration_seconds") else None,
+            "last_status": raw.get("last_status"),
+            "last_items": int(raw["last_items"]) if raw.get("last_items") else None,
+            "last_failures": int(raw["last_failures"]) if raw.get("last_failures") else None,
+            "last_error": raw.get("last_error"),
+        }
+    return metrics
+
+
+def _run_in_background(app, name: str):
+    with app.app_context():
+        try:
+            run_job(name)
+        except JobAlreadyRunning:
+            pass
+        except Exception:
+            print(f"Job {name} failed: {traceback.format_exc()}", file=sys.stderr)
+        finally:
+            # The session belongs to this task, unlike when run_job is called from a request
+            db.session.remove()
+
+
+def run_scheduler(app):
+    # Don't start every job at the same moment when the app starts
+    for job in jobs.values():
+        job.next_check = time.time() + random.uniform(0, job.jitter)
+
+    while True:
+        now = time.time()
+        for job in jobs.values():
+            try:
+                if job.due(now) and not redis_client.exists(f"{LOCK_KEY}:{job.name}"):
+                    job.next_check = now + job.interval + random.uniform(0, job.jitter)
+                    socketio.start_background_task(_run_in_background, app, job.name)
+            except Exception as e:
+                print(f"Scheduler error checking {job.name}: {str(e)}", file=sys.stderr)
+        socketio.sleep(TICK_SECONDS)
+
+
+def start_scheduler(app):
+    socketio.start_background_task(run_scheduler, app)
@@ -0,0 +1,8 @@
+from app.scheduler import register_job
+from app.transportopendata.routes import collect_parking_data, sync_parking_lots
+
+
+def register_jobs():
+    # Matches the sample interval the parking queries assume
+    register_job("parking_data", collect_parking_data, interval=300, jitter=10)
+    register_job("parking_lots", sync_parking_lots, interval=86400, jitter=600)
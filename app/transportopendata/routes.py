@@ -1,20 +1,33 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import sys
 from typing import List
-from flask import jsonify, request
+from flask import current_app, jsonify, request
 import requests
-from app.models.transportopendata import ParkingData, ParkingLot, query_parking_data,query_min_and_max_parking, ServiceInfoSchema, InfosSchema
+from app.models.transportopendata import (ParkingData, ParkingLot, query_parking_data, query_min_and_max_parking, ServiceInfoSchema, InfosSchema,
+                                          query_parking_profile, query_profile_slots, profile_slot,
+                                          PROFILE_SLOT_MINUTES, PROFILE_TIMEZONE)
 from app.transportopendata import bp
-from app.extensions import db, roles_required, limiter
+from app.extensions import db, roles_required, limiter, redis_client
 from config import Config
 from zoneinfo import ZoneInfo
 from app.analytics.routes import parse_datetime
+from app.cache import stale_while_revalidate
+from app.scheduler import JobAlreadyRunning, run_job
 
 API_KEY = f"apikey {Config.OPEN_DATA_TOKEN}"
 BASE_URL = "https://api.transport.nsw.gov.au/v1/carpark"
 headers = {
     "Authorization": API_KEY,
 }
+PARKING_LAST_STORED_KEY = "parking:last_stored"
+
+SERVICE_INFO_URL = "https://api.transport.nsw.gov.au/v1/tp/add_info"
+SERVICE_INFO_CACHE_KEY = "transport:service_info"
+# Alerts are served from cache for a minute, then refreshed in the background for up to 10 more
+SERVICE_INFO_FRESH_SECONDS = 60
+SERVICE_INFO_STALE_SECONDS = 600
+# How long the current deviation from the typical occupancy is assumed to persist
+EXPECTED_ANOMALY_HORIZON_MINUTES = 120
 
 @bp.route('', methods=['GET'])
 @limiter.limit('40/minute', override_defaults=True)
@@ -27,43 +40,55 @@ def get_latest_parking():
 def set_parking_lots():
     '''
     Calls the baseurl of the parking API to get a list of parking lots and updates the table accordingly
-    '''    
+    '''
+    try:
+        run_job("parking_lots")
+    except JobAlreadyRunning:
+        return jsonify({"success": False, "error": "Parking lots are already being updated"}), 409
+    except requests.HTTPError as e:
+        return jsonify({"error": f"Request failed with status {e.response.status_code}", "details": e.response.text}), e.response.status_code
+    return jsonify([lot.to_dict() for lot in ParkingLot.query.all()])
+
+def sync_parking_lots():
+    '''
+    Updates the parking lots table from the list of parking lots of the API. Scheduled as the parking_lots job
+    '''
     response = requests.get(BASE_URL, headers=headers)
-    if response.status_code == 200:
-        data = response.json()
-        for facility_id, name in data.items():
-            # Skip IDs 5 and lower because they are historical only
-            if int(facility_id) <= 5:
-                continue
-            
-            # Query for to get the latest capacity and spots
-            parking_data_response = requests.get(f"{BASE_URL}?facility={facility_id}", headers=headers)
-            if parking_data_response.status_code != 200:
-                 continue
-            
-            parking_data = parking_data_response.json()
-            
-            occupancy = parking_data["occupancy"]["total"]
-            capacity = parking_data["spots"]
-
-            # Check if the parking lot exists
-            parking_lot = db.session.query(ParkingLot).filter_by(facility_id=facility_id).first()
-            if parking_lot:
-                parking_lot.name = name
-                parking_lot.occupancy = occupancy
-                parking_lot.capacity = capacity
-            else:
-                parking_lot = ParkingLot(facility_id=int(facility_id), name=name, occupancy=occupancy, capacity=capacity)
-                db.session.add(parking_lot)
-            db.session.commit()
-        return jsonify([lot.to_dict() for lot in ParkingLot.query.all()])
-    else:
-        return jsonify({"error": f"Request failed with status {response.status_code}", "details": response.text}), response.status_code
-    
+    response.raise_for_status()
+
+    data = response.json()
+    updated = 0
+    for facility_id, name in data.items():
+        # Skip IDs 5 and lower because they are historical only
+        if int(facility_id) <= 5:
+            continue
+
+        # Query for to get the latest capacity and spots
+        parking_data_response = requests.get(f"{BASE_URL}?facility={facility_id}", headers=headers)
+        if parking_data_response.status_code != 200:
+             continue
+
+        parking_data = parking_data_response.json()
+
+        occupancy = parking_data["occupancy"]["total"]
+        capacity = parking_data["spots"]
+
+        # Check if the parking lot exists
+        parking_lot = db.session.query(ParkingLot).filter_by(facility_id=facility_id).first()
+        if parking_lot:
+            parking_lot.name = name
+            parking_lot.occupancy = occupancy
+            parking_lot.capacity = capacity
+        else:
+            parking_lot = ParkingLot(facility_id=int(facility_id), name=name, occupancy=occupancy, capacity=capacity)
+            db.session.add(parking_lot)
+        db.session.commit()
+        updated += 1
+    return {"items": updated}
+
 @bp.route('parking_data', methods=['POST'])
 @limiter.limit('10/minute', override_defaults=True)
 def post_parking_data():
-    parking_lots: List[ParkingLot] = ParkingLot.query.all()
     post_body = request.json
 
     if 'password' not in post_body:
@@ -71,20 +96,54 @@ def post_parking_data():
     if post_body['password'] != Config.PARKING_POST_PASSWORD:
             return jsonify({"success": False, 'error': 'incorrect password'}), 400
 
+    try:
+        result = run_job("parking_data")
+    except JobAlreadyRunning:
+        return jsonify({"success": False, "error": "Parking data is already being collected"}), 409
+
+    return jsonify({"success": True, "stored": result["stored"]}), 201
+
+def collect_parking_data():
+    '''
+    Records the current occupancy of every parking lot. Scheduled as the parking_data job
+    '''
+    parking_lots: List[ParkingLot] = ParkingLot.query.all()
+
+    # Last stored occupancy per facility, stored as "occupancy:unix timestamp"
+    last_stored = {int(k): v.decode().split(":") for k, v in redis_client.hgetall(PARKING_LAST_STORED_KEY).items()}
+    keyframe_seconds = Config.PARKING_KEYFRAME_MINUTES * 60
+    stored = {}
+    failures = 0
+
     for parking_lot in parking_lots:
         response = requests.get(f"{BASE_URL}?facility={parking_lot.facility_id}", headers=headers)
         if response.status_code != 200:
+            failures += 1
             continue
         data = response.json()
         timestamp = datetime.now(ZoneInfo("UTC"))
-        facility_id = data["facility_id"]  
+        facility_id = int(data["facility_id"])
         occupancy = data["occupancy"]["total"]
+        # Keep the latest occupancy on the lot so reads don't need to touch parking_data
+        parking_lot.occupancy = occupancy
+
+        # Unchanged readings are skipped, queries carry the previous reading forward.
+        # A keyframe is still written periodically so that lookback stays bounded
+        previous = last_stored.get(facility_id)
+        if Config.PARKING_CHANGE_ONLY and previous is not None:
+            previous_occupancy, previous_time = int(previous[0]), int(previous[1])
+            if previous_occupancy == occupancy and timestamp.timestamp() - previous_time < keyframe_seconds:
+                continue
+
         parking_data = ParkingData(timestamp=timestamp, facility_id=facility_id, occupancy=occupancy)
         db.session.add(parking_data)
-        db.session.commit()
-    
-    return jsonify({"success": True}), 201
+        stored[facility_id] = f"{occupancy}:{int(timestamp.timestamp())}"
 
+    db.session.commit()
+    if stored:
+        redis_client.hset(PARKING_LAST_STORED_KEY, mapping=stored)
+
+    return {"stored": len(stored), "items": len(parking_lots) - failures, "failures": failures}
 
 @bp.route('parking_data/<int:facility_id>', methods=['GET'])
 @limiter.limit('30/minute', override_defaults=True)
@@ -122,26 +181,106 @@ def get_parking_data(facility_id):
 
     return jsonify(response), 200
 
+@bp.route('parking_profile/<int:facility_id>', methods=['GET'])
+@limiter.limit('30/minute', override_defaults=True)
+def get_parking_profile(facility_id):
+    '''
+    Returns the typical occupancy (mean, p10, p90) of a facility for each day of week and time of day.
+    Optionally filter to a single ISO day of week (1 = Monday, 7 = Sunday) with 'day'
+    '''
+    day = request.args.get('day', type=int)
+    if day is not None and not 1 <= day <= 7:
+        return jsonify({"success": False, "error": "'day' must be an integer between 1-7"}), 400
+
+    facility = db.session.query(ParkingLot).filter_by(facility_id=facility_id).first()
+    if not facility:
+        return jsonify({"success": False, "error": "Facility ID not found"}), 404
+
+    response = {
+        "facility_id": facility_id,
+        "facility_name": facility.name,
+        "capacity": facility.capacity,
+        "timezone": PROFILE_TIMEZONE,
+        "slot_minutes": PROFILE_SLOT_MINUTES,
+        "profile": query_parking_profile(facility_id, day)
+    }
+
+    return jsonify(response), 200
+
+@bp.route('parking_profile/<int:facility_id>/expected', methods=['GET'])
+@limiter.limit('30/minute', override_defaults=True)
+def get_expected_occupancy(facility_id):
+    '''
+    Estimates the occupancy of a facility in 'minutes' minutes (default 60, max 1440).
+    The typical occupancy of the target slot is shifted by how far the facility currently
+    is from its typical occupancy, with that deviation fading out over a couple of hours
+    '''
+    minutes = request.args.get('minutes', default=60, type=int)
+    if minutes is None or not 0 <= minutes <= 1440:
+        return jsonify({"success": False, "error": "'minutes' must be an integer between 0-1440"}), 400
+
+    facility = db.session.query(ParkingLot).filter_by(facility_id=facility_id).first()
+    if not facility:
+        return jsonify({"success": False, "error": "Facility ID not found"}), 404
+
+    now = datetime.now(ZoneInfo("UTC"))
+    target_time = now + timedelta(minutes=minutes)
+    current_key = profile_slot(now)
+    target_key = profile_slot(target_time)
+
+    slots = query_profile_slots(facility_id, [current_key, target_key])
+    current_profile = slots.get(current_key)
+    target_profile = slots.get(target_key)
+    if not target_profile:
+        return jsonify({"success": False, "error": "No occupancy profile exists for this facility yet"}), 404
+
+    expected = target_profile["mean"]
+    if current_profile:
+        weight = max(0.0, 1 - minutes / EXPECTED_ANOMALY_HORIZON_MINUTES)
+        expected += (facility.occupancy - current_profile["mean"]) * weight
+    expected = min(max(round(expected), 0), facility.capacity)
+
+    response = {
+        "facility_id": facility_id,
+        "capacity": facility.capacity,
+        "latest_occupancy": facility.occupancy,
+        "time": target_time.isoformat(),
+        "expected_occupancy": expected,
+        "typical_p10": target_profile["p10"],
+        "typical_p90": target_profile["p90"]
+    }
+
+    return jsonify(response), 200
+
 @bp.route('service_info', methods=['GET'])
 @limiter.limit('30/minute', override_defaults=True)
 def get_service_info():
-    lines = request.args.getlist('line')
+    lines = sorted(set(request.args.getlist('line')))
 
-    SERVICE_INFO_URL = "https://api.transport.nsw.gov.au/v1/tp/add_info"
+    def fetch_service_info():
+        params = {
+             "version": "10.2.2.48",
+             "itdLPxx_selLine": lines,
+             "filterPublicationStatus": "current"
+        }
 
-    params = {
-         "version": "10.2.2.48",
-         "itdLPxx_selLine": lines,
-         "filterPublicationStatus": "current"
-    }
+        response = requests.get(SERVICE_INFO_URL, params=params, headers=headers)
+        response.raise_for_status()
+
+        schema = ServiceInfoSchema()
+        data = schema.load(response.json())
+        return_schema = InfosSchema()
 
-    response = requests.get(SERVICE_INFO_URL, params=params, headers=headers)
+        # Cache the filtered and serialised result so cache hits skip both schema passes
+        return current_app.json.dumps(return_schema.dump(data.get("infos", {})))
 
-    if response.status_code != 200:
-        return jsonify({"error": "Failed to fetch service info"}), response.status_code
-    
-    schema = ServiceInfoSchema()
-    data = schema.load(response.json())
-    return_schema = InfosSchema()
+    try:
+        body, age = stale_while_revalidate(f"{SERVICE_INFO_CACHE_KEY}:{','.join(lines)}",
+                                           SERVICE_INFO_FRESH_SECONDS, SERVICE_INFO_STALE_SECONDS,
+                                           fetch_service_info)
+    except requests.HTTPError as e:
+        return jsonify({"error": "Failed to fetch service info"}), e.response.status_code
 
-    return jsonify(return_schema.dump(data.get("infos", {})))
+    response = current_app.response_class(body, mimetype="application/json")
+    response.headers["Age"] = str(age)
+    return response
@@ -0,0 +1,136 @@
+"""
+Compares per player history fetch latency (the /clashofclans/player_data/<tag> query) between
+ - plain: coc_player_historical_data as it was, a plain table with only a serial primary key
+ - plain_indexed: the same table with a (tag, timestamp DESC) index
+ - hypertable: a hypertable with the (tag, timestamp DESC) index and chunks older than 60 days compressed (segmentby tag)
+
+Tables are created in a scratch schema of the database at DB_URL (needs timescaledb) and dropped afterwards.
+
+python benchmarks/coc_player_history.py --players 50 --years 3 --interval "6 hours"
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import psycopg2
+
+SCHEMA = "bench_coc_history"
+
+COLUMNS = """
+    timestamp TIMESTAMPTZ NOT NULL,
+    tag VARCHAR(15) NOT NULL,
+    town_hall_level INTEGER NOT NULL,
+    exp_level INTEGER NOT NULL,
+    trophies INTEGER NOT NULL,
+    war_stars INTEGER NOT NULL,
+    donations INTEGER NOT NULL,
+    troops JSONB NOT NULL,
+    heroes JSONB NOT NULL,
+    achievements JSONB NOT NULL
+"""
+
+
+def create_tables(cur):
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+    cur.execute(f"CREATE SCHEMA {SCHEMA};")
+
+    cur.execute(f"CREATE TABLE {SCHEMA}.plain (id SERIAL PRIMARY KEY, {COLUMNS});")
+    cur.execute(f"CREATE TABLE {SCHEMA}.plain_indexed (id SERIAL PRIMARY KEY, {COLUMNS});")
+    cur.execute(f"CREATE INDEX ON {SCHEMA}.plain_indexed (tag, timestamp DESC);")
+
+    cur.execute(f"CREATE TABLE {SCHEMA}.hypertable (id SERIAL, {COLUMNS}, PRIMARY KEY (id, timestamp));")
+    cur.execute(f"SELECT create_hypertable('{SCHEMA}.hypertable', 'timestamp', chunk_time_interval => INTERVAL '30 days');")
+    cur.execute(f"CREATE INDEX ON {SCHEMA}.hypertable (tag, timestamp DESC);")
+    cur.execute(f"""
+        ALTER TABLE {SCHEMA}.hypertable SET (
+            timescaledb.compress,
+            timescaledb.compress_segmentby = 'tag',
+            timescaledb.compress_orderby = 'timestamp DESC'
+        );
+    """)
+
+
+def load_data(cur, players: int, years: int, interval: str):
+    # Levels drift over time so consecutive snapshots differ like real upgrades do
+    cur.execute(f"""
+        INSERT INTO {SCHEMA}.plain (timestamp, tag, town_hall_level, exp_level, trophies, war_stars, donations, troops, heroes, achievements)
+        SELECT
+            ts,
+            '#P' || p,
+            8 + (extract(epoch FROM ts - (now() - INTERVAL '{years} years')) / 31536000 * 3)::INTEGER,
+            100 + (extract(epoch FROM ts) / 86400)::INTEGER % 150,
+            4000 + (random() * 1500)::INTEGER,
+            500 + (extract(epoch FROM ts) / 3600)::INTEGER % 1000,
+            (random() * 2000)::INTEGER,
+            (SELECT jsonb_agg(jsonb_build_object('name', 'Troop ' || i, 'level', 1 + (i + extract(doy FROM ts)::INTEGER / 30) % 12)) FROM generate_series(1, 60) i),
+            (SELECT jsonb_agg(jsonb_build_object('name', 'Hero ' || i, 'level', 40 + extract(doy FROM ts)::INTEGER / 7)) FROM generate_series(1, 6) i),
+            (SELECT jsonb_agg(jsonb_build_object('name', 'Achievement ' || i, 'value', (extract(epoch FROM ts) / 3600)::INTEGER * i)) FROM generate_series(1, 40) i)
+        FROM generate_series(1, {players}) p,
+             generate_series(now() - INTERVAL '{years} years', now(), INTERVAL '{interval}') ts;
+    """)
+    cur.execute(f"INSERT INTO {SCHEMA}.plain_indexed SELECT * FROM {SCHEMA}.plain;")
+    cur.execute(f"INSERT INTO {SCHEMA}.hypertable SELECT * FROM {SCHEMA}.plain;")
+    cur.execute(f"SELECT compress_chunk(c, if_not_compressed => TRUE) FROM show_chunks('{SCHEMA}.hypertable', older_than => INTERVAL '60 days') c;")
+
+    for table in ["plain", "plain_indexed", "hypertable"]:
+        cur.execute(f"ANALYZE {SCHEMA}.{table};")
+
+    cur.execute(f"SELECT count(*) FROM {SCHEMA}.plain;")
+    return cur.fetchone()[0]
+
+
+def time_fetches(cur, table: str, tags: list, days: int, runs: int):
+    end = datetime.now(ZoneInfo("UTC"))
+    start = end - timedelta(days=days)
+    timings = []
+    for _ in range(runs):
+        for tag in tags:
+            t = time.perf_counter()
+            cur.execute(f"""
+                SELECT * FROM {SCHEMA}.{table}
+                WHERE tag = %s AND timestamp >= %s AND timestamp <= %s
+                ORDER BY timestamp ASC;
+            """, (tag, start, end))
+            cur.fetchall()
+            timings.append((time.perf_counter() - t) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--players", type=int, default=50)
+    arg_parser.add_argument("--years", type=int, default=3)
+    arg_parser.add_argument("--interval", default="6 hours", help="time between snapshots of a player")
+    arg_parser.add_argument("--sample", type=int, default=10, help="players to fetch history for")
+    arg_parser.add_argument("--runs", type=int, default=5)
+    arg_parser.add_argument("--keep", action="store_true", help="don't drop the scratch schema")
+    args = arg_parser.parse_args()
+
+    conn = psycopg2.connect(os.environ["DB_URL"])
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    try:
+        create_tables(cur)
+        rows = load_data(cur, args.players, args.years, args.interval)
+        print(f"{rows} snapshots ({args.players} players, {args.years} years, every {args.interval})")
+
+        tags = [f"#P{p}" for p in random.sample(range(1, args.players + 1), min(args.sample, args.players))]
+        for days in [30, 365, 365 * args.years]:
+            print(f"\nHistory of the last {days} days")
+            for table in ["plain", "plain_indexed", "hypertable"]:
+                median, p95 = time_fetches(cur, table, tags, days, args.runs)
+                print(f"  {table:<15} median {median:8.2f} ms   p95 {p95:8.2f} ms")
+    finally:
+        if not args.keep:
+            cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        cur.close()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
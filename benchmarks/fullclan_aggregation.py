@@ -0,0 +1,265 @@
+"""
+Compares the /clashofclans/fullclan/<tag> member aggregation before and after indexing
+ - legacy: the previous per member loop (next() scans of every roster, CWL rounds rebuilt per member)
+ - indexed: app.clashofclans.fullclan.build_full_clan
+
+Runs on a generated fixture shaped like the API responses: a 50 member clan during CWL week
+(7 rounds of 8 clans, the last round in progress), an ongoing capital raid and a regular war.
+Both implementations must produce identical output.
+
+Run from the repository root, in the flask container so the app package can be imported:
+python -m benchmarks.fullclan_aggregation --members 50 --rounds 7 --runs 200
+"""
+import argparse
+import copy
+import json
+import random
+import statistics
+import time
+from app.clashofclans.fullclan import build_full_clan
+
+CLAN_TAG = "#220QP2GGU"
+
+
+def make_fixture(members: int, rounds: int, seed: int = 0):
+    rng = random.Random(seed)
+    player_tags = [f"#P{i:07d}" for i in range(members)]
+
+    def roster(tags, clan_tag, state):
+        roster_members = []
+        for position, tag in enumerate(tags, start=1):
+            member = {
+                "tag": tag,
+                "name": f"Player {tag}",
+                "townhallLevel": rng.randint(12, 17),
+                "mapPosition": position,
+                "opponentAttacks": rng.randint(0, 2),
+            }
+            if member["opponentAttacks"]:
+                member["bestOpponentAttack"] = {
+                    "attackerTag": "#OPP", "defenderTag": tag, "stars": rng.randint(0, 3),
+                    "destructionPercentage": rng.randint(0, 100), "order": 1, "duration": rng.randint(30, 180)
+                }
+            if state == "warEnded" or rng.random() < 0.5:
+                member["attacks"] = [{
+                    "attackerTag": tag, "defenderTag": "#OPP", "stars": rng.randint(0, 3),
+                    "destructionPercentage": rng.randint(0, 100), "order": position, "duration": rng.randint(30, 180)
+                }]
+            roster_members.append(member)
+        return {
+            "tag": clan_tag, "name": f"Clan {clan_tag}", "attacks": rng.randint(0, 15), "stars": rng.randint(0, 45),
+            "destructionPercentage": rng.uniform(0, 100), "members": roster_members
+        }
+
+    clan = {
+        "tag": CLAN_TAG,
+        "name": "Clan",
+        "memberList": [{"tag": tag, "name": f"Player {tag}", "role": "member"} for tag in player_tags]
+    }
+
+    capital_data = {
+        "state": "ongoing",
+        "members": [
+            {"tag": tag, "name": f"Player {tag}", "attacks": rng.randint(1, 6), "capitalResourcesLooted": rng.randint(0, 30000)}
+            for tag in player_tags if rng.random() < 0.8
+        ]
+    }
+
+    war_data = {
+        "state": "inWar",
+        "clan": roster(rng.sample(player_tags, 30), CLAN_TAG, "inWar"),
+        "opponent": roster([f"#R{i:07d}" for i in range(30)], "#REGULAR", "inWar")
+    }
+
+    # Each round has 4 wars between the 8 clans of the group, one of them ours
+    cwl_wars = []
+    for r in range(rounds):
+        state = "inWar" if r == rounds - 1 else "warEnded"
+        for w in range(4):
+            ours = w == 0
+            side = roster(rng.sample(player_tags, 15), CLAN_TAG, state) if ours else \
+                roster([f"#G{r}{w}{i:05d}" for i in range(15)], f"#GROUP{r}{w}A", state)
+            other = roster([f"#O{r}{w}{i:05d}" for i in range(15)], f"#GROUP{r}{w}B", state)
+            # Our clan is listed as the opponent in half of the wars
+            clan_side, opponent_side = (other, side) if ours and r % 2 else (side, other)
+            cwl_wars.append({
+                "state": state, "teamSize": 15, "startTime": f"2024010{r + 1}T080000.000Z",
+                "clan": clan_side, "opponent": opponent_side, "war_tag": f"%23W{r}{w}"
+            })
+
+    return clan, war_data, capital_data, cwl_wars
+
+
+def legacy_build_full_clan(tag, clan, war_data, capital_data, cwl_wars):
+    clan["war"] = war_data
+    clan["cwl_wars"] = cwl_wars
+    clan["capital_raid_data"] = capital_data
+
+    for member in clan["memberList"]:
+        if capital_data and capital_data.get("state") == "ongoing":
+            capital_player = next((p for p in capital_data["members"] if p["tag"] == member["tag"]), None)
+            if capital_player:
+                member["clan_capital"] = {
+                    "attacks": capital_player.get("attacks", 0),
+                    "capitalResourcesLooted": capital_player.get("capitalResourcesLooted", 0)
+                }
+            else:
+                member["clan_capital"] = None
+        else:
+            member["clan_capital"] = None
+
+        if war_data and war_data.get("state") == "inWar":
+            war_player = next((p for p in war_data["clan"]["members"] if p["tag"] == member["tag"]), None)
+            if war_player:
+                member["war"] = {
+                    "attacks": len(war_player.get("attacks", []))
+                }
+            else:
+                member["war"] = None
+        else:
+            member["war"] = None
+
+        tag = tag.replace("%23", "#")
+        if cwl_wars:
+            attacks = 0
+            attack_limit = 0
+            total_destruction = 0
+            total_stars = 0
+            total_duration = 0
+            attack_todo = False
+            defends = 0
+            defends_stars = 0
+            defends_total_destruction = 0
+            defends_total_duration = 0
+            for war in cwl_wars:
+                if war.get("state") == "preparation":
+                    continue
+                warMembers = None
+                if war.get("clan").get("tag") == tag:
+                    warMembers = war.get("clan").get("members")
+                elif war.get("opponent").get("tag") == tag:
+                    warMembers = war.get("opponent").get("members")
+                else:
+                    continue
+
+                war_player = next((p for p in warMembers if p["tag"] == member["tag"]), None)
+
+                if war_player:
+                    attack_limit += 1
+                    if war_player.get("attacks") and len(war_player.get("attacks")) == 1:
+                        attack_info = war_player.get("attacks")[0]
+                        attacks += 1
+                        total_destruction += attack_info.get("destructionPercentage")
+                        total_stars += attack_info.get("stars")
+                        total_duration += attack_info.get("duration")
+                    elif war.get("state") == "inWar":
+                        attack_todo = True
+
+                    if war_player.get("opponentAttacks") > 0:
+                        defends += war_player.get("opponentAttacks")
+                        if war_player.get("bestOpponentAttack"):
+                            best_attack = war_player.get("bestOpponentAttack")
+                            defends_stars += best_attack.get("stars")
+                            defends_total_destruction += best_attack.get("destructionPercentage")
+                            defends_total_duration += best_attack.get("duration")
+            member["cwl_war"] = {
+                "attacks": attacks,
+                "attack_limit": attack_limit,
+                "total_destruction": total_destruction,
+                "total_stars": total_stars,
+                "total_duration": total_duration,
+                "attack_todo": attack_todo,
+                "defends": defends,
+                "defends_stars": defends_stars,
+                "defends_total_destruction": defends_total_destruction,
+                "defends_total_duration": defends_total_duration
+            }
+        else:
+            member["cwl_war"] = None
+
+        if cwl_wars:
+            cwl_war_rounds = []
+            for war in cwl_wars:
+                war_tag = war.get("war_tag").replace("%23", "#")
+                if war.get("opponent").get("tag") == tag:
+                    opponent = war.get("clan").get("name")
+                    opponent_tag = war.get("clan").get("tag")
+                    opponent_attacks = war.get("clan").get("attacks")
+                    opponent_stars = war.get("clan").get("stars")
+                    opponent_destruction_percentage = war.get("clan").get("destructionPercentage")
+                    clan_name = war.get("opponent").get("name")
+                    clan_tag = tag
+                    clan_attacks = war.get("opponent").get("attacks")
+                    clan_stars = war.get("opponent").get("stars")
+                    clan_destruction_percentage = war.get("opponent").get("destructionPercentage")
+                else:
+                    opponent = war.get("opponent").get("name")
+                    opponent_tag = war.get("opponent").get("tag")
+                    opponent_attacks = war.get("opponent").get("attacks")
+                    opponent_stars = war.get("opponent").get("stars")
+                    opponent_destruction_percentage = war.get("opponent").get("destructionPercentage")
+                    clan_name = war.get("clan").get("name")
+                    clan_tag = war.get("clan").get("tag")
+                    clan_attacks = war.get("clan").get("attacks")
+                    clan_stars = war.get("clan").get("stars")
+                    clan_destruction_percentage = war.get("clan").get("destructionPercentage")
+
+                cwl_war_rounds.append({
+                    "war_tag": war_tag,
+                    "clan": clan_name,
+                    "clan_tag": clan_tag,
+                    "clan_attacks": clan_attacks,
+                    "clan_stars": clan_stars,
+                    "clan_destruction_percentage": clan_destruction_percentage,
+                    "opponent": opponent,
+                    "opponent_tag": opponent_tag,
+                    "opponent_attacks": opponent_attacks,
+                    "opponent_stars": opponent_stars,
+                    "opponent_destruction_percentage": opponent_destruction_percentage,
+                    "state": war.get("state"),
+                    "team_size": war.get("teamSize"),
+                })
+            clan["cwl_war_rounds"] = cwl_war_rounds
+        else:
+            clan["cwl_war_rounds"] = None
+
+    return clan
+
+
+def time_build(build, fixture, runs: int):
+    timings = []
+    for _ in range(runs):
+        # Copying isn't timed, both implementations modify the clan in place
+        clan, war_data, capital_data, cwl_wars = copy.deepcopy(fixture)
+        t = time.perf_counter()
+        build(CLAN_TAG.replace("#", "%23"), clan, war_data, capital_data, cwl_wars)
+        timings.append((time.perf_counter() - t) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95) - 1]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--members", type=int, default=50)
+    arg_parser.add_argument("--rounds", type=int, default=7)
+    arg_parser.add_argument("--runs", type=int, default=200)
+    arg_parser.add_argument("--fixture", help="JSON file to write the generated fixture to")
+    args = arg_parser.parse_args()
+
+    fixture = make_fixture(args.members, args.rounds)
+    if args.fixture:
+        with open(args.fixture, "w") as f:
+            json.dump(fixture, f)
+
+    legacy = legacy_build_full_clan(CLAN_TAG.replace("#", "%23"), *copy.deepcopy(fixture))
+    indexed = build_full_clan(CLAN_TAG.replace("#", "%23"), *copy.deepcopy(fixture))
+    assert json.dumps(legacy) == json.dumps(indexed), "indexed output differs from legacy output"
+
+    print(f"{args.members} members, {args.rounds} CWL rounds ({len(fixture[3])} wars), {args.runs} runs")
+    for name, build in [("legacy", legacy_build_full_clan), ("indexed", build_full_clan)]:
+        median, p95 = time_build(build, fixture, args.runs)
+        print(f"  {name:<8} median {median:8.3f} ms   p95 {p95:8.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -18,4 +18,29 @@ class Config:
     WEATHER_POST_PASSWORD = os.environ.get("WEATHER_POST_PASSWORD")
     COC_BEARER_TOKEN = os.environ.get("COC_BEARER_TOKEN")
     OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+    # Combined request rate (and burst) against the CoC API of the web app and the discord bot, shared through Redis
+    COC_API_REQUESTS_PER_SECOND = int(os.environ.get("COC_API_REQUESTS_PER_SECOND", 10))
+    COC_API_BURST = int(os.environ.get("COC_API_BURST", COC_API_REQUESTS_PER_SECOND))
+    # Comma separated player tags to keep collecting snapshots for even when they aren't in the tracked clan
+    COC_EXTRA_TRACKED_PLAYERS = [t.strip() for t in os.environ.get("COC_EXTRA_TRACKED_PLAYERS", "").split(",") if t.strip()]
+    # Clans added to the tracked clan registry on startup (more can be added through /clashofclans/tracked_clans).
+    # Tracked clans have their members' data collected and their /fullclan data served from a background refreshed snapshot
+    COC_TRACKED_CLANS = [t.strip() for t in os.environ.get("COC_TRACKED_CLANS", "#220QP2GGU").split(",") if t.strip()]
+    # How often each tracked clan's member snapshots and each player's activity are collected, the work is spread
+    # evenly over the interval so more clans don't raise the peak request rate
+    COC_SNAPSHOT_INTERVAL_SECONDS = int(os.environ.get("COC_SNAPSHOT_INTERVAL_SECONDS", 3600))
+    COC_ACTIVITY_INTERVAL_SECONDS = int(os.environ.get("COC_ACTIVITY_INTERVAL_SECONDS", 300))
+    # Most players polled for activity per collection tick (a minute), past this the interval stretches instead
+    COC_ACTIVITY_MAX_PLAYERS_PER_TICK = int(os.environ.get("COC_ACTIVITY_MAX_PLAYERS_PER_TICK", 200))
+    # Upstream requests a single tracked clan may use per day (UTC), collection for the clan pauses once it is reached
+    COC_CLAN_DAILY_REQUEST_QUOTA = int(os.environ.get("COC_CLAN_DAILY_REQUEST_QUOTA", 5000))
+    COC_FULLCLAN_REFRESH_SECONDS = int(os.environ.get("COC_FULLCLAN_REFRESH_SECONDS", 120))
+    # How often buffered player profile views are written to Postgres
+    COC_VIEW_COUNT_FLUSH_SECONDS = int(os.environ.get("COC_VIEW_COUNT_FLUSH_SECONDS", 60))
+    # Run the job scheduler in this process, job intervals can be overridden with JOB_<NAME>_INTERVAL (seconds)
+    # and jobs disabled by listing them in DISABLED_JOBS
+    BACKGROUND_JOBS = os.environ.get("BACKGROUND_JOBS", "true").lower() == "true"
+    # Only store parking readings when occupancy changes, with a full keyframe at least every N minutes
+    PARKING_CHANGE_ONLY = os.environ.get("PARKING_CHANGE_ONLY", "true").lower() == "true"
+    PARKING_KEYFRAME_MINUTES = int(os.environ.get("PARKING_KEYFRAME_MINUTES", 60))
 
@@ -12,13 +12,14 @@ from typing import List, Tuple, Optional
 from datetime import datetime, timedelta, timezone
 from collections import Counter
 from clash_events import get_clash_events
+from upstream_quota import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, coc_quota
 import matplotlib.pyplot as plt
 import pandas as pd
 import io
 from dateutil import parser
 
 BASE_URL = "http://flask_app:5000"
-DEFAULT_CLAN_TAG = "#220QP2GGU"
+DEFAULT_CLAN_TAG = os.getenv("COC_DEFAULT_CLAN_TAG", "#220QP2GGU")
 MAX_EMBED_FIELD_LENGTH = 1024
 COC_BEARER_TOKEN = os.getenv("COC_BEARER_TOKEN")
 COC_PROXY_URL = "https://cocproxy.royaleapi.dev/v1"
@@ -104,7 +105,8 @@ async def get_current_clan_war(data: dict) -> Tuple[Optional[dict], int]:
 
     return None, 0
 
-async def create_clan_war_embed(data, clan_war, max_attacks: int, session: aiohttp.ClientSession):
+async def create_clan_war_embed(data, clan_war, max_attacks: int, session: aiohttp.ClientSession,
+                                priority: str = PRIORITY_INTERACTIVE):
     embed = discord.Embed(
     title=f"War Info: {data.get('name', 'Unknown')}",
     description=f"Tag: [{data.get('tag')}](https://www.ashwingur.com/ClashOfClans/clan/{data.get('tag').replace('#','')})\n{clan_war['teamSize']} vs {clan_war['teamSize']}",
@@ -122,6 +124,7 @@ async def create_clan_war_embed(data, clan_war, max_attacks: int, session: aioht
         # We also want to call the 2nd clan API to get war streak information
         encoded_tag = urllib.parse.quote(clan2["tag"])
         url = f"{COC_PROXY_URL}/clans/{encoded_tag}"
+        await coc_quota.acquire(priority)
         async with session.get(url, headers=COC_PROXY_HEADERS) as resp:
             opponent_wins = "?"
             opponent_losses = "?"
@@ -426,7 +429,7 @@ class ClashCommands(commands.Cog):
                         if should_send_end:
                             await channel.send("War reminder")
                             self.last_sent_war_end_time = end_time
-                        embed = await create_clan_war_embed(data, clan_war, max_attacks, session)
+                        embed = await create_clan_war_embed(data, clan_war, max_attacks, session, PRIORITY_BACKGROUND)
                         await channel.send(embed=embed)
 
         except Exception as e:
@@ -534,12 +537,12 @@ class ClashCommands(commands.Cog):
         cwl_only: bool = False
     ):
         """
-        Retrieves and summarizes the war attack history for specified players or a clan,
-        calculating the average stars, destruction, duration and opponent map position offset.
+        Retrieves the war leaderboard for specified players or a clan,
+        with the average stars, destruction, duration and opponent map position offset.
         """
         await interaction.response.defer()
 
-        base_path = f"{BASE_URL}/clashofclans/clan/{urllib.parse.quote(clan_tag)}/warattackhistory"
+        base_path = f"{BASE_URL}/clashofclans/clan/{urllib.parse.quote(clan_tag)}/war_leaderboard"
 
         if days <= 0:
             days = 1
@@ -550,7 +553,10 @@ class ClashCommands(commands.Cog):
         query_params = urllib.parse.urlencode({
             "player_tags": player_tags,
             "player_names": player_names,
-            "start": start_date.isoformat()
+            "start": start_date.isoformat(),
+            "war_type": "cwl" if cwl_only else "all",
+            "sort": "average_stars",
+            "limit": 100
         })
 
         full_url = f"{base_path}?{query_params}"
@@ -567,59 +573,19 @@ class ClashCommands(commands.Cog):
                         await interaction.followup.send("No attack history found for the given criteria.")
                         return
 
-
-                    # --- PRE-PROCESS DATA TO CALCULATE AVERAGES AND ADD TO PLAYER DICTS ---
-                    processed_players = []
-                    for player in data:
-                        total_stars = 0
-                        total_duration = 0
-                        total_destruction = 0
-                        total_opponent_offset = 0
-                        total_townhall_offset = 0
-                        num_attacks = 0
-
-                        for attack in player["attacks"]:
-                            if cwl_only:
-                                if not attack.get("is_cwl", False):
-                                    continue
-                            
-                            num_attacks += 1
-                            total_stars += attack["stars"]
-                            total_duration += attack["duration"]
-                            total_destruction += attack["destruction_percentage"]
-                            total_opponent_offset += (attack["map_position"] - attack["defender_map_position"])
-                            total_townhall_offset += (attack["defender_townhall"] - attack["attacker_townhall"])
-
-                        # Handle division by zero if no attacks meet criteria
-                        if num_attacks == 0:
-                            if cwl_only: continue
-                            average_stars = 0
-                            average_duration = 0
-                            average_destruction = 0
-                            average_opponent_offset = 0
-                            average_townhall_offset = 0
-                        else:
-                            average_stars = total_stars / num_attacks
-                            average_duration = total_duration / num_attacks
-                            average_destruction = total_destruction / num_attacks
-                            average_opponent_offset = total_opponent_offset / num_attacks
-                            average_townhall_offset = total_townhall_offset / num_attacks
-                        
-                        player['num_attacks'] = num_attacks
-                        player['average_stars'] = average_stars
-                        player['average_duration'] = average_duration
-                        player['average_destruction'] = average_destruction
-                        player['average_opponent_offset'] = average_opponent_offset
-                        player['average_townhall_offset'] = average_townhall_offset
-                        processed_players.append(player)
-                    
-                    
-                    if not processed_players:
-                        await interaction.followup.send("No attack history found for the given criteria.")
-                        return
-
-                    # --- SORTING BY AVERAGE STARS DESCENDING ---
-                    sorted_players = sorted(processed_players, key=lambda p: (-p["average_stars"], -p["num_attacks"], p["name"]))
+                    # Already sorted by average stars, then attacks and name
+                    sorted_players = [
+                        {
+                            **player,
+                            "num_attacks": player["attacks"],
+                            "average_stars": float(player["average_stars"]),
+                            "average_destruction": float(player["average_destruction"]),
+                            "average_duration": float(player["average_duration"]),
+                            "average_opponent_offset": float(player["average_opponent_offset"]),
+                            "average_townhall_offset": float(player["average_townhall_offset"]),
+                        }
+                        for player in data
+                    ]
 
                     # Prepare data for the table from the sorted list
                     table_data = []
@@ -929,6 +895,7 @@ class ClashCommands(commands.Cog):
 
         try:
             async with aiohttp.ClientSession() as session:
+                await coc_quota.acquire(PRIORITY_BACKGROUND)
                 async with session.get(url, headers=COC_PROXY_HEADERS) as resp:
                     if resp.status != 200:
                         return
@@ -942,6 +909,7 @@ class ClashCommands(commands.Cog):
                             encoded_player_tag = urllib.parse.quote(member["tag"])
                             player_url = f"{COC_PROXY_URL}/players/{encoded_player_tag}"
 
+                            await coc_quota.acquire(PRIORITY_BACKGROUND)
                             async with session.get(player_url, headers=COC_PROXY_HEADERS) as player_resp:
                                 if player_resp.status == 200:
                                     player_data = await player_resp.json()
@@ -1107,6 +1075,7 @@ class ClashCommands(commands.Cog):
 
         try:
             async with aiohttp.ClientSession() as session:
+                await coc_quota.acquire(PRIORITY_BACKGROUND)
                 async with session.get(url, headers=COC_PROXY_HEADERS) as resp:
                     if resp.status != 200:
                         return
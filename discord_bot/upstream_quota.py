@@ -0,0 +1,67 @@
+import asyncio
+import os
+import sys
+import redis.asyncio as redis
+
+# Same bucket as the web app (app/clashofclans/quota.py), so both processes share one request rate per upstream
+COC_UPSTREAM = "cocproxy"
+PRIORITY_INTERACTIVE = "interactive"
+PRIORITY_BACKGROUND = "background"
+RESERVED_FRACTION = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_BACKGROUND: 0.5}
+
+# Must match TOKEN_BUCKET_SCRIPT in app/clashofclans/quota.py
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+
+local wait = 0
+if tokens - 1 >= reserve then
+    tokens = tokens - 1
+else
+    wait = (reserve + 1 - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+class UpstreamQuota:
+    """
+    Distributed token bucket for an upstream API, acquire() waits until a request may be made.
+    If Redis isn't configured or reachable requests go ahead unlimited rather than failing
+    """
+
+    def __init__(self, redis_url: str, upstream: str, rate: float, capacity: int):
+        self.key = f"quota:{upstream}"
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.script = redis.from_url(redis_url).register_script(TOKEN_BUCKET_SCRIPT) if redis_url else None
+
+    async def acquire(self, priority: str = PRIORITY_INTERACTIVE):
+        if self.script is None:
+            return
+        # At least one token has to stay usable, or a bucket of capacity 1 would never serve background requests
+        reserve = min(self.capacity * RESERVED_FRACTION[priority], self.capacity - 1)
+        try:
+            while True:
+                wait = float(await self.script(keys=[self.key], args=[self.rate, self.capacity, reserve]))
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
+        except redis.RedisError as e:
+            print(f"Upstream quota unavailable, continuing without it: {e}", file=sys.stderr)
+
+
+COC_API_REQUESTS_PER_SECOND = int(os.getenv("COC_API_REQUESTS_PER_SECOND", 10))
+coc_quota = UpstreamQuota(os.getenv("REDIS_URL"), COC_UPSTREAM, COC_API_REQUESTS_PER_SECOND,
+                          int(os.getenv("COC_API_BURST", COC_API_REQUESTS_PER_SECOND)))
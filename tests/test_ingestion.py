@@ -0,0 +1,24 @@
+from unittest import mock
+from app.clashofclans import ingestion
+from app.clashofclans.ingestion import PlayerIngestion
+
+
+def test_failed_batch_is_rolled_back_and_later_batches_are_written():
+    tags = [f"#P{i}" for i in range(6)]
+    calls = []
+
+    def write(batch):
+        calls.append(len(batch))
+        if len(calls) == 1:
+            raise RuntimeError("duplicate key")
+        return len(batch)
+
+    player_ingestion = PlayerIngestion("test", workers=1, batch_size=2)
+    with mock.patch.object(PlayerIngestion, "_fetch", lambda self, tag: {"tag": tag}), \
+            mock.patch.object(ingestion, "db") as db:
+        stats = player_ingestion.run(tags, write)
+
+    db.session.rollback.assert_called_once()
+    assert calls == [2, 2, 2]
+    assert stats["write_failures"] == 2
+    assert stats["written"] == 4
@@ -0,0 +1,18 @@
+from unittest import mock
+from app.clashofclans import quota
+from app.clashofclans.quota import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, UpstreamQuota
+
+
+def reserve_used(capacity, priority):
+    with mock.patch.object(quota, "token_bucket", return_value="0") as token_bucket:
+        UpstreamQuota("test", rate=1, capacity=capacity).acquire(priority)
+    return token_bucket.call_args.kwargs["args"][2]
+
+
+def test_background_requests_can_use_a_bucket_of_one():
+    assert reserve_used(1, PRIORITY_BACKGROUND) == 0
+
+
+def test_background_requests_leave_half_the_bucket():
+    assert reserve_used(10, PRIORITY_BACKGROUND) == 5
+    assert reserve_used(10, PRIORITY_INTERACTIVE) == 0
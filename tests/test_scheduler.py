@@ -0,0 +1,13 @@
+from unittest import mock
+from app import scheduler
+
+
+def test_run_job_leaves_the_callers_session_open():
+    scheduler.register_job("test_job", lambda: {"items": 1}, interval=60)
+    with mock.patch.object(scheduler, "redis_client") as redis_client, \
+            mock.patch.object(scheduler, "RELEASE_LOCK_SCRIPT"), \
+            mock.patch.object(scheduler, "db") as db:
+        redis_client.set.return_value = True
+        assert scheduler.run_job("test_job") == {"items": 1}
+
+    db.session.remove.assert_not_called()
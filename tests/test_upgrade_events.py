@@ -0,0 +1,32 @@
+from datetime import datetime
+from types import SimpleNamespace
+from zoneinfo import ZoneInfo
+from app.models.clashofclans import find_upgrade_events
+
+
+def snapshot(troops):
+    return SimpleNamespace(tag="#TEST", town_hall_level=15, town_hall_weapon_level=None, builder_hall_level=10,
+                           troops=troops, heroes=[], spells=[], hero_equipment=[])
+
+
+def test_items_sharing_a_name_are_told_apart_by_village():
+    previous = snapshot([{"name": "Baby Dragon", "level": 5, "village": "home"},
+                         {"name": "Baby Dragon", "level": 3, "village": "builderBase"}])
+    current = snapshot([{"name": "Baby Dragon", "level": 6, "village": "home"},
+                        {"name": "Baby Dragon", "level": 4, "village": "builderBase"}])
+
+    events = find_upgrade_events(previous, current, datetime.now(ZoneInfo("UTC")))
+
+    assert sorted((e["name"], e["village"], e["old_level"], e["new_level"]) for e in events) == [
+        ("Baby Dragon", "builderBase", 3, 4),
+        ("Baby Dragon", "home", 5, 6),
+    ]
+
+
+def test_snapshot_without_village_takes_it_from_the_newer_snapshot():
+    previous = snapshot([{"name": "Raged Barbarian", "level": 2}])
+    current = snapshot([{"name": "Raged Barbarian", "level": 3, "village": "builderBase"}])
+
+    events = find_upgrade_events(previous, current, datetime.now(ZoneInfo("UTC")))
+
+    assert [(e["village"], e["old_level"], e["new_level"]) for e in events] == [("builderBase", 2, 3)]